@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Measures how the parent-side overhead of `bw apply` (dependency
+preparation and item scheduling) scales with the number of items on a
+node.
+
+No SSH connections or worker processes are involved: items finish
+instantly and the WorkerPool is replaced by a synchronous stand-in, so
+all time measured is spent in blockwart.deps and blockwart.node.
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/apply_scheduling.py [COUNT ...]
+"""
+from __future__ import print_function
+
+from random import Random
+import sys
+from time import time
+
+from blockwart import deps
+from blockwart.deps import prepare_dependencies
+from blockwart.items import Item
+from blockwart.node import apply_items
+
+DEFAULT_COUNTS = (250, 500, 1000, 2000, 4000)
+ITEM_TYPES = ("type1", "type2", "type3", "type4")
+
+
+class BenchmarkNode(object):
+    name = "benchmark"
+
+
+class BenchmarkBundle(object):
+    bundle_dir = ""
+
+    def __init__(self, name):
+        self.name = name
+        self.node = BenchmarkNode()
+
+
+class BenchmarkItem(Item):
+    BUNDLE_ATTRIBUTE_NAME = "benchmark"
+    ITEM_TYPE_NAME = "type1"
+
+    def apply(self, *args, **kwargs):
+        return self.STATUS_OK
+
+
+class SynchronousWorkerPool(object):
+    """
+    Mimics the event protocol of blockwart.concurrency.WorkerPool with a
+    single worker that completes every task immediately.
+    """
+    def __init__(self, workers=1, objects=()):
+        self.events = [{'msg': 'REQUEST_WORK', 'wid': 0}]
+        self.jobs_open = 0
+        self.workers_alive = [0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def activate_idle_workers(self):
+        pass
+
+    def get_event(self):
+        msg = self.events.pop(0)
+        if msg['msg'] == 'FINISHED_WORK':
+            self.jobs_open -= 1
+        return msg
+
+    def keep_running(self):
+        return self.jobs_open > 0 or self.workers_alive
+
+    def mark_idle(self, wid):
+        pass
+
+    def quit(self, wid):
+        self.workers_alive.remove(wid)
+
+    def start_task(self, wid, target, task_id=None, args=None, kwargs=None,
+                   target_attrs=None, timeout=None):
+        self.jobs_open += 1
+        self.events.append({
+            'msg': 'FINISHED_WORK',
+            'return_value': target(**(kwargs or {})),
+            'task_id': task_id,
+            'wid': wid,
+        })
+        self.events.append({'msg': 'REQUEST_WORK', 'wid': wid})
+
+
+def make_items(count, seed=0):
+    """
+    Builds a synthetic node: items are spread across a few bundles and
+    types, each item needs up to three earlier items of its own or a
+    "lower" type and some items also need all items of the first type.
+    """
+    rand = Random(seed)
+    bundles = [BenchmarkBundle("bundle{}".format(i)) for i in range(10)]
+    items = []
+    items_by_type = [[] for item_type in ITEM_TYPES]
+    for i in range(count):
+        type_index = i % len(ITEM_TYPES)
+        item_type = ITEM_TYPES[type_index]
+        candidates = []
+        for type_items in items_by_type[:type_index + 1]:
+            candidates.extend(type_items[-50:])
+        needs = []
+        if candidates:
+            for j in range(rand.randint(0, 3)):
+                dep = rand.choice(candidates).id
+                if dep not in needs:
+                    needs.append(dep)
+        if type_index > 0 and i % 3 == 0:
+            needs.append(ITEM_TYPES[0] + ":")
+        item = BenchmarkItem(
+            rand.choice(bundles),
+            "item{}".format(i),
+            {'needs': needs},
+            skip_validation=True,
+        )
+        item.ITEM_TYPE_NAME = item_type
+        items.append(item)
+        items_by_type[type_index].append(item)
+    return items
+
+
+def benchmark(count):
+    node = BenchmarkNode()
+
+    deps._GRAPH_TEMPLATE_CACHE.clear()
+    node.items = make_items(count)
+    start = time()
+    prepare_dependencies(node.items)
+    prepare_time = time() - start
+
+    # same items on another node, so the graph template is reused
+    node.items = make_items(count)
+    start = time()
+    prepare_dependencies(node.items)
+    cached_prepare_time = time() - start
+
+    deps._GRAPH_TEMPLATE_CACHE.clear()
+    node.items = make_items(count)
+    start = time()
+    results = list(apply_items(node, pool_class=SynchronousWorkerPool))
+    apply_time = time() - start
+    assert len(results) == count
+
+    return prepare_time, cached_prepare_time, apply_time
+
+
+def main(counts):
+    print("{:>8}  {:>12}  {:>12}  {:>12}  {:>14}".format(
+        "items", "prepare [s]", "cached [s]", "apply [s]", "apply/item [ms]",
+    ))
+    for count in counts:
+        prepare_time, cached_prepare_time, apply_time = benchmark(count)
+        print("{:>8}  {:>12.3f}  {:>12.3f}  {:>12.3f}  {:>14.3f}".format(
+            count,
+            prepare_time,
+            cached_prepare_time,
+            apply_time,
+            apply_time * 1000 / count,
+        ))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
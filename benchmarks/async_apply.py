@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Measures how blockwart.engine scales with the number of nodes applied
+from a single event loop.
+
+Nodes are served by a FakeTransport: every command takes LATENCY
+seconds without actually connecting anywhere. Each item runs three
+commands (get_status(), fix() and get_status() again).
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/async_apply.py [NODES ...]
+"""
+from __future__ import print_function
+
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import time
+
+from blockwart.engine import apply_nodes, FakeTransport
+from blockwart.items import Item, ItemStatus
+from blockwart.node import Node
+from blockwart.operations import RunResult
+from blockwart.repo import Repository
+from blockwart.utils.eventloop import EventLoop
+
+DEFAULT_NODES = (10, 50, 100)
+EXECUTOR_THREADS = 256
+ITEMS_PER_NODE = 20
+ITEM_WORKERS = 4
+LATENCY = 0.05
+
+
+class BenchmarkBundle(object):
+    bundle_dir = ""
+    name = "benchmark"
+
+
+class BenchmarkItem(Item):
+    BUNDLE_ATTRIBUTE_NAME = "benchmark"
+    ITEM_TYPE_NAME = "type1"
+
+    def fix(self, status):
+        self.node.run("fix " + self.name)
+
+    def get_status(self):
+        result = self.node.run("check " + self.name, may_fail=True)
+        return ItemStatus(correct=result.return_code == 0)
+
+
+class BenchmarkNode(Node):
+    items = ()
+
+
+def make_handler():
+    fixed = set()
+
+    def handler(hostname, command):
+        action, name = command.split(" ", 1)
+        if action == "fix":
+            fixed.add((hostname, name))
+        elif action == "check" and (hostname, name) not in fixed:
+            result = RunResult()
+            result.return_code = 1
+            result.stderr = ""
+            result.stdout = ""
+            return result
+    return handler
+
+
+def make_nodes(repo, count):
+    nodes = []
+    for i in range(count):
+        node = BenchmarkNode("benchmark{}".format(i))
+        repo.add_node(node)
+        bundle = BenchmarkBundle()
+        bundle.node = node
+        node.items = [
+            BenchmarkItem(bundle, "item{}".format(j), {}, skip_validation=True)
+            for j in range(ITEMS_PER_NODE)
+        ]
+        nodes.append(node)
+    return nodes
+
+
+def benchmark(node_count):
+    tmpdir = mkdtemp()
+    try:
+        Repository().create(tmpdir)
+        repo = Repository(tmpdir)
+        nodes = make_nodes(repo, node_count)
+        with EventLoop(executor_threads=EXECUTOR_THREADS) as loop:
+            transport = FakeTransport(loop, handler=make_handler(), latency=LATENCY)
+            start = time()
+            results = loop.run_until_complete(
+                apply_nodes(loop, nodes, transport=transport, workers=ITEM_WORKERS),
+            )
+            duration = time() - start
+        assert all(result.fixed == ITEMS_PER_NODE for result in results.values())
+        return duration, len(transport.commands), transport.max_in_flight
+    finally:
+        rmtree(tmpdir)
+
+
+def main(node_counts):
+    print("{} items per node, {} at a time, {:.0f} ms per command, "
+          "{} executor threads".format(
+              ITEMS_PER_NODE, ITEM_WORKERS, LATENCY * 1000, EXECUTOR_THREADS))
+    print("{:>8}  {:>10}  {:>10}  {:>10}  {:>10}".format(
+        "nodes", "commands", "in flight", "time [s]", "items/s",
+    ))
+    for node_count in node_counts:
+        duration, commands, in_flight = benchmark(node_count)
+        print("{:>8}  {:>10}  {:>10}  {:>10.3f}  {:>10.0f}".format(
+            node_count,
+            commands,
+            in_flight,
+            duration,
+            node_count * ITEMS_PER_NODE / duration,
+        ))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_NODES)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Measures how log records sent by worker processes of a
+blockwart.concurrency.WorkerPool slow down dispatching tasks.
+
+Every task logs LINES_PER_TASK debug messages, like an item running a
+few remote commands (blockwart.operations.run() logs two lines per
+command). The parent either wants to see them (--debug) or not.
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/worker_logging.py [TASKS [WORKERS ...]]
+"""
+from __future__ import print_function
+
+from logging import DEBUG, Handler, INFO
+import sys
+from time import time
+
+from blockwart.concurrency import WorkerPool
+from blockwart.utils import LOG
+
+DEFAULT_TASKS = 2000
+DEFAULT_WORKERS = (1, 4, 8)
+LINES_PER_TASK = 10
+
+
+class CountingHandler(Handler):
+    def __init__(self):
+        Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        self.format(record)
+        self.count += 1
+
+
+class Task(object):
+    def log(self):
+        for i in range(LINES_PER_TASK):
+            LOG.debug("running on %s: %s", "node", "command {}".format(i))
+
+
+def benchmark(tasks, workers, level):
+    handler = CountingHandler()
+    handler.setLevel(level)
+    LOG.addHandler(handler)
+    LOG.setLevel(level)
+    task = Task()
+    start = time()
+    tasks_left = tasks
+    try:
+        with WorkerPool(workers=workers, objects=[task]) as worker_pool:
+            while worker_pool.keep_running():
+                msg = worker_pool.get_event()
+                if msg['msg'] == 'REQUEST_WORK':
+                    if tasks_left:
+                        worker_pool.start_task(msg['wid'], task.log, task_id=tasks_left)
+                        tasks_left -= 1
+                    else:
+                        worker_pool.quit(msg['wid'])
+    finally:
+        LOG.removeHandler(handler)
+    return time() - start, handler.count
+
+
+def main(tasks, worker_counts):
+    print("{:>8}  {:>8}  {:>8}  {:>10}  {:>10}  {:>10}".format(
+        "workers", "tasks", "level", "records", "time [s]", "tasks/s",
+    ))
+    for workers in worker_counts:
+        for level in (INFO, DEBUG):
+            duration, records = benchmark(tasks, workers, level)
+            print("{:>8}  {:>8}  {:>8}  {:>10}  {:>10.3f}  {:>10.0f}".format(
+                workers,
+                tasks,
+                "DEBUG" if level == DEBUG else "INFO",
+                records,
+                duration,
+                tasks / duration,
+            ))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(
+        args[0] if args else DEFAULT_TASKS,
+        args[1:] or DEFAULT_WORKERS,
+    )
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Measures how many trivial tasks per second a
+blockwart.concurrency.WorkerPool or ThreadPool can dispatch. Tasks do no
+work at all, so this is the per-task overhead of talking to the workers.
+
+Tasks are bound methods of an object referring to a lot of data (like
+an item referring to its node and repository). For worker processes,
+that object is either pickled for every task or handed to the workers
+once at startup. Worker threads simply share it.
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/worker_pool.py [TASKS [WORKERS ...]]
+"""
+from __future__ import print_function
+
+import sys
+from time import time
+
+from blockwart.concurrency import ThreadPool, WorkerPool
+
+DEFAULT_TASKS = 5000
+DEFAULT_WORKERS = (1, 4, 8)
+PAYLOAD_SIZE = 10000
+
+
+class Task(object):
+    def __init__(self):
+        self.payload = [{'key': "value {}".format(i)} for i in range(PAYLOAD_SIZE)]
+
+    def noop(self):
+        return None
+
+
+DISPATCH_MODES = ("pickle", "reference", "threads")
+
+
+def benchmark(tasks, workers, dispatch):
+    task = Task()
+    objects = [] if dispatch == "pickle" else [task]
+    pool_class = ThreadPool if dispatch == "threads" else WorkerPool
+    start = time()
+    tasks_left = tasks
+    with pool_class(workers=workers, objects=objects) as worker_pool:
+        while worker_pool.keep_running():
+            msg = worker_pool.get_event()
+            if msg['msg'] == 'REQUEST_WORK':
+                if tasks_left:
+                    worker_pool.start_task(msg['wid'], task.noop, task_id=tasks_left)
+                    tasks_left -= 1
+                else:
+                    worker_pool.quit(msg['wid'])
+    return time() - start
+
+
+def main(tasks, worker_counts):
+    print("{:>8}  {:>8}  {:>10}  {:>10}  {:>10}".format(
+        "workers", "tasks", "dispatch", "time [s]", "tasks/s",
+    ))
+    for workers in worker_counts:
+        for dispatch in DISPATCH_MODES:
+            duration = benchmark(tasks, workers, dispatch)
+            print("{:>8}  {:>8}  {:>10}  {:>10.3f}  {:>10.0f}".format(
+                workers,
+                tasks,
+                dispatch,
+                duration,
+                tasks / duration,
+            ))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(
+        args[0] if args else DEFAULT_TASKS,
+        args[1:] or DEFAULT_WORKERS,
+    )
@@ -6,9 +6,8 @@ from os import getcwd
 import re
 from sys import argv, exit, stderr, stdout
 
-from fabric.network import disconnect_all
-
 from ..exceptions import NoSuchRepository
+from ..operations import disconnect_all
 from ..repo import Repository
 from ..utils.text import mark_for_translation as _, red
 from .parser import build_parser_bw
@@ -1,9 +1,10 @@
 from datetime import datetime
 
-from ..concurrency import WorkerPool
+from ..concurrency import PoolMetrics, ThreadPool, WorkerPool
 from ..exceptions import WorkerException
+from ..scheduler import apply_nodes
 from ..utils import LOG
-from ..utils.cmdline import get_target_nodes
+from ..utils.cmdline import dump_metrics, get_target_nodes
 from ..utils.text import bold, green, red, yellow
 from ..utils.text import error_summary, mark_for_translation as _
 
@@ -30,22 +31,48 @@ def format_node_result(result):
     return ", ".join(output)
 
 
-def bw_apply(repo, args):
-    errors = []
-    target_nodes = get_target_nodes(repo, args.target)
-
-    repo.hooks.apply_start(
-        repo,
-        args.target,
+def _apply(target_nodes, args, errors, metrics):
+    for event, node, value in apply_nodes(
         target_nodes,
-        interactive=args.interactive,
-    )
-
-    start_time = datetime.now()
-
-    worker_count = 1 if args.interactive else args.node_workers
-    with WorkerPool(workers=worker_count) as worker_pool:
-        results = {}
+        force=args.force,
+        item_timeout=args.item_timeout,
+        item_workers=args.item_workers,
+        metrics=metrics,
+        node_timeout=args.node_timeout,
+        node_workers=args.node_workers,
+        pool_class=ThreadPool if args.item_threads else WorkerPool,
+        workers=args.total_workers,
+    ):
+        if event == 'started':
+            LOG.info(_("{}: run started at {}").format(
+                node.name,
+                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            ))
+        elif event == 'finished':
+            LOG.info(_("{node}: run completed after {time}s").format(
+                node=node.name,
+                time=value.duration.total_seconds(),
+            ))
+            if value.connection_setup_time is not None:
+                LOG.info(_("{node}: connected after {time:.3f}s").format(
+                    node=node.name,
+                    time=value.connection_setup_time,
+                ))
+            LOG.info(_("{node}: stats: {stats}").format(
+                node=node.name,
+                stats=format_node_result(value),
+            ))
+        else:
+            msg = "{}: {} {}".format(node.name, red("!"), value.wrapped_exception)
+            if args.debug:
+                yield value.traceback
+            yield msg
+            errors.append(msg)
+
+
+def _apply_interactive(target_nodes, args, errors, metrics):
+    # nodes are applied one after another, each in a single worker
+    with WorkerPool(workers=1, objects=target_nodes, metrics=metrics) as worker_pool:
         while worker_pool.keep_running():
             try:
                 msg = worker_pool.get_event()
@@ -53,64 +80,67 @@ def bw_apply(repo, args):
                 msg = "{} {}".format(red("!"), e.wrapped_exception)
                 if args.debug:
                     yield e.traceback
-                if not args.interactive:
-                    msg = "{}: {}".format(e.task_id, msg)
                 yield msg
                 errors.append(msg)
                 continue
             if msg['msg'] == 'REQUEST_WORK':
                 if target_nodes:
                     node = target_nodes.pop()
-                    node_start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                    if args.interactive:
-                        yield _("{}: run started at {}").format(
-                            bold(node.name),
-                            node_start_time,
-                        )
-                    else:
-                        LOG.info(_("{}: run started at {}").format(
-                            node.name,
-                            node_start_time,
-                        ))
-
+                    yield _("{}: run started at {}").format(
+                        bold(node.name),
+                        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    )
                     worker_pool.start_task(
                         msg['wid'],
                         node.apply,
                         task_id=node.name,
                         kwargs={
                             'force': args.force,
-                            'interactive': args.interactive,
-                            'workers': args.item_workers,
+                            'interactive': True,
+                            'pool_class': ThreadPool if args.item_threads else WorkerPool,
                         },
                     )
                 else:
                     worker_pool.quit(msg['wid'])
             elif msg['msg'] == 'FINISHED_WORK':
-                node_name = msg['task_id']
-                results[node_name] = msg['return_value']
-
-                if args.interactive:
-                    yield _("{node}: run completed after {time}s ({stats})\n").format(
-                        node=bold(node_name),
-                        time=results[node_name].duration.total_seconds(),
-                        stats=format_node_result(results[node_name]),
-                    )
-                else:
-                    LOG.info(_("{node}: run completed after {time}s").format(
-                        node=node_name,
-                        time=results[node_name].duration.total_seconds(),
-                    ))
-                    LOG.info(_("{node}: stats: {stats}").format(
-                        node=node_name,
-                        stats=format_node_result(results[node_name]),
-                    ))
+                result = msg['return_value']
+                yield _("{node}: run completed after {time}s ({stats})\n").format(
+                    node=bold(msg['task_id']),
+                    time=result.duration.total_seconds(),
+                    stats=format_node_result(result),
+                )
+
+
+def bw_apply(repo, args):
+    errors = []
+    target_nodes = get_target_nodes(repo, args.target)
+
+    repo.hooks.apply_start(
+        repo,
+        args.target,
+        target_nodes,
+        interactive=args.interactive,
+    )
+
+    start_time = datetime.now()
+    metrics = PoolMetrics()
+
+    if args.interactive:
+        output = _apply_interactive(list(target_nodes), args, errors, metrics)
+    else:
+        output = _apply(target_nodes, args, errors, metrics)
+    for line in output:
+        yield line
 
     error_summary(errors)
 
+    if args.metrics_file:
+        dump_metrics(metrics, args.metrics_file)
+
     repo.hooks.apply_end(
         repo,
         args.target,
         target_nodes,
         duration=datetime.now() - start_time,
+        metrics=metrics,
     )
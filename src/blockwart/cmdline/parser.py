@@ -59,6 +59,38 @@ def build_parser_bw():
         dest='interactive',
         help=_("ask before applying each item"),
     )
+    parser_apply.add_argument(
+        "--item-timeout",
+        default=None,
+        dest='item_timeout',
+        help=_("number of seconds after which an item is considered failed"),
+        metavar=_("SECONDS"),
+        type=float,
+    )
+    parser_apply.add_argument(
+        "-j",
+        "--jobs",
+        default=16,
+        dest='total_workers',
+        help=_("number of items to apply simultaneously across all nodes"),
+        type=int,
+    )
+    parser_apply.add_argument(
+        "--metrics",
+        default=None,
+        dest='metrics_file',
+        help=_("write worker pool timings to this JSON file"),
+        metavar=_("FILE"),
+        type=str,
+    )
+    parser_apply.add_argument(
+        "--node-timeout",
+        default=None,
+        dest='node_timeout',
+        help=_("number of seconds after which remaining items on a node are skipped"),
+        metavar=_("SECONDS"),
+        type=float,
+    )
     parser_apply.add_argument(
         "-p",
         "--parallel-nodes",
@@ -75,6 +107,14 @@ def build_parser_bw():
         help=_("number of items to apply to simultaneously on each node"),
         type=int,
     )
+    parser_apply.add_argument(
+        "-t",
+        "--threads",
+        action='store_true',
+        default=False,
+        dest='item_threads',
+        help=_("use threads instead of processes to apply items on each node"),
+    )
 
     # bw groups
     parser_groups = subparsers.add_parser("groups")
@@ -207,7 +247,7 @@ def build_parser_bw():
         "--no-depends-conc",
         action='store_false',
         dest='depends_concurrency',
-        help=_("do not show concurrency blocker dependencies"),
+        help=_("do not show concurrency blockers"),
     )
     parser_repo_subparsers_plot.add_argument(
         "--no-depends-regular",
@@ -302,6 +342,14 @@ def build_parser_bw():
         type=str,
         help=_("target nodes, groups and/or bundle selectors"),
     )
+    parser_verify.add_argument(
+        "--metrics",
+        default=None,
+        dest='metrics_file',
+        help=_("write worker pool timings to this JSON file"),
+        metavar=_("FILE"),
+        type=str,
+    )
     parser_verify.add_argument(
         "-p",
         "--parallel-nodes",
@@ -318,6 +366,14 @@ def build_parser_bw():
         help=_("number of items to verify to simultaneously on each node"),
         type=int,
     )
+    parser_verify.add_argument(
+        "-t",
+        "--threads",
+        action='store_true',
+        default=False,
+        dest='item_threads',
+        help=_("use threads instead of processes to verify items on each node"),
+    )
 
     # bw zen
     parser_zen = subparsers.add_parser("zen")
@@ -6,9 +6,9 @@ from copy import copy
 from sys import exit
 
 from .. import VERSION_STRING
-from ..concurrency import WorkerPool
+from ..deps import prepare_dependency_graph
 from ..exceptions import WorkerException
-from ..node import prepare_dependencies
+from ..node import test_nodes
 from ..repo import Repository
 from ..utils import graph_for_items
 from ..utils.cmdline import get_target_nodes
@@ -44,7 +44,7 @@ def bw_repo_plot(repo, args):
     node = repo.get_node(args.node)
     for line in graph_for_items(
         node.name,
-        prepare_dependencies(node.items),
+        prepare_dependency_graph(node.items),
         cluster=args.cluster,
         concurrency=args.depends_concurrency,
         static=args.depends_static,
@@ -60,29 +60,14 @@ def bw_repo_test(repo, args):
         target_nodes = get_target_nodes(repo, args.target)
     else:
         target_nodes = copy(list(repo.nodes))
-    with WorkerPool(workers=args.node_workers) as worker_pool:
-        while worker_pool.keep_running():
-            try:
-                msg = worker_pool.get_event()
-            except WorkerException as e:
-                msg = "{} {}\n".format(
-                    red("✘"),
-                    e.task_id,
-                )
-                yield msg
-                yield e.traceback
-                exit(1)
-                break  # for testing, when exit() is patched
-            if msg['msg'] == 'REQUEST_WORK':
-                if target_nodes:
-                    node = target_nodes.pop()
-                    worker_pool.start_task(
-                        msg['wid'],
-                        node.test,
-                        task_id=node.name,
-                        kwargs={
-                            'workers': args.item_workers,
-                        },
-                    )
-                else:
-                    worker_pool.quit(msg['wid'])
+    try:
+        # a single pool for all nodes, as big as it would have been
+        # with node_workers nodes testing item_workers items each
+        test_nodes(target_nodes, workers=args.node_workers * args.item_workers)
+    except WorkerException as e:
+        yield "{} {}\n".format(
+            red("✘"),
+            e.task_id,
+        )
+        yield e.traceback
+        exit(1)
@@ -1,45 +1,42 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from ..concurrency import WorkerPool
+from ..concurrency import PoolMetrics, ThreadPool, WorkerPool
 from ..exceptions import WorkerException
-from ..utils.cmdline import get_target_nodes
+from ..node import verify_nodes
+from ..utils.cmdline import dump_metrics, get_target_nodes
 from ..utils.text import error_summary, red
 
 
 def bw_verify(repo, args):
     errors = []
     target_nodes = get_target_nodes(repo, args.target)
-    with WorkerPool(workers=args.node_workers) as worker_pool:
-        while worker_pool.keep_running():
-            try:
-                msg = worker_pool.get_event()
-            except WorkerException as e:
-                msg = "{} {}: {}".format(
-                    red("!"),
-                    e.task_id,
-                    e.wrapped_exception,
-                )
-                if args.debug:
-                    yield e.traceback
-                if not args.interactive:
-                    msg = "{}: {}".format(e.task_id, msg)
-                yield msg
-                errors.append(msg)
-                continue
-            if msg['msg'] == 'REQUEST_WORK':
-                if target_nodes:
-                    node = target_nodes.pop()
-                    worker_pool.start_task(
-                        msg['wid'],
-                        node.verify,
-                        task_id=node.name,
-                        kwargs={
-                            'workers': args.item_workers,
-                        },
-                    )
-                else:
-                    worker_pool.quit(msg['wid'])
-            # Nothing to do for the 'FINISHED_WORK' message.
+    metrics = PoolMetrics()
+    try:
+        # a single pool for all nodes, as big as it would have been
+        # with node_workers nodes verifying item_workers items each
+        exceptions = verify_nodes(
+            target_nodes,
+            workers=args.node_workers * args.item_workers,
+            metrics=metrics,
+            pool_class=ThreadPool if args.item_threads else WorkerPool,
+        )
+    except WorkerException as e:
+        # loading the items of a node failed
+        exceptions = [e]
+
+    for e in exceptions:
+        msg = "{} {}: {}".format(
+            red("!"),
+            e.task_id,
+            e.wrapped_exception,
+        )
+        if args.debug:
+            yield e.traceback
+        yield msg
+        errors.append(msg)
 
     error_summary(errors)
+
+    if args.metrics_file:
+        dump_metrics(metrics, args.metrics_file)
@@ -1,115 +1,426 @@
+from collections import deque
 from inspect import ismethod, isgenerator
-from logging import getLogger, Handler
-from multiprocessing import Manager, Pipe, Process
-from os import dup, fdopen
+from logging import Formatter, getLevelName, getLogger, Handler, makeLogRecord, NOTSET
+from multiprocessing import Pipe, Process
+from os import close, dup, fdopen, kill, pipe as os_pipe, read, times, write
+from Queue import Queue
+from select import select
+from signal import SIGKILL, signal, SIGTERM
 import sys
+from threading import current_thread, RLock, Thread
+from time import sleep, time
 from traceback import format_exception
 
-from fabric.network import disconnect_all
-
-from .exceptions import WorkerException
+from .exceptions import TaskTimeoutException, WorkerException
+from .operations import disconnect_all
 from .utils import LOG
 from .utils.text import mark_for_translation as _
 
 JOIN_TIMEOUT = 5
 
+# log entries are sent to the parent once this many have piled up or
+# the oldest one has been waiting for this many seconds
+LOG_BATCH_SIZE = 100
+LOG_BATCH_INTERVAL = 0.1
+
+_EXCEPTION_FORMATTER = Formatter()
+
 
 class ChildLogHandler(Handler):
     """
-    Captures log events in child processes and inserts them into the
-    queue to be processed by the parent process.
+    Captures log events in child processes and sends them through the
+    worker's pipe to be processed by the parent process.
+
+    Records are formatted right away, so their arguments and tracebacks
+    don't have to be pickled. Instead of sending every single one of
+    them, they are buffered and sent along with the next message the
+    worker sends anyway (see send()), unless there are too many of them
+    or they have been waiting for too long. Once start_timer() has been
+    called, the latter is also checked while no records are coming in.
     """
-    def __init__(self, messages):
-        Handler.__init__(self)
-        self.messages = messages
+    def __init__(self, pipe, level=NOTSET):
+        Handler.__init__(self, level)
+        self.pipe = pipe
+        self.log_entries = []
+        self.oldest_entry = None
+        self.stopped = False
+        self._sending = False
 
     def emit(self, record):
-        self.messages.put({'msg': 'LOG_ENTRY', 'log_entry': record})
+        try:
+            if record.exc_info and not record.exc_text:
+                record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            log_entry = (
+                record.name,
+                record.levelno,
+                record.getMessage(),
+                record.exc_text,
+                record.created,
+                record.process,
+            )
+        except:
+            self.handleError(record)
+            return
+        if not self.log_entries:
+            self.oldest_entry = time()
+        self.log_entries.append(log_entry)
+        if (
+            len(self.log_entries) >= LOG_BATCH_SIZE or
+            time() - self.oldest_entry >= LOG_BATCH_INTERVAL
+        ):
+            self.flush()
+
+    def _flush_periodically(self):
+        while True:
+            sleep(LOG_BATCH_INTERVAL)
+            self.acquire()
+            try:
+                if self.stopped:
+                    return
+                if (
+                    self.log_entries and
+                    time() - self.oldest_entry >= LOG_BATCH_INTERVAL
+                ):
+                    self.flush()
+            finally:
+                self.release()
+
+    def flush(self):
+        self.acquire()
+        try:
+            # We might be called by a signal handler while a message is
+            # being sent. Starting another one would garble both.
+            if (
+                self.log_entries and
+                not self._sending and
+                not self.stopped
+            ):
+                self.send({'msg': 'LOG_ENTRIES'})
+        finally:
+            self.release()
+
+    def send(self, msg):
+        """
+        Sends msg to the parent along with all buffered log entries.
+        """
+        self.acquire()
+        try:
+            self._sending = True
+            msg['log_entries'] = self.log_entries
+            self.log_entries = []
+            self.pipe.send(msg)
+        finally:
+            self._sending = False
+            self.release()
+
+    def start_timer(self):
+        """
+        Starts a thread sending buffered log entries once they have been
+        waiting for LOG_BATCH_INTERVAL seconds, so the parent gets them
+        even if the task logging them hangs.
+        """
+        thread = Thread(target=self._flush_periodically)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Sends all remaining log entries. Nothing is sent after this.
+        """
+        self.acquire()
+        try:
+            self.flush()
+            self.stopped = True
+        finally:
+            self.release()
 
 
-def _patch_logger(logger, new_handler=None):
+def _log_record(log_entry):
+    """
+    Turns a log entry sent by ChildLogHandler back into a LogRecord.
+    """
+    name, levelno, message, exc_text, created, process = log_entry
+    return makeLogRecord({
+        'created': created,
+        'exc_text': exc_text,
+        'levelname': getLevelName(levelno),
+        'levelno': levelno,
+        'msecs': (created - int(created)) * 1000,
+        'msg': message,
+        'name': name,
+        'process': process,
+    })
+
+
+def _patch_logger(logger, new_handler=None, level=NOTSET):
     for handler in logger.handlers:
         logger.removeHandler(handler)
     if new_handler is not None:
         logger.addHandler(new_handler)
-    logger.setLevel(0)
+    logger.setLevel(level)
+
 
+def _terminate(signum, frame):
+    # the parent still reads what we have logged so far
+    for handler in getLogger().handlers:
+        handler.flush()
+    # unwind the stack (closing connections and so on) instead of
+    # dying on the spot
+    raise SystemExit(1)
 
-def _worker_process(wid, messages, pipe, stdin=None):
+
+def _worker_process(wid, pipe, stdin=None, objects=(), log_level=NOTSET):
     """
     This is what actually runs in the child process.
+
+    objects are the objects the pool was created with. Tasks refer to
+    them by their position in that list.
+
+    Log records below log_level are dropped right here instead of being
+    sent to the parent just to be ignored there.
     """
     if stdin is not None:
         # replace stdin with the one our parent gave us
         sys.stdin = stdin
 
+    signal(SIGTERM, _terminate)
+
     # replace the child logger with one that will send logs back to the
     # parent process
     from blockwart import utils
-    child_log_handler = ChildLogHandler(messages)
-    _patch_logger(getLogger(), child_log_handler)
-    _patch_logger(utils.LOG)
+    child_log_handler = ChildLogHandler(pipe, level=log_level)
+    _patch_logger(getLogger(), child_log_handler, level=log_level)
+    _patch_logger(utils.LOG, level=log_level)
+    # everything we send needs to go through the handler, so buffered
+    # log entries come first
+    send = child_log_handler.send
+    child_log_handler.start_timer()
 
     while True:
-        # These two calls can block for an infinite amount of time. We
-        # request work via the public queue and, eventually, some day,
-        # we might get an answer via our private pipe.
-        messages.put({'msg': 'REQUEST_WORK', 'wid': wid})
+        # This can block for an infinite amount of time. We request
+        # work and, eventually, some day, we might get an answer.
+        send({'msg': 'REQUEST_WORK', 'wid': wid})
         msg = pipe.recv()
         if msg['msg'] == 'DIE':
             # clean up Fabric connections first...
             disconnect_all()
+            # the parent reads what we have logged until we are gone
+            child_log_handler.stop()
             # then die
             return
         elif msg['msg'] == 'NOOP':
             pass
         elif msg['msg'] == 'RUN':
-            exception = None
-            exception_task_id = None
-            return_value = None
-            traceback = None
+            send(_run_task(wid, msg, objects))
 
-            try:
-                if msg['target_obj'] is None:
-                    target = msg['target']
-                else:
-                    target = getattr(msg['target_obj'], msg['target'])
 
-                return_value = target(*msg['args'], **msg['kwargs'])
+def _worker_thread(wid, tasks, send):
+    """
+    This is what actually runs in a worker thread. Unlike worker
+    processes, threads share all objects (and connections) with the rest
+    of the process.
+    """
+    while True:
+        send({'msg': 'REQUEST_WORK', 'wid': wid})
+        msg = tasks.get()
+        if msg['msg'] == 'DIE':
+            return
+        elif msg['msg'] == 'NOOP':
+            pass
+        elif msg['msg'] == 'RUN':
+            send(_run_task(wid, msg))
 
-                if isgenerator(return_value):
-                    return_value = list(return_value)
 
-            except Exception as e:
-                if isinstance(e, WorkerException):
-                    exception = e.wrapped_exception
-                    exception_task_id = e.task_id
-                else:
-                    exception = str(e)
-                    exception_task_id = msg['task_id']
-                traceback = "".join(format_exception(*sys.exc_info()))
-                return_value = None
+def _run_task(wid, msg, objects=()):
+    """
+    Runs the task described by a 'RUN' message and returns the
+    'FINISHED_WORK' message to report back.
+    """
+    exception = None
+    exception_task_id = None
+    return_value = None
+    traceback = None
+
+    try:
+        if msg['target_ref'] is not None:
+            target_obj = objects[msg['target_ref']]
+        else:
+            target_obj = msg['target_obj']
 
-            finally:
-                messages.put({
-                    'exception': exception,
-                    'exception_task_id': exception_task_id,
-                    'msg': 'FINISHED_WORK',
-                    'return_value': return_value,
-                    'task_id': msg['task_id'],
-                    'traceback': traceback,
-                    'wid': wid,
-                })
+        if target_obj is None:
+            target = msg['target']
+        else:
+            for attr_name, attr_value in msg['target_attrs'].iteritems():
+                setattr(target_obj, attr_name, attr_value)
+            target = getattr(target_obj, msg['target'])
+
+        return_value = target(*msg['args'], **msg['kwargs'])
+
+        if isgenerator(return_value):
+            return_value = list(return_value)
+
+    except Exception as e:
+        if isinstance(e, WorkerException):
+            exception = e.wrapped_exception
+            exception_task_id = e.task_id
+        else:
+            exception = str(e)
+            exception_task_id = msg['task_id']
+        traceback = "".join(format_exception(*sys.exc_info()))
+        return_value = None
+
+    return {
+        'exception': exception,
+        'exception_task_id': exception_task_id,
+        'msg': 'FINISHED_WORK',
+        'return_value': return_value,
+        'task_id': msg['task_id'],
+        'traceback': traceback,
+        'wid': wid,
+    }
+
+
+def _cpu_time():
+    user, system = times()[:2]
+    return user + system
+
+
+class PoolMetrics(object):
+    """
+    Collects timings from worker pools to tell whether a run spends
+    most of its time waiting for workers (e.g. for remote commands) or
+    for the parent process to hand out work.
+
+    All times are in seconds, as seen by the parent process. Pass the
+    same object to several pools to add up their metrics.
+    """
+    def __init__(self):
+        self.start = None
+        self.end = None
+        # CPU time used by the parent process while pools were running
+        # (for ThreadPool, this includes the worker threads)
+        self.cpu_time = 0.0
+        self.messages = 0
+        # time messages spent waiting for get_event() after they had
+        # been received
+        self.message_latency_max = 0.0
+        self.message_latency_total = 0.0
+        # list of dicts with the 'task_id' given to start_task(), how
+        # long the task had been ready to be started before that
+        # ('queued', None unless start_task() was told), how long the
+        # worker had been idle before getting it ('idle') and how long
+        # it took the worker to finish it ('run')
+        self.tasks = []
+        # maps wids to dicts holding the total 'busy' and 'idle' time
+        # and the number of 'tasks' of each worker
+        self.workers = {}
+
+        self._busy_since = {}
+        self._cpu_start = None
+        self._idle_since = {}
+        self._running_tasks = {}
+
+    def pool_started(self, workers):
+        if self.start is None:
+            self.start = time()
+        self._cpu_start = _cpu_time()
+        for wid in range(workers):
+            self.workers.setdefault(wid, {'busy': 0.0, 'idle': 0.0, 'tasks': 0})
+
+    def pool_stopped(self):
+        if self._cpu_start is None:
+            return
+        self.end = time()
+        self.cpu_time += _cpu_time() - self._cpu_start
+        self._cpu_start = None
+
+    def message_handled(self, msg):
+        """
+        Called with every message returned by get_event(). Messages need
+        a 'received' timestamp.
+        """
+        now = time()
+        self.messages += 1
+        latency = now - msg['received']
+        self.message_latency_total += latency
+        self.message_latency_max = max(self.message_latency_max, latency)
+        if msg['msg'] == 'REQUEST_WORK':
+            self._idle_since[msg['wid']] = msg['received']
+        elif msg['msg'] == 'FINISHED_WORK':
+            wid = msg['wid']
+            run_time = msg['received'] - self._busy_since.pop(wid, msg['received'])
+            self.workers[wid]['busy'] += run_time
+            task = self._running_tasks.pop(wid, None)
+            if task is not None:
+                task['run'] = run_time
+
+    def task_started(self, wid, task_id, ready_since=None):
+        now = time()
+        idle = now - self._idle_since.pop(wid, now)
+        self.workers[wid]['idle'] += idle
+        self.workers[wid]['tasks'] += 1
+        self._busy_since[wid] = now
+        task = {
+            'idle': idle,
+            'queued': None if ready_since is None else now - ready_since,
+            'run': None,
+            'task_id': task_id,
+        }
+        self._running_tasks[wid] = task
+        self.tasks.append(task)
+
+    def worker_quit(self, wid):
+        now = time()
+        self.workers[wid]['idle'] += now - self._idle_since.pop(wid, now)
+
+    def as_dict(self):
+        """
+        Returns a summary suitable for JSON.
+        """
+        duration = (self.end or time()) - (self.start or time())
+        busy = sum([worker['busy'] for worker in self.workers.values()])
+        capacity = duration * len(self.workers)
+        return {
+            'cpu_time': self.cpu_time,
+            'duration': duration,
+            'message_latency_max': self.message_latency_max,
+            'message_latency_mean': self.message_latency_total / self.messages
+                                    if self.messages else 0.0,
+            'messages': self.messages,
+            'messages_per_second': self.messages / duration if duration else 0.0,
+            'tasks': self.tasks,
+            'utilization': busy / capacity if capacity else 0.0,
+            'workers': self.workers,
+        }
 
 
 class WorkerPool(object):
     """
     Manages a bunch of worker processes.
+
+    Every worker gets its own copy of the given objects when it is
+    started (on Linux, it simply inherits them when forked). Bound
+    methods of these objects passed to start_task() are sent to the
+    worker by reference instead of pickling the object (and everything
+    it refers to, like the whole repository) for every task.
+
+    Timings are collected in self.metrics, a PoolMetrics object (a new
+    one unless one is given).
     """
-    def __init__(self, workers=4):
+    def __init__(self, workers=4, objects=(), metrics=None):
         if workers < 1:
             raise ValueError(_("at least one worker is required"))
 
+        self.metrics = PoolMetrics() if metrics is None else metrics
+        self.metrics.pool_started(workers)
+
+        # objects are looked up by identity, keep them alive so their
+        # id()s won't be reused
+        self.objects = list(objects)
+        self.object_refs = {}
+        for ref, obj in enumerate(self.objects):
+            self.object_refs[id(obj)] = ref
+
         # A "worker" is simply a tuple consisting of a Process object
         # and our end of a pipe. Each worker is always adressed with
         # it's "worker id" (wid): That's the index of the tuple in
@@ -126,28 +437,67 @@ class WorkerPool(object):
         # job. We only need to know how many there are.
         self.jobs_open = 0
 
-        # The public message queue. Workers ask for jobs here, report
-        # finished work and log items.
-        # Note: There's (at least) two ways to organize a pool like
-        # this. One is to only open a pipe to each worker. Then, you can
-        # use select() to see which pipe can be read from. Problem is,
-        # this is not really supported by the multiprocessing module;
-        # you have to dig into the internals and that's ugly. So, we go
-        # for another option: A managed queue. Multiple processes can
-        # write to it (all the workers do) and the parent can read from
-        # it. However, this is only feasible when workers must talk to
-        # the parent. The parent can't talk to the workers using this
-        # queue. Thus, we still need a dedicated pipe to each worker
-        # (see below).
-        self.messages = Manager().Queue()
-
-        stdin = fdopen(dup(sys.stdin.fileno())) if workers == 1 else None
+        # Maps wids of workers running a task with a time limit to a
+        # (deadline, task_id, timeout) tuple.
+        self.deadlines = {}
+
+        # Each worker talks to us through its own duplex pipe: workers
+        # ask for jobs, report finished work and send log entries while
+        # we send them jobs in return. We wait for any of the pipes to
+        # become readable using select(). Messages that arrive together
+        # are buffered here until get_event() is called again.
+        self.messages = deque()
+
+        self.stdin = fdopen(dup(sys.stdin.fileno())) if workers == 1 else None
+        self.log_level = LOG.getEffectiveLevel()
         for i in range(workers):
-            (parent_conn, child_conn) = Pipe()
-            p = Process(target=_worker_process,
-                        args=(i, self.messages, child_conn, stdin,))
-            p.start()
-            self.workers.append((p, parent_conn))
+            self.workers.append(self._start_worker(i))
+
+    def _start_worker(self, wid):
+        (parent_conn, child_conn) = Pipe()
+        p = Process(target=_worker_process,
+                    args=(wid, child_conn, self.stdin, self.objects, self.log_level))
+        p.start()
+        # close our copy of the child's end, so we'll notice when
+        # the child goes away
+        child_conn.close()
+        return (p, parent_conn)
+
+    def _drain(self, pipe, deadline):
+        """
+        Handles the log entries of everything a worker that has been
+        told to go away still sends, until it is gone or the deadline
+        has passed. Other messages are dropped.
+        """
+        while True:
+            timeout = deadline - time()
+            if timeout <= 0:
+                return
+            try:
+                if not pipe.poll(timeout):
+                    return
+                msg = pipe.recv()
+            except (EOFError, IOError):
+                # the worker is gone
+                return
+            for log_entry in msg.get('log_entries', ()):
+                LOG.handle(_log_record(log_entry))
+
+    def _replace_worker(self, wid):
+        """
+        Kills the given worker and starts a new one in its place.
+        """
+        (process, pipe) = self.workers[wid]
+        deadline = time() + JOIN_TIMEOUT
+        process.terminate()
+        # the worker sends what it has logged before exiting
+        self._drain(pipe, deadline)
+        pipe.close()
+        process.join(max(0, deadline - time()))
+        if process.is_alive():
+            kill(process.pid, SIGKILL)
+            process.join()
+        self.workers[wid] = self._start_worker(wid)
 
     def __enter__(self):
         return self
@@ -159,39 +509,134 @@ class WorkerPool(object):
         """
         Blocks until a message from a worker is received.
         """
-        msg = self.messages.get()
+        while True:
+            self._expire_tasks()
+            if self.messages:
+                break
+            if self.deadlines:
+                timeout = max(0, min(self.deadlines.values())[0] - time())
+            else:
+                timeout = None
+            self._receive_messages(timeout)
+        msg = self.messages.popleft()
+        self.metrics.message_handled(msg)
+        for log_entry in msg.get('log_entries', ()):
+            LOG.handle(_log_record(log_entry))
         if msg['msg'] == 'FINISHED_WORK':
             self.jobs_open -= 1
+            self.deadlines.pop(msg['wid'], None)
             # check for exception in child process and raise it
             # here in the parent
             if not msg['traceback'] is None:
-                raise WorkerException(
+                if msg.get('timed_out', False):
+                    exception_class = TaskTimeoutException
+                else:
+                    exception_class = WorkerException
+                raise exception_class(
                     msg['exception_task_id'],
                     msg['exception'],
                     msg['traceback'],
                 )
-        elif msg['msg'] == 'LOG_ENTRY':
-            LOG.handle(msg['log_entry'])
         return msg
 
-    def start_task(self, wid, target, task_id=None, args=None, kwargs=None):
+    def _expire_tasks(self):
+        """
+        Replaces workers that have been running a task for longer than
+        its timeout and reports those tasks as failed.
         """
-        wid         id of the worker to use
-        target      any callable (includes bound methods)
-        task_id     something to remember this worker by
-        args        list of positional arguments passed to target
-        kwargs      dictionary of keyword arguments passed to target
+        if not self.deadlines:
+            return
+        now = time()
+        finished = set([
+            msg['wid'] for msg in list(self.messages)
+            if msg['msg'] == 'FINISHED_WORK'
+        ])
+        for wid, (deadline, task_id, timeout) in list(self.deadlines.items()):
+            if deadline > now or wid in finished:
+                continue
+            del self.deadlines[wid]
+            self._replace_worker(wid)
+            error = _("task {task} timed out after {time} seconds").format(
+                task=task_id,
+                time=timeout,
+            )
+            self.messages.append({
+                'exception': error,
+                'exception_task_id': task_id,
+                'msg': 'FINISHED_WORK',
+                'received': now,
+                'return_value': None,
+                'task_id': task_id,
+                'timed_out': True,
+                'traceback': error,
+                'wid': wid,
+            })
+
+    def _receive_messages(self, timeout=None):
+        """
+        Waits until at least one worker has sent a message (or timeout
+        seconds have passed) and reads one message from every worker
+        that has.
         """
+        pipes = {}
+        for wid in self.workers_alive:
+            pipe = self.workers[wid][1]
+            pipes[pipe.fileno()] = (wid, pipe)
+        readable, writable, exceptional = select(pipes.keys(), [], [], timeout)
+        for fileno in readable:
+            wid, pipe = pipes[fileno]
+            try:
+                msg = pipe.recv()
+                msg['received'] = time()
+                self.messages.append(msg)
+            except EOFError:
+                # the worker exited without saying goodbye, waiting for
+                # it would block forever
+                error = _("worker process with PID {pid} died unexpectedly").format(
+                    pid=self.workers[wid][0].pid,
+                )
+                raise WorkerException(None, error, error)
+
+    def start_task(self, wid, target, task_id=None, args=None, kwargs=None,
+                   target_attrs=None, timeout=None, ready_since=None):
+        """
+        wid             id of the worker to use
+        target          any callable (includes bound methods)
+        task_id         something to remember this worker by
+        args            list of positional arguments passed to target
+        kwargs          dictionary of keyword arguments passed to target
+        target_attrs    dictionary of attributes to set on the object
+                        target is bound to before calling it (if the
+                        object was passed to the pool, the worker's copy
+                        won't see any changes made after the pool was
+                        started)
+        timeout         number of seconds after which get_event() will
+                        raise TaskTimeoutException for this task and
+                        replace the worker running it
+        ready_since     timestamp at which the task could have been
+                        started (for self.metrics)
+        """
+        if timeout is not None:
+            self.deadlines[wid] = (time() + timeout, task_id, timeout)
+        self.metrics.task_started(wid, task_id, ready_since=ready_since)
+
         if args is None:
             args = []
         else:
             args = list(args)
         if kwargs is None:
             kwargs = {}
+        if target_attrs is None:
+            target_attrs = {}
 
+        target_ref = None
         if ismethod(target):
             target_obj = target.im_self
             target = target.__name__
+            target_ref = self.object_refs.get(id(target_obj))
+            if target_ref is not None:
+                # the worker already has a copy of this object
+                target_obj = None
         else:
             target_obj = None
 
@@ -200,7 +645,9 @@ class WorkerPool(object):
             'msg': 'RUN',
             'task_id': task_id,
             'target': target,
+            'target_attrs': target_attrs,
             'target_obj': target_obj,
+            'target_ref': target_ref,
             'args': args,
             'kwargs': kwargs,
         })
@@ -221,12 +668,15 @@ class WorkerPool(object):
         Shutdown a worker.
         """
         (process, pipe) = self.workers[wid]
+        deadline = time() + JOIN_TIMEOUT
         try:
             pipe.send({'msg': 'DIE'})
         except IOError:
             pass
+        else:
+            self._drain(pipe, deadline)
         pipe.close()
-        process.join(JOIN_TIMEOUT)
+        process.join(max(0, deadline - time()))
         if process.is_alive():
             LOG.warn(_(
                 "worker process with PID {pid} didn't join "
@@ -237,6 +687,7 @@ class WorkerPool(object):
             )
             process.terminate()
         self.workers_alive.remove(wid)
+        self.metrics.worker_quit(wid)
 
     def shutdown(self):
         """
@@ -244,6 +695,7 @@ class WorkerPool(object):
         """
         while self.workers_alive:
             self.quit(self.workers_alive[0])
+        self.metrics.pool_stopped()
 
     def activate_idle_workers(self):
         """
@@ -261,3 +713,154 @@ class WorkerPool(object):
         Returns True if this pool is not ready to die.
         """
         return self.jobs_open > 0 or self.workers_alive
+
+
+class ThreadPool(WorkerPool):
+    """
+    Like WorkerPool, but runs tasks in threads of this process.
+
+    This is meant for tasks that spend most of their time waiting for
+    remote commands: threads are cheap to start and share one
+    connection to each node. The objects and attributes given to
+    start_task() are shared with the threads instead of being copied.
+    CPU-bound tasks should use WorkerPool instead.
+    """
+    def __init__(self, workers=4, objects=(), metrics=None):
+        if workers < 1:
+            raise ValueError(_("at least one worker is required"))
+
+        self.metrics = PoolMetrics() if metrics is None else metrics
+        self.metrics.pool_started(workers)
+
+        # same as in WorkerPool, except that a worker is a tuple of a
+        # Thread object and the Queue it takes tasks from
+        self.workers = []
+        self.idle_workers = []
+        self.workers_alive = range(workers)
+        self.jobs_open = 0
+        self.deadlines = {}
+
+        # Threads append their messages to this deque and write a byte
+        # to a pipe we can block on. Unlike waiting on a Queue, reading
+        # from the pipe can be interrupted with Ctrl+C.
+        self.messages = deque()
+        self._wakeup_read, self._wakeup_write = os_pipe()
+        # held while expiring tasks and replacing workers, so a message
+        # sent by the old thread can't slip through
+        self._workers_lock = RLock()
+
+        for i in range(workers):
+            self.workers.append(None)
+            self._start_worker(i)
+
+    def _start_worker(self, wid):
+        tasks = Queue()
+        thread = Thread(target=_worker_thread, args=(wid, tasks, self._send))
+        # don't keep the process alive for a thread stuck in a task
+        thread.daemon = True
+        # _send() needs to find the thread before it sends anything
+        self.workers[wid] = (thread, tasks)
+        thread.start()
+
+    def _expire_tasks(self):
+        """
+        See WorkerPool._expire_tasks().
+        """
+        # A thread finishing its task between us looking for its
+        # FINISHED_WORK and replacing it would have that task finish
+        # twice. Keep threads from sending anything until we're done.
+        with self._workers_lock:
+            WorkerPool._expire_tasks(self)
+
+    def _replace_worker(self, wid):
+        """
+        Threads can't be killed. Leave the given one behind (it will
+        exit once its task is done, if ever) and start a new one in its
+        place.
+        """
+        with self._workers_lock:
+            self.workers[wid][1].put({'msg': 'DIE'})
+            self._start_worker(wid)
+
+    def _send(self, msg):
+        """
+        Called by worker threads to send a message to the pool.
+        """
+        with self._workers_lock:
+            if self.workers[msg['wid']][0] is not current_thread():
+                # this thread has been replaced, nobody is waiting for it
+                return
+            msg['received'] = time()
+            self.messages.append(msg)
+        write(self._wakeup_write, b"\0")
+
+    def _receive_messages(self, timeout=None):
+        """
+        Waits until at least one worker thread has sent a message (or
+        timeout seconds have passed).
+        """
+        readable, writable, exceptional = select([self._wakeup_read], [], [], timeout)
+        if readable:
+            read(self._wakeup_read, 4096)
+
+    def start_task(self, wid, target, task_id=None, args=None, kwargs=None,
+                   target_attrs=None, timeout=None, ready_since=None):
+        """
+        See WorkerPool.start_task().
+        """
+        if timeout is not None:
+            self.deadlines[wid] = (time() + timeout, task_id, timeout)
+        self.metrics.task_started(wid, task_id, ready_since=ready_since)
+
+        if target_attrs and ismethod(target):
+            for attr_name, attr_value in target_attrs.iteritems():
+                setattr(target.im_self, attr_name, attr_value)
+
+        self.workers[wid][1].put({
+            'msg': 'RUN',
+            'task_id': task_id,
+            'target': target,
+            'target_attrs': {},
+            'target_obj': None,
+            'target_ref': None,
+            'args': [] if args is None else list(args),
+            'kwargs': {} if kwargs is None else kwargs,
+        })
+
+        self.jobs_open += 1
+
+    def quit(self, wid):
+        """
+        Shutdown a worker.
+        """
+        (thread, tasks) = self.workers[wid]
+        tasks.put({'msg': 'DIE'})
+        thread.join(JOIN_TIMEOUT)
+        if thread.is_alive():
+            LOG.warn(_(
+                "worker thread {wid} didn't join within {time} seconds, "
+                "leaving it behind...").format(
+                    time=JOIN_TIMEOUT,
+                    wid=wid,
+                )
+            )
+        self.workers_alive.remove(wid)
+        self.metrics.worker_quit(wid)
+
+    def shutdown(self):
+        """
+        Shutdown all workers.
+        """
+        WorkerPool.shutdown(self)
+        if self._wakeup_read is not None:
+            close(self._wakeup_read)
+            close(self._wakeup_write)
+            self._wakeup_read = self._wakeup_write = None
+
+    def activate_idle_workers(self):
+        """
+        Tell all idle workers to ask for work again.
+        """
+        for wid in self.idle_workers:
+            self.workers[wid][1].put({'msg': 'NOOP'})
+        self.idle_workers = []
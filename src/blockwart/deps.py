@@ -1,15 +1,29 @@
-from .exceptions import BundleError
+from array import array
+from collections import defaultdict, deque, OrderedDict
+from heapq import heappop, heappush
+from itertools import count
+from time import time
+
+from .exceptions import BundleError, ItemDependencyError
 from .items import Item
 from .items.actions import Action
 from .utils import LOG
+from .utils.depgraph import DependencyGraph
+from .utils.paths import PathIndex
 from .utils.text import mark_for_translation as _
 
+GRAPH_TEMPLATE_CACHE_SIZE = 64
+
+_GRAPH_TEMPLATE_CACHE = OrderedDict()
+
 
 class BundleItem(object):
     """
     Represents a dependency on all items in a certain bundle.
     """
+    ESTIMATED_APPLY_DURATION = 0
     PARALLEL_APPLY = True
+    has_been_triggered = False
 
     def __init__(self, bundle):
         self.NEEDS_STATIC = []
@@ -38,7 +52,9 @@ class DummyItem(object):
     """
     Represents a dependency on all items of a certain type.
     """
+    ESTIMATED_APPLY_DURATION = 0
     bundle = None
+    has_been_triggered = False
 
     def __init__(self, item_type):
         self.NEEDS_STATIC = []
@@ -63,84 +79,343 @@ class DummyItem(object):
         pass
 
 
+class ItemQueue(object):
+    """
+    Keeps track of which items are ready to be applied.
+
+    For every item, we count the dependencies it is still waiting for.
+    The items depending on each item are looked up in a DependencyGraph,
+    so finishing an item only touches the items directly depending on
+    it. Instead of a list of items, you may also pass the
+    DependencyGraph returned by prepare_dependency_graph().
+
+    Items sharing a concurrency resource (see
+    _inject_concurrency_resources()) are never handed out at the same
+    time. Among the items that are ready, those starting the longest
+    chain of work (see _critical_path()) are handed out first.
+
+    item_durations is an optional dict mapping item IDs to the number of
+    seconds it took to apply them in the past. Items not in that dict
+    are assumed to take their ESTIMATED_APPLY_DURATION.
+    """
+    def __init__(self, items, item_durations=None):
+        if isinstance(items, DependencyGraph):
+            self.graph = items
+        else:
+            self.graph = DependencyGraph(items)
+        self.items = self.graph.items
+        self._blocked_entries = {}
+        self._busy_resources = set()
+        self._counter = count()
+        self._pending_deps = array('l', [
+            len(self.graph.deps(position)) for position in xrange(len(self.graph))
+        ])
+        self._ready_entries = []
+        # when each item became ready (0 if it hasn't yet)
+        self._ready_since = array('d', [0]) * len(self.graph)
+        self._skipped = bytearray(len(self.graph))
+
+        self._priority = self._critical_path(item_durations or {})
+
+        for position in xrange(len(self.graph)):
+            if not self._pending_deps[position]:
+                self._push(position)
+
+    def _critical_path(self, item_durations):
+        """
+        Returns an array holding the estimated number of seconds from
+        starting each item until the last item (recursively) depending
+        on it can be finished, assuming unlimited workers.
+
+        Items are visited in reverse topological order: an item is
+        handled once all items depending on it have been.
+        """
+        waiting_for = array('l', [
+            len(self.graph.dependents(position))
+            for position in xrange(len(self.graph))
+        ])
+        priority = array('d', [0]) * len(self.graph)
+        stack = [
+            position for position in xrange(len(self.graph))
+            if not waiting_for[position]
+        ]
+        while stack:
+            position = stack.pop()
+            downstream = 0
+            for dependent in self.graph.dependents(position):
+                downstream = max(downstream, priority[dependent])
+            item = self.items[position]
+            priority[position] = item_durations.get(
+                item.id,
+                item.ESTIMATED_APPLY_DURATION,
+            ) + downstream
+            for dep in self.graph.deps(position):
+                waiting_for[dep] -= 1
+                if not waiting_for[dep]:
+                    stack.append(dep)
+        return priority
+
+    @property
+    def items_with_deps(self):
+        """
+        Items that are still waiting for at least one dependency.
+        """
+        return [
+            item for position, item in enumerate(self.items)
+            if self._pending_deps[position] and not self._skipped[position]
+        ]
+
+    def _push(self, position):
+        self._ready_since[position] = time()
+        heappush(
+            self._ready_entries,
+            (-self._priority[position], next(self._counter), position),
+        )
+
+    def _release_resources(self, item):
+        for resource in item._concurrency_resources:
+            self._busy_resources.discard(resource)
+            for entry in self._blocked_entries.pop(resource, []):
+                heappush(self._ready_entries, entry)
+
+    def item_failed(self, item):
+        """
+        Removes all items (recursively) depending on the given item from
+        the queue. Returns a list of the removed items.
+        """
+        self._release_resources(item)
+        skipped_items = []
+        queue = deque([self.graph.index[item.id]])
+        while queue:
+            position = queue.popleft()
+            new_skipped_items = []
+            for dependent in self.graph.dependents(position):
+                if self._skipped[dependent]:
+                    continue
+                self._skipped[dependent] = 1
+                new_skipped_items.append(self.items[dependent])
+                queue.append(dependent)
+
+            if new_skipped_items:
+                LOG.debug(
+                    "skipped these items because they depend on {item}, which was "
+                    "skipped previously: {skipped}".format(
+                        item=self.items[position].id,
+                        skipped=", ".join([item.id for item in new_skipped_items]),
+                    )
+                )
+                skipped_items.extend(new_skipped_items)
+        return skipped_items
+
+    def item_ok(self, item):
+        """
+        Resolves all dependencies on the given item. Items left without
+        dependencies become ready to be applied.
+        """
+        self._release_resources(item)
+        for dependent in self.graph.dependents(self.graph.index[item.id]):
+            self._pending_deps[dependent] -= 1
+            if not self._pending_deps[dependent] and not self._skipped[dependent]:
+                self._push(dependent)
+
+    def ready_since(self, item):
+        """
+        Returns the timestamp at which the given item became ready to be
+        applied (even if it had to wait for a concurrency resource after
+        that) or None if it hasn't yet.
+        """
+        return self._ready_since[self.graph.index[item.id]] or None
+
+    def pop(self):
+        """
+        Removes and returns the next item to be applied. Returns None if
+        no item can be applied right now, either because all remaining
+        items are waiting for dependencies or because their concurrency
+        resources are held by items currently being applied.
+        """
+        while self._ready_entries:
+            entry = heappop(self._ready_entries)
+            item = self.items[entry[-1]]
+            busy_resources = item._concurrency_resources & self._busy_resources
+            if busy_resources:
+                # put the item aside until that resource is released
+                self._blocked_entries.setdefault(
+                    busy_resources.pop(),
+                    [],
+                ).append(entry)
+                continue
+            self._busy_resources.update(item._concurrency_resources)
+            return item
+        return None
+
+
 def find_item(item_id, items):
     """
     Returns the first item with the given ID within the given list of
-    items.
+    items. Instead of a list, you may also pass an item index as
+    returned by index_items() to avoid a linear scan.
     """
+    if not isinstance(items, dict):
+        items = index_items(items)
     try:
-        item = filter(lambda item: item.id == item_id, items)[0]
-    except IndexError:
+        return items[item_id]
+    except KeyError:
         raise ValueError(_("item not found: {}").format(item_id))
-    return item
 
 
-def _find_items_of_types(item_types, items, include_dummy=False):
+def index_items(items):
     """
-    Returns a subset of items with any of the given types.
+    Returns a dict mapping item IDs to the first item with that ID in
+    the given list of items.
     """
-    return filter(
-        lambda item:
-            item.id.split(":", 1)[0] in item_types and (
-                include_dummy or not item.id.endswith(":")
-            ),
-        items,
-    )
+    item_index = {}
+    for item in items:
+        item_index.setdefault(item.id, item)
+    return item_index
 
 
-def _flatten_dependencies(items):
+def _index_items_by_bundle(items, items_by_bundle=None):
     """
-    This will cause all dependencies - direct AND inherited - to be
-    listed in item._deps.
+    Returns a dict mapping bundle names to lists of the given items in
+    that bundle. Dummy items are left out. Instead of creating a new
+    dict, you may pass an existing one to add more items to.
     """
+    if items_by_bundle is None:
+        items_by_bundle = {}
     for item in items:
-        item._flattened_deps = list(set(
-            item._deps + _get_deps_for_item(item, items)
+        if item.bundle is None or item.id.endswith(":"):
+            continue
+        items_by_bundle.setdefault(item.bundle.name, []).append(item)
+    return items_by_bundle
+
+
+def _index_items_by_type(items, items_by_type=None):
+    """
+    Returns a dict mapping item types to lists of the given items of
+    that type. Dummy items are left out. Instead of creating a new dict,
+    you may pass an existing one to add more items to.
+    """
+    if items_by_type is None:
+        items_by_type = {}
+    for item in items:
+        if item.id.endswith(":"):
+            continue
+        items_by_type.setdefault(item.id.split(":", 1)[0], []).append(item)
+    return items_by_type
+
+
+def _check_bundle_collisions(items):
+    """
+    Raises BundleError if any item ID is defined more than once. All
+    duplicate definitions are reported at once.
+    """
+    item_index = {}
+    collisions = []
+    for item in items:
+        if item.id in item_index:
+            collisions.append(_(
+                "duplicate definition of {item} in bundles '{bundle1}' and '{bundle2}'"
+            ).format(
+                item=item.id,
+                bundle1=item_index[item.id].bundle.name,
+                bundle2=item.bundle.name,
+            ))
+        else:
+            item_index[item.id] = item
+    if collisions:
+        raise BundleError("\n".join(collisions))
+
+
+def _check_loops(graph):
+    """
+    Raises ItemDependencyError if the given DependencyGraph contains
+    any dependency loops. The error lists all items involved in each
+    loop and the dependencies forming one round through it.
+    """
+    loops = []
+    for component in graph.strongly_connected_components():
+        if len(component) == 1 and component[0] not in graph.deps(component[0]):
+            continue
+        loop = _find_loop(graph, component[-1], set(component))
+        loops.append(_(
+            "loop in dependencies between these items: {items}\n{loop}"
+        ).format(
+            items=", ".join(sorted([graph.items[position].id for position in component])),
+            loop="\n".join([
+                "  {} -> {} ({})".format(
+                    item.id,
+                    dep,
+                    _dependency_type(item, dep),
+                ) for item, dep in loop
+            ]),
         ))
-    return items
+    if loops:
+        raise ItemDependencyError("\n\n".join(loops))
 
 
-def _get_deps_for_item(item, items, deps_found=None):
+def _dependency_type(item, dep):
+    """
+    Returns a short description of how the given dependency of the
+    given item came to be.
     """
-    Recursively retrieves and returns a list of all inherited
-    dependencies of the given item.
+    if dep in item.NEEDS_STATIC:
+        return "static"
+    elif dep in item.needs:
+        return "regular"
+    elif dep in item._reverse_deps:
+        return "reverse"
+    elif dep in item._trigger_deps:
+        return "trigger"
+    else:
+        return "auto"
 
-    Note: This can handle loops, but won't detect them.
+
+def _find_loop(graph, start, component):
     """
-    if deps_found is None:
-        deps_found = []
-    deps = []
-    for dep in item._deps:
-        if dep not in deps_found:
-            deps.append(dep)
-            deps_found.append(dep)
-            deps += _get_deps_for_item(
-                find_item(dep, items),
-                items,
-                deps_found,
-            )
-    return deps
+    Returns the shortest way from the given item number back to itself
+    while staying within the given set of item numbers, as a list of
+    (item, dep) tuples.
+    """
+    previous = {}
+    queue = deque([start])
+    while queue:
+        position = queue.popleft()
+        for dep in graph.deps(position):
+            if dep not in component or dep in previous:
+                continue
+            previous[dep] = position
+            if dep == start:
+                loop = []
+                while True:
+                    loop.insert(0, (graph.items[previous[dep]], graph.items[dep].id))
+                    dep = previous[dep]
+                    if dep == start:
+                        return loop
+            queue.append(dep)
 
 
-def _inject_bundle_items(items):
+def _inject_bundle_items(items, items_by_bundle=None):
     """
     Adds virtual items that depend on every item in a bundle.
     """
-    bundle_items = {}
-    for item in items:
-        if item.bundle is None:
-            continue
-        if item.bundle.name not in bundle_items:
-            bundle_items[item.bundle.name] = BundleItem(item.bundle)
-        bundle_items[item.bundle.name]._deps.append(item.id)
-    return list(bundle_items.values()) + items
+    if items_by_bundle is None:
+        items_by_bundle = _index_items_by_bundle(items)
+    bundle_items = []
+    for bundle_items_list in items_by_bundle.values():
+        bundle_item = BundleItem(bundle_items_list[0].bundle)
+        bundle_item._deps = [item.id for item in bundle_items_list]
+        bundle_items.append(bundle_item)
+    return bundle_items + items
 
 
-def _inject_canned_actions(items):
+def _inject_canned_actions(items, item_index=None):
     """
     Looks for canned actions like "svc_upstart:mysql:reload" in item
-    triggers and adds them to the list of items.
+    triggers and adds them to the list of items. If an item index is
+    given, the new actions will be added to it as well.
     """
+    if item_index is None:
+        item_index = index_items(items)
     added_actions = {}
     for item in items:
         for triggered_item_id in item.triggers:
@@ -155,7 +430,7 @@ def _inject_canned_actions(items):
             target_item_id = "{}:{}".format(type_name, item_name)
 
             try:
-                target_item = find_item(target_item_id, items)
+                target_item = find_item(target_item_id, item_index)
             except ValueError:
                 raise BundleError(_(
                     "{item} in bundle '{bundle}' triggers unknown item '{target_item}'"
@@ -188,100 +463,81 @@ def _inject_canned_actions(items):
             action._prepare_deps(items)
             added_actions[triggered_item_id] = action
 
+    for action in added_actions.values():
+        item_index.setdefault(action.id, action)
+
     return items + list(added_actions.values())
 
 
-def _inject_concurrency_blockers(items):
+def _inject_concurrency_resources(items):
     """
-    Looks for items with PARALLEL_APPLY set to False and inserts
-    dependencies to force a sequential apply.
+    Looks for item types with BLOCK_CONCURRENT set and assigns a
+    resource named after that type to all items of the blocking type
+    and the blocked types. ItemQueue won't hand out two items sharing a
+    resource at the same time.
     """
     # find every item type that cannot be applied in parallel
-    item_types = []
+    resources_by_type = defaultdict(set)
     for item in items:
-        item._concurrency_deps = []
+        item._concurrency_resources = set()
         if (
             item.ITEM_TYPE_NAME == 'dummy' or
-            item.__class__ in item_types or
             not item.BLOCK_CONCURRENT
         ):
             continue
-        else:
-            item_types.append(item.__class__)
-
-    # daisy-chain all items of the blocking type and all items of the
-    # blocked types while respecting existing dependencies between them
-    for item_type in item_types:
-        blocked_types = item_type.BLOCK_CONCURRENT + [item_type.ITEM_TYPE_NAME]
-        type_items = _find_items_of_types(
-            blocked_types,
-            items,
-        )
-        processed_items = []
-        for item in type_items:
-            # disregard deps to items of other types
-            item.__deps = filter(
-                lambda dep: dep.split(":", 1)[0] in blocked_types,
-                item._flattened_deps,
+        for blocked_type in item.BLOCK_CONCURRENT + [item.ITEM_TYPE_NAME]:
+            resources_by_type[blocked_type].add(item.ITEM_TYPE_NAME)
+
+    if resources_by_type:
+        for item in items:
+            if item.ITEM_TYPE_NAME == 'dummy':
+                continue
+            item._concurrency_resources.update(
+                resources_by_type.get(item.ITEM_TYPE_NAME, ()),
             )
-        previous_item = None
-        while len(processed_items) < len(type_items):
-            # find the first item without same-type deps we haven't
-            # processed yet
-            try:
-                item = filter(
-                    lambda item: not item.__deps and item not in processed_items,
-                    type_items,
-                )[0]
-            except IndexError:
-                # this can happen if the flattened deps of all items of
-                # this type already contain a dependency on another
-                # item of this type
-                break
-            if previous_item is not None:  # unless we're at the first item
-                # add dep to previous item -- unless it's already in there
-                if not previous_item.id in item._deps:
-                    item._deps.append(previous_item.id)
-                    item._concurrency_deps.append(previous_item.id)
-                    item._flattened_deps.append(previous_item.id)
-            previous_item = item
-            processed_items.append(item)
-            for other_item in type_items:
-                try:
-                    other_item.__deps.remove(item.id)
-                except ValueError:
-                    pass
     return items
 
 
-def _inject_dummy_items(items):
+def _inject_dummy_items(items, items_by_type=None):
     """
     Takes a list of items and adds dummy items depending on each type of
     item in the list. Returns the appended list.
     """
-    # first, find all types of items and add dummy deps
+    if items_by_type is None:
+        items_by_type = _index_items_by_type(items)
+
+    # create dummy items that depend on each item of their type
     dummy_items = {}
-    items = list(items)
-    for item in items:
-        # create dummy items that depend on each item of their type
-        item_type = item.id.split(":")[0]
-        if item_type not in dummy_items:
-            dummy_items[item_type] = DummyItem(item_type)
-        dummy_items[item_type]._deps.append(item.id)
+    for item_type, type_items in items_by_type.iteritems():
+        dummy_items[item_type] = DummyItem(item_type)
+        dummy_items[item_type]._deps = [item.id for item in type_items]
 
-        # create DummyItem for every type
+    # create DummyItem for every type
+    for item in items:
         for dep in item._deps:
-            item_type = dep.split(":")[0]
+            item_type = dep.split(":", 1)[0]
             if item_type not in dummy_items:
                 dummy_items[item_type] = DummyItem(item_type)
-    return list(dummy_items.values()) + items
+    return list(dummy_items.values()) + list(items)
 
 
-def _inject_reverse_dependencies(items):
+def _inject_reverse_dependencies(
+    items,
+    item_index=None,
+    items_by_bundle=None,
+    items_by_type=None,
+):
     """
     Looks for 'needed_by' deps and creates standard dependencies
     accordingly.
     """
+    if item_index is None:
+        item_index = index_items(items)
+    if items_by_bundle is None:
+        items_by_bundle = _index_items_by_bundle(items)
+    if items_by_type is None:
+        items_by_type = _index_items_by_type(items)
+
     def add_dep(item, dep):
         if dep not in item._deps:
             item._deps.append(dep)
@@ -295,32 +551,37 @@ def _inject_reverse_dependencies(items):
             # bundle items
             if depending_item_id.startswith("bundle:"):
                 depending_bundle_name = depending_item_id.split(":")[1]
-                for depending_item in items:
-                    if depending_item.bundle.name == depending_bundle_name:
-                        add_dep(depending_item, item.id)
+                for depending_item in items_by_bundle.get(depending_bundle_name, []):
+                    add_dep(depending_item, item.id)
 
             # dummy items
             if depending_item_id.endswith(":"):
                 target_type = depending_item_id[:-1]
-                for depending_item in _find_items_of_types([target_type], items):
+                for depending_item in items_by_type.get(target_type, []):
                     add_dep(depending_item, item.id)
 
             # single items
             else:
-                depending_item = find_item(depending_item_id, items)
+                depending_item = find_item(depending_item_id, item_index)
                 add_dep(depending_item, item.id)
     return items
 
 
-def _inject_trigger_dependencies(items):
+def _inject_trigger_dependencies(items, item_index=None):
     """
     Injects dependencies from all triggered items to their triggering
     items.
     """
+    if item_index is None:
+        item_index = index_items(items)
+
+    for item in items:
+        item._trigger_deps = []
+
     for item in items:
         for triggered_item_id in item.triggers:
             try:
-                triggered_item = find_item(triggered_item_id, items)
+                triggered_item = find_item(triggered_item_id, item_index)
             except ValueError:
                 raise BundleError(_(
                     "unable to find definition of '{item1}' triggered "
@@ -342,82 +603,189 @@ def _inject_trigger_dependencies(items):
                     bundle2=item.bundle.name,
                 ))
             triggered_item._deps.append(item.id)
+            triggered_item._trigger_deps.append(item.id)
     return items
 
 
-def prepare_dependencies(items):
-    """
-    Performs all dependency preprocessing on a list of items.
-    """
-    items = list(items)
-
-    for item in items:
-        item._check_bundle_collisions(items)
-        item._prepare_deps(items)
-
-    items = _inject_dummy_items(items)
-    items = _inject_bundle_items(items)
-    items = _inject_canned_actions(items)
-    items = _inject_reverse_dependencies(items)
-    items = _inject_trigger_dependencies(items)
-    items = _flatten_dependencies(items)
-    items = _inject_concurrency_blockers(items)
-    return items
+class _GraphTemplate(object):
+    """
+    Remembers the outcome of prepare_dependency_graph() for a list of
+    items, so it can be reproduced for another list of items with the
+    same _graph_signature() without repeating the work.
+
+    The result is a list of virtual items (bundle and dummy items),
+    followed by the original items and finally the canned actions. For
+    each of them, we keep the injected dependencies and concurrency
+    resources along with the DependencyGraph.
+    """
+    def __init__(self, graph, first_item, item_count):
+        self.graph = graph
+        self.first_item = first_item
+        self.item_count = item_count
+
+        first_positions = {}
+        for position in xrange(self.first_item, self.first_item + item_count):
+            item = graph.items[position]
+            first_positions.setdefault(("bundle", item.bundle.name), position)
+            for triggered_item_id in item.triggers:
+                first_positions.setdefault(("trigger", triggered_item_id), position)
+
+        self.attributes = []
+        self.virtual_items = {}
+        for position, item in enumerate(graph.items):
+            self.attributes.append((
+                list(item._deps),
+                list(item._reverse_deps),
+                list(item._trigger_deps),
+                set(item._concurrency_resources),
+            ))
+            if self.first_item <= position < self.first_item + item_count:
+                continue
+            if isinstance(item, BundleItem):
+                self.virtual_items[position] = (
+                    "bundle",
+                    first_positions[("bundle", item.bundle.name)],
+                )
+            elif isinstance(item, DummyItem):
+                self.virtual_items[position] = ("dummy", item.item_type)
+            else:
+                type_name, item_name, action_name = item.id.split(":")
+                self.virtual_items[position] = (
+                    "action",
+                    first_positions[("trigger", item.id)],
+                    graph.index["{}:{}".format(type_name, item_name)],
+                    action_name,
+                    (item.needs, item.needed_by, item.triggers),
+                )
+
+    def bind(self, items):
+        """
+        Returns a DependencyGraph for the given items (with
+        _prepare_deps() already called) as if they had gone through
+        prepare_dependency_graph(). Returns None if canned actions turn
+        out to be defined differently for these items.
+        """
+        all_items = []
+        for position in xrange(len(self.graph)):
+            if self.first_item <= position < self.first_item + self.item_count:
+                all_items.append(items[position - self.first_item])
+                continue
+            kind = self.virtual_items[position]
+            if kind[0] == "bundle":
+                all_items.append(BundleItem(items[kind[1] - self.first_item].bundle))
+            elif kind[0] == "dummy":
+                all_items.append(DummyItem(kind[1]))
+            else:
+                triggering_item = items[kind[1] - self.first_item]
+                target_item = all_items[kind[2]]
+                try:
+                    action_attrs = target_item.get_canned_actions()[kind[3]]
+                except KeyError:
+                    return None
+                action_attrs.update({'triggered': True})
+                action = Action(
+                    triggering_item.bundle,
+                    self.graph.items[position].id,
+                    action_attrs,
+                    skip_name_validation=True,
+                )
+                if (action.needs, action.needed_by, action.triggers) != kind[4]:
+                    return None
+                all_items.append(action)
+
+        for item, attributes in zip(all_items, self.attributes):
+            deps, reverse_deps, trigger_deps, concurrency_resources = attributes
+            item._deps = list(deps)
+            item._reverse_deps = list(reverse_deps)
+            item._trigger_deps = list(trigger_deps)
+            item._concurrency_resources = set(concurrency_resources)
+
+        return self.graph.bind(all_items)
+
+
+def _graph_signature(items):
+    """
+    Returns a hashable summary of everything about the given items
+    (with _prepare_deps() already called) that prepare_dependency_graph()
+    looks at. Lists of items with the same signature (e.g. on nodes
+    with the same bundles) end up with the same dependency graph.
+    """
+    return tuple([
+        (
+            item.__class__,
+            item.id,
+            item.bundle.name,
+            tuple(item._deps),
+            tuple(item.needed_by),
+            tuple(item.triggers),
+            item.triggered,
+            tuple(item.BLOCK_CONCURRENT),
+        ) for item in items
+    ])
 
 
-def remove_dep_from_items(items, dep):
+def prepare_dependencies(items):
     """
-    Removes the given item id (dep) from the temporary list of
-    dependencies of all items in the given list.
+    Performs all dependency preprocessing on a list of items. Returns
+    the list of items, including the virtual items added along the way.
     """
-    for item in items:
-        try:
-            item._deps.remove(dep)
-        except ValueError:
-            pass
-    return items
+    return prepare_dependency_graph(items).items
 
 
-def remove_item_dependents(items, dep):
+def prepare_dependency_graph(items):
     """
-    Removes the items depending on the given id from the list of items.
+    Performs all dependency preprocessing on a list of items. Returns a
+    DependencyGraph of the resulting items.
     """
-    removed_items = []
-    for item in items:
-        if dep in item._deps:
-            removed_items.append(item)
-
-    for item in removed_items:
-        items.remove(item)
-
-    if removed_items:
-        LOG.debug(
-            "skipped these items because they depend on {item}, which was "
-            "skipped previously: {skipped}".format(
-                item=dep,
-                skipped=", ".join([item.id for item in removed_items]),
-            )
-        )
-
-    all_recursively_removed_items = []
-    for removed_item in removed_items:
-        items, recursively_removed_items = \
-            remove_item_dependents(items, removed_item.id)
-        all_recursively_removed_items += recursively_removed_items
-
-    return (items, removed_items + all_recursively_removed_items)
-
+    items = list(items)
+    _check_bundle_collisions(items)
 
-def split_items_without_deps(items):
-    """
-    Takes a list of items and extracts the ones that don't have any
-    dependencies. The extracted deps are returned as a list.
-    """
-    items = list(items)  # make sure we're not returning a generator
-    removed_items = []
+    path_index = PathIndex(items)
     for item in items:
-        if not item._deps:
-            removed_items.append(item)
-    for item in removed_items:
-        items.remove(item)
-    return (items, removed_items)
+        item._prepare_deps(items, path_index=path_index)
+
+    # nodes with the same bundles usually end up with the same graph
+    signature = _graph_signature(items)
+    template = _GRAPH_TEMPLATE_CACHE.get(signature)
+    if template is not None:
+        graph = template.bind(items)
+        if graph is not None:
+            return graph
+    item_count = len(items)
+
+    items_by_bundle = _index_items_by_bundle(items)
+    items_by_type = _index_items_by_type(items)
+    items = _inject_dummy_items(items, items_by_type)
+    items = _inject_bundle_items(items, items_by_bundle)
+
+    # from here on, all lookups by item ID go through this index
+    item_index = index_items(items)
+
+    # the original items are now preceded by bundle and dummy items
+    first_item = len(items) - item_count
+
+    items = _inject_canned_actions(items, item_index)
+    # add the new actions to the other indexes as well
+    _index_items_by_bundle(items[first_item + item_count:], items_by_bundle)
+    _index_items_by_type(items[first_item + item_count:], items_by_type)
+    items = _inject_reverse_dependencies(
+        items,
+        item_index,
+        items_by_bundle=items_by_bundle,
+        items_by_type=items_by_type,
+    )
+    items = _inject_trigger_dependencies(items, item_index)
+    items = _inject_concurrency_resources(items)
+
+    graph = DependencyGraph(items)
+    _check_loops(graph)
+
+    if signature not in _GRAPH_TEMPLATE_CACHE:
+        if len(_GRAPH_TEMPLATE_CACHE) >= GRAPH_TEMPLATE_CACHE_SIZE:
+            _GRAPH_TEMPLATE_CACHE.popitem(last=False)
+        _GRAPH_TEMPLATE_CACHE[signature] = _GraphTemplate(
+            graph,
+            first_item,
+            item_count,
+        )
+    return graph
@@ -0,0 +1,362 @@
+from datetime import datetime
+from threading import Event
+from time import time
+
+from . import operations
+from .deps import index_items, ItemQueue, prepare_dependency_graph
+from .exceptions import NodeAlreadyLockedException, RemoteException
+from .node import ApplyResult, check_for_unapplied_items, handle_item_result, NodeLock
+from .operations import RunResult
+from .utils import LOG
+from .utils.eventloop import CompletionQueue, Future, Return
+from .utils.text import mark_for_translation as _
+
+# An alternative to Node.apply() that applies any number of nodes from a
+# single event loop (see blockwart.utils.eventloop) instead of using one
+# process per node and another one per item.
+#
+# Nodes and items are coroutines: generators yielding futures.
+# Transports make remote commands awaitable (run_async()), while
+# offering the same synchronous interface as blockwart.operations to
+# item code (Node.run() and friends use the node's transport).
+#
+# Item code itself is still synchronous: every item being applied
+# occupies one of the loop's executor threads until it is done. The
+# number of items being applied across all nodes at the same time is
+# therefore capped by the number of executor threads, no matter how
+# many nodes there are.
+
+
+class SSHTransport(object):
+    """
+    Runs commands on actual nodes through blockwart.operations. Since
+    those block until the command has finished, awaitable commands are
+    run in one of the loop's executor threads.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def download(self, hostname, remote_path, local_path, **kwargs):
+        return operations.download(hostname, remote_path, local_path, **kwargs)
+
+    def run(self, hostname, command, **kwargs):
+        return operations.run(hostname, command, **kwargs)
+
+    def run_async(self, hostname, command, **kwargs):
+        """
+        Returns a future for the RunResult of the given command.
+        """
+        return self.loop.run_in_executor(operations.run, hostname, command, **kwargs)
+
+    def run_batch(self, hostname, commands, **kwargs):
+        return operations.run_batch(hostname, commands, **kwargs)
+
+    def upload(self, hostname, local_path, remote_path, **kwargs):
+        return operations.upload(hostname, local_path, remote_path, **kwargs)
+
+
+class FakeTransport(object):
+    """
+    Pretends to run commands on nodes without connecting to anything,
+    so the engine can be tested and benchmarked without real hosts.
+
+    Every command takes latency seconds (without blocking the loop).
+    Its result is provided by handler(hostname, command), which returns
+    a RunResult or None (meaning success without any output). Commands
+    are recorded in self.commands. Uploaded files are kept in
+    self.files and can be downloaded again.
+    """
+    def __init__(self, loop, handler=None, latency=0.0):
+        self.commands = []
+        self.files = {}
+        self.handler = handler
+        self.latency = latency
+        self.loop = loop
+        self.max_in_flight = 0
+        self._in_flight = 0
+
+    def download(self, hostname, remote_path, local_path, ignore_failure=False,
+                 **kwargs):
+        try:
+            content = self.files[(hostname, remote_path)]
+        except KeyError:
+            if ignore_failure:
+                return
+            raise RemoteException(_(
+                "reading file '{path}' on {host} failed: {error}").format(
+                    error=_("no such file"),
+                    host=hostname,
+                    path=remote_path,
+                )
+            )
+        with open(local_path, 'w') as f:
+            f.write(content)
+
+    def run(self, hostname, command, ignore_failure=False, **kwargs):
+        """
+        Blocks until the command has finished. Must not be called from
+        the loop's own thread.
+        """
+        finished = Event()
+        futures = []
+
+        def start():
+            future = self.run_async(hostname, command, ignore_failure=ignore_failure)
+            future.add_done_callback(lambda future: finished.set())
+            futures.append(future)
+
+        self.loop.call_soon_threadsafe(start)
+        finished.wait()
+        return futures[0].result()
+
+    def run_batch(self, hostname, commands, ignore_failure=False, **kwargs):
+        """
+        Like run(), but all commands are started at once, so together
+        they only take latency seconds.
+        """
+        finished = Event()
+        futures = []
+
+        def done(future):
+            if all(future.done() for future in futures):
+                finished.set()
+
+        def start():
+            for command in commands:
+                futures.append(self.run_async(hostname, command, ignore_failure=True))
+            for future in futures:
+                future.add_done_callback(done)
+
+        if not commands:
+            return []
+        self.loop.call_soon_threadsafe(start)
+        finished.wait()
+        results = [future.result() for future in futures]
+        if not ignore_failure:
+            for command, result in zip(commands, results):
+                if result.return_code != 0:
+                    raise RemoteException(_(
+                        "Non-zero return code ({rcode}) running '{command}' on '{host}'"
+                    ).format(
+                        command=command,
+                        host=hostname,
+                        rcode=result.return_code,
+                    ))
+        return results
+
+    def run_async(self, hostname, command, ignore_failure=False, **kwargs):
+        """
+        Returns a future for the RunResult of the given command.
+        """
+        self.commands.append((hostname, command))
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        future = Future(self.loop)
+        self.loop.call_later(
+            self.latency,
+            self._finish,
+            future,
+            hostname,
+            command,
+            ignore_failure,
+        )
+        return future
+
+    def upload(self, hostname, local_path, remote_path, **kwargs):
+        with open(local_path) as f:
+            self.files[(hostname, remote_path)] = f.read()
+
+    def _finish(self, future, hostname, command, ignore_failure):
+        self._in_flight -= 1
+        result = None
+        if self.handler is not None:
+            result = self.handler(hostname, command)
+        if result is None:
+            result = RunResult()
+            result.return_code = 0
+            result.stderr = ""
+            result.stdout = ""
+        if result.return_code != 0 and not ignore_failure:
+            future.set_exception(RemoteException(_(
+                "Non-zero return code ({rcode}) running '{command}' on '{host}':\n\n{result}"
+            ).format(
+                command=command,
+                host=hostname,
+                rcode=result.return_code,
+                result=result.stdout + result.stderr,
+            )))
+        else:
+            future.set_result(result)
+
+
+def apply_item(loop, item):
+    """
+    Coroutine applying a single item.
+
+    Items implement the synchronous get_status()/fix() contract, so
+    Item.apply() runs in one of the loop's executor threads. Dummy items
+    don't do anything and are handled right away.
+    """
+    if item.ITEM_TYPE_NAME == 'dummy':
+        raise Return(item.apply())
+    elif item.ITEM_TYPE_NAME == 'action':
+        target = item.get_result
+    else:
+        target = item.apply
+    status_code = yield loop.run_in_executor(target, interactive=False)
+    raise Return(status_code)
+
+
+def apply_items(loop, node, workers=4, item_durations=None):
+    """
+    Coroutine applying all items of the given node, at most workers
+    items at a time. Returns a list of (item_id, status_code) tuples.
+
+    See blockwart.node.apply_items() for item_durations.
+    """
+    # Done on the loop's thread, so graphs of different nodes are never
+    # prepared at the same time (the graph template cache in
+    # blockwart.deps is not thread-safe).
+    graph = prepare_dependency_graph(node.items)
+    item_index = index_items(graph.items)
+    item_queue = ItemQueue(graph, item_durations=item_durations)
+    in_flight = CompletionQueue(loop)
+    results = []
+
+    while True:
+        while len(in_flight) < workers:
+            item = item_queue.pop()
+            if item is None:
+                break
+            task = loop.create_task(apply_item(loop, item))
+            task.item = item
+            task.start_time = time()
+            in_flight.add(task)
+
+        if not len(in_flight):
+            break
+
+        finished_tasks = yield in_flight.get()
+        for task in finished_tasks:
+            try:
+                status_code = task.result()
+            except Exception as e:
+                # Don't start any more items, but wait for those still
+                # being applied: apply_node() unlocks the node as soon
+                # as we are done.
+                while len(in_flight):
+                    yield in_flight.get()
+                raise e
+            if (
+                item_durations is not None and
+                task.item.ITEM_TYPE_NAME != 'dummy'
+            ):
+                item_durations[task.item.id] = time() - task.start_time
+            results.extend(handle_item_result(
+                task.item,
+                status_code,
+                item_queue,
+                item_index,
+            ))
+
+    check_for_unapplied_items(node, item_queue)
+    raise Return(results)
+
+
+def apply_node(loop, node, workers=4, force=False):
+    """
+    Coroutine doing what Node.apply() does (except for interactive
+    mode). Returns an ApplyResult.
+    """
+    yield loop.run_in_executor(
+        node.repo.hooks.node_apply_start,
+        node.repo,
+        node,
+        interactive=False,
+    )
+
+    start = datetime.now()
+    item_durations = node.repo.get_item_durations(node.name)
+    lock = NodeLock(node, False, ignore=force)
+    item_results = []
+    try:
+        yield loop.run_in_executor(lock.__enter__)
+    except NodeAlreadyLockedException as e:
+        LOG.error(_("Node '{node}' already locked: {info}").format(
+            node=node.name,
+            info=e.args,
+        ))
+    else:
+        try:
+            item_results = yield loop.create_task(apply_items(
+                loop,
+                node,
+                workers=workers,
+                item_durations=item_durations,
+            ))
+            node.repo.set_item_durations(node.name, item_durations)
+        finally:
+            yield loop.run_in_executor(lock.__exit__, None, None, None)
+
+    result = ApplyResult(node, item_results)
+    result.start = start
+    result.end = datetime.now()
+
+    yield loop.run_in_executor(
+        node.repo.hooks.node_apply_end,
+        node.repo,
+        node,
+        duration=result.duration,
+        interactive=False,
+        result=result,
+    )
+
+    raise Return(result)
+
+
+def apply_nodes(loop, nodes, transport=None, workers=4, force=False):
+    """
+    Coroutine applying all given nodes at once, at most workers items at
+    a time on each node. Returns a dict mapping node names to
+    ApplyResults (or None if applying the node failed).
+
+    The total number of items being applied at the same time (across
+    all nodes) is limited by the number of executor threads of the loop,
+    since each of them runs in one of those threads.
+
+    transport defaults to an SSHTransport.
+    """
+    if transport is None:
+        transport = SSHTransport(loop)
+
+    node_tasks = CompletionQueue(loop)
+    previous_transports = {}
+    for node in nodes:
+        previous_transports[node.name] = node.__dict__.get('transport')
+        node.transport = transport
+        task = loop.create_task(apply_node(loop, node, workers=workers, force=force))
+        task.node = node
+        node_tasks.add(task)
+
+    results = {}
+    try:
+        while len(node_tasks):
+            finished_tasks = yield node_tasks.get()
+            for task in finished_tasks:
+                try:
+                    results[task.node.name] = task.result()
+                except Exception as e:
+                    LOG.error(_("applying {node} failed: {error}").format(
+                        error=e,
+                        node=task.node.name,
+                    ))
+                    LOG.debug(task.traceback)
+                    results[task.node.name] = None
+    finally:
+        for node in nodes:
+            if previous_transports[node.name] is None:
+                del node.transport
+            else:
+                node.transport = previous_transports[node.name]
+
+    raise Return(results)
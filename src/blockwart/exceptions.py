@@ -92,3 +92,11 @@ class NodeAlreadyLockedException(Exception):
     Raised when a node is already locked during an 'apply' run.
     """
     pass
+
+
+class TaskTimeoutException(WorkerException):
+    """
+    Raised when a task hasn't finished in time. The worker that was
+    running it has been replaced by a new one.
+    """
+    pass
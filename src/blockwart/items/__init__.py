@@ -10,6 +10,7 @@ from os.path import join
 
 from blockwart.exceptions import BundleError
 from blockwart.utils import LOG
+from blockwart.utils.paths import PATH_ITEM_TYPES
 from blockwart.utils.text import mark_for_translation as _
 from blockwart.utils.text import bold, wrap_question
 from blockwart.utils.ui import ask_interactively
@@ -67,6 +68,7 @@ class Item(object):
     """
     BLOCK_CONCURRENT = []
     BUNDLE_ATTRIBUTE_NAME = None
+    ESTIMATED_APPLY_DURATION = 1  # seconds, used until measured
     ITEM_ATTRIBUTES = {}
     ITEM_TYPE_NAME = None
     REQUIRED_ATTRIBUTES = []
@@ -135,24 +137,15 @@ class Item(object):
     def __repr__(self):
         return "<Item {}>".format(self.id)
 
-    def _check_bundle_collisions(self, items):
-        for item in items:
-            if item == self:
-                continue
-            if item.id == self.id:
-                raise BundleError(_(
-                    "duplicate definition of {item} in bundles '{bundle1}' and '{bundle2}'"
-                ).format(
-                    item=item.id,
-                    bundle1=item.bundle.name,
-                    bundle2=self.bundle.name,
-                ))
-
-    def _prepare_deps(self, items):
+    def _prepare_deps(self, items, path_index=None):
         # merge static and user-defined deps
         self._deps = list(self.NEEDS_STATIC)
         self._deps += self.needs
-        self._deps += list(self.get_auto_deps(items))
+        if path_index is not None and self.ITEM_TYPE_NAME in PATH_ITEM_TYPES:
+            # built-in path items can reuse the index of the whole list
+            self._deps += list(self.get_auto_deps(items, path_index=path_index))
+        else:
+            self._deps += list(self.get_auto_deps(items))
 
     @classmethod
     def _validate_attribute_names(cls, bundle, item_id, attributes):
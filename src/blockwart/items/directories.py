@@ -7,9 +7,10 @@ from pipes import quote
 from blockwart.exceptions import BundleError
 from blockwart.items import Item, ItemStatus
 from blockwart.utils import LOG
+from blockwart.utils.paths import PathIndex
 from blockwart.utils.remote import PathInfo
 from blockwart.utils.text import mark_for_translation as _
-from blockwart.utils.text import bold, is_subdirectory
+from blockwart.utils.text import bold
 
 
 def validator_mode(item_id, value):
@@ -136,35 +137,28 @@ class Directory(Item):
         self._fix_mode(status)
         self._fix_owner(status)
 
-    def get_auto_deps(self, items):
-        deps = []
-        for item in items:
-            if item == self:
-                continue
-            if (
-                (
-                    item.ITEM_TYPE_NAME == "file" and
-                    is_subdirectory(item.name, self.name)
-                )
-                or
-                (
-                    item.ITEM_TYPE_NAME in ("file", "symlink") and
-                    item.name == self.name
-                )
-            ):
-                raise BundleError(_(
-                    "{item1} (from bundle '{bundle1}') blocking path to "
-                    "{item2} (from bundle '{bundle2}')"
-                ).format(
-                    item1=item.id,
-                    bundle1=item.bundle.name,
-                    item2=self.id,
-                    bundle2=self.bundle.name,
-                ))
-            elif item.ITEM_TYPE_NAME in ("directory", "symlink"):
-                if is_subdirectory(item.name, self.name):
-                    deps.append(item.id)
-        return deps
+    def get_auto_deps(self, items, path_index=None):
+        if path_index is None:
+            path_index = PathIndex(items)
+        blocking_items = path_index.items_on_path(
+            self.name,
+            ("file",),
+            path_types=("file", "symlink"),
+        )
+        if blocking_items:
+            raise BundleError(_(
+                "{item1} (from bundle '{bundle1}') blocking path to "
+                "{item2} (from bundle '{bundle2}')"
+            ).format(
+                item1=blocking_items[0].id,
+                bundle1=blocking_items[0].bundle.name,
+                item2=self.id,
+                bundle2=self.bundle.name,
+            ))
+        return [
+            item.id for item in
+            path_index.items_on_path(self.name, ("directory", "symlink"))
+        ]
 
     def get_status(self):
         correct = True
@@ -4,7 +4,7 @@ from collections import defaultdict
 from copy import copy
 from datetime import datetime
 from difflib import unified_diff
-from os import remove
+from os import close, remove
 from os.path import dirname, exists, join, normpath
 from pipes import quote
 from sys import exc_info
@@ -15,9 +15,10 @@ from blockwart.exceptions import BundleError, TemplateError
 from blockwart.items import BUILTIN_ITEM_ATTRIBUTES, Item, ItemStatus
 from blockwart.items.directories import validator_mode
 from blockwart.utils import cached_property, LOG, sha1
+from blockwart.utils.paths import PathIndex
 from blockwart.utils.remote import PathInfo
 from blockwart.utils.text import mark_for_translation as _
-from blockwart.utils.text import bold, green, is_subdirectory, red
+from blockwart.utils.text import bold, green, red
 
 
 DIFF_MAX_FILE_SIZE = 1024 * 1024 * 5  # bytes
@@ -131,6 +132,7 @@ def get_remote_file_contents(node, path):
     Returns the contents of the given path as a string.
     """
     handle, tmp_file = mkstemp()
+    close(handle)
     node.download(path, tmp_file)
     with open(tmp_file) as f:
         content = f.read()
@@ -358,27 +360,35 @@ class File(Item):
             self.node.run("mkdir -p -- {}".format(quote(dirname(self.name))))
             self._fix_content(status)
 
-    def get_auto_deps(self, items):
-        deps = []
-        for item in items:
-            if item.ITEM_TYPE_NAME == "file" and is_subdirectory(item.name, self.name):
-                raise BundleError(_(
-                    "{item1} (from bundle '{bundle1}') blocking path to "
-                    "{item2} (from bundle '{bundle2}')"
-                ).format(
-                    item1=item.id,
-                    bundle1=item.bundle.name,
-                    item2=self.id,
-                    bundle2=self.bundle.name,
-                ))
-            elif item.ITEM_TYPE_NAME in ("directory", "symlink"):
-                if is_subdirectory(item.name, self.name):
-                    deps.append(item.id)
-        return deps
+    def get_auto_deps(self, items, path_index=None):
+        if path_index is None:
+            path_index = PathIndex(items)
+        blocking_items = path_index.items_on_path(self.name, ("file",))
+        if blocking_items:
+            raise BundleError(_(
+                "{item1} (from bundle '{bundle1}') blocking path to "
+                "{item2} (from bundle '{bundle2}')"
+            ).format(
+                item1=blocking_items[0].id,
+                bundle1=blocking_items[0].bundle.name,
+                item2=self.id,
+                bundle2=self.bundle.name,
+            ))
+        return [
+            item.id for item in
+            path_index.items_on_path(self.name, ("directory", "symlink"))
+        ]
 
     def get_status(self):
         correct = True
-        path_info = PathInfo(self.node, self.name)
+        path_info = PathInfo(
+            self.node,
+            self.name,
+            sha1=(
+                not self.attributes['delete'] and
+                self.attributes['content_type'] != 'any'
+            ),
+        )
         status_info = {'needs_fixing': [], 'path_info': path_info}
 
         if not path_info.is_file:
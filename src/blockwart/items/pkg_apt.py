@@ -37,6 +37,7 @@ class AptPkg(Item):
     """
     BLOCK_CONCURRENT = ["pkg_apt"]
     BUNDLE_ATTRIBUTE_NAME = "pkg_apt"
+    ESTIMATED_APPLY_DURATION = 20
     ITEM_ATTRIBUTES = {
         'installed': True,
     }
@@ -43,6 +43,7 @@ class PacmanPkg(Item):
     """
     BLOCK_CONCURRENT = ["pkg_pacman"]
     BUNDLE_ATTRIBUTE_NAME = "pkg_pacman"
+    ESTIMATED_APPLY_DURATION = 20
     ITEM_ATTRIBUTES = {
         'installed': True,
         'tarball': None,
@@ -33,6 +33,7 @@ class SvcSystemd(Item):
     A service managed by systemd.
     """
     BUNDLE_ATTRIBUTE_NAME = "svc_systemd"
+    ESTIMATED_APPLY_DURATION = 5
     ITEM_ATTRIBUTES = {
         'running': True,
     }
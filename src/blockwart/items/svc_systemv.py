@@ -33,6 +33,7 @@ class SvcSystemV(Item):
     A service managed by traditional System V init scripts.
     """
     BUNDLE_ATTRIBUTE_NAME = "svc_systemv"
+    ESTIMATED_APPLY_DURATION = 5
     ITEM_ATTRIBUTES = {
         'running': True,
     }
@@ -30,6 +30,7 @@ class SvcUpstart(Item):
     A service managed by Upstart.
     """
     BUNDLE_ATTRIBUTE_NAME = "svc_upstart"
+    ESTIMATED_APPLY_DURATION = 5
     ITEM_ATTRIBUTES = {
         'running': True,
     }
@@ -6,7 +6,7 @@ from string import ascii_lowercase, digits
 
 from passlib.hash import md5_crypt, sha256_crypt, sha512_crypt
 
-from blockwart.exceptions import BundleError
+from blockwart.exceptions import BundleError, RemoteException
 from blockwart.items import BUILTIN_ITEM_ATTRIBUTES, Item, ItemStatus
 from blockwart.utils import LOG
 from blockwart.utils.text import mark_for_translation as _
@@ -35,13 +35,11 @@ HASH_METHODS = {
 _USERNAME_VALID_CHARACTERS = ascii_lowercase + digits + "-_"
 
 
-def _groups_for_user(node, username):
+def _parse_groups(id_output):
     """
-    Returns the list of group names for the given username on the given
-    node.
+    Returns the list of group names from the output of 'id -Gn'.
     """
-    idcmd = node.run("id -Gn {}".format(username))
-    return idcmd.stdout.strip().split(" ")
+    return id_output.strip().split()
 
 
 def _parse_passwd_line(line):
@@ -176,11 +174,17 @@ class User(Item):
             )
 
     def get_status(self):
-        # verify content of /etc/passwd
-        passwd_grep_result = self.node.run(
+        # these don't depend on each other, so we get them all at once
+        commands = [
             "grep -e '^{}:' /etc/passwd".format(self.name),
-            may_fail=True,
-        )
+            "id -Gn {}".format(self.name),
+        ]
+        if self.attributes['use_shadow']:
+            commands.append("grep -e '^{}:' /etc/shadow".format(self.name))
+        results = self.node.run_many(commands, may_fail=True)
+        passwd_grep_result = results[0]
+
+        # verify content of /etc/passwd
         if passwd_grep_result.return_code != 0:
             return ItemStatus(
                 correct=self.attributes['delete'],
@@ -197,10 +201,7 @@ class User(Item):
 
         if self.attributes['use_shadow']:
             # verify content of /etc/shadow
-            shadow_grep_result = self.node.run(
-                "grep -e '^{}:' /etc/shadow".format(self.name),
-                may_fail=True,
-            )
+            shadow_grep_result = results[2]
             if shadow_grep_result.return_code != 0:
                 status.correct = False
                 status.info['shadow_hash'] = None
@@ -213,7 +214,13 @@ class User(Item):
                 status.correct = False
 
         # verify content of /etc/group
-        status.info['groups'] = _groups_for_user(self.node, self.name)
+        if results[1].return_code != 0:
+            raise RemoteException(_("unable to get groups for {user} on {node}: {error}").format(
+                error=results[1].stderr,
+                node=self.node.name,
+                user=self.name,
+            ))
+        status.info['groups'] = _parse_groups(results[1].stdout)
         if set(self.attributes['groups']) != set(status.info['groups']):
             status.correct = False
 
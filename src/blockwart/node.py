@@ -8,13 +8,25 @@ from pipes import quote
 from socket import gethostname
 from tempfile import mkstemp
 from time import time
+from traceback import format_exc
 
 from . import operations
 from .bundle import Bundle
 from .concurrency import WorkerPool
-from .deps import find_item, prepare_dependencies, remove_item_dependents, remove_dep_from_items, \
-    split_items_without_deps
-from .exceptions import ItemDependencyError, NodeAlreadyLockedException, RepositoryError
+from .deps import (
+    find_item,
+    index_items,
+    ItemQueue,
+    prepare_dependencies,
+    prepare_dependency_graph,
+)
+from .exceptions import (
+    ItemDependencyError,
+    NodeAlreadyLockedException,
+    RepositoryError,
+    TaskTimeoutException,
+    WorkerException,
+)
 from .items import Item
 from .utils import cached_property, LOG, graph_for_items
 from .utils.text import mark_for_translation as _
@@ -58,42 +70,96 @@ class ApplyResult(object):
 
         self.start = None
         self.end = None
+        # seconds it took to connect to the node, if we know
+        self.connection_setup_time = None
 
     @property
     def duration(self):
         return self.end - self.start
 
 
-def apply_items(node, workers=1, interactive=False):
-    items = prepare_dependencies(node.items)
-
-    with WorkerPool(workers=workers) as worker_pool:
-        items_with_deps, items_without_deps = \
-            split_items_without_deps(items)
-
+def apply_items(node, workers=1, interactive=False, item_durations=None,
+                pool_class=WorkerPool, item_timeout=None, timeout=None):
+    """
+    Applies all items of the given node, yielding an (item_id,
+    status_code) tuple for each of them.
+
+    item_durations is an optional dict mapping item IDs to the number of
+    seconds it took to apply them in previous runs. It is used to apply
+    the items holding up most other items first and will be updated with
+    the durations measured during this run (unless in interactive mode,
+    where we would just measure how long the user took to answer).
+
+    pool_class is the kind of worker pool to apply items with
+    (blockwart.concurrency.WorkerPool or ThreadPool).
+
+    Items taking longer than item_timeout seconds fail. Once timeout
+    seconds have passed, items not started yet are skipped and those
+    being applied fail as soon as they hit the deadline. Both are
+    ignored in interactive mode.
+    """
+    graph = prepare_dependency_graph(node.items)
+    item_index = index_items(graph.items)
+    item_queue = ItemQueue(graph, item_durations=item_durations)
+    start_times = {}
+
+    if interactive:
+        item_timeout = timeout = None
+    deadline = None if timeout is None else time() + timeout
+
+    # workers get their own copies of all items when they are started,
+    # so tasks only need to tell them which item to apply
+    with pool_class(workers=workers, objects=graph.items) as worker_pool:
         # This whole thing is set in motion because every worker
         # initially asks for work. He also reports back when he finished
         # a job. Actually, all these conditions are internal to
         # worker_pool -- it will tell us whether we must keep going:
         while worker_pool.keep_running():
-            msg = worker_pool.get_event()
+            try:
+                msg = worker_pool.get_event()
+            except TaskTimeoutException as e:
+                LOG.error("{}: {}".format(node.name, e.wrapped_exception))
+                # treat it just like the item failed
+                msg = {
+                    'msg': 'FINISHED_WORK',
+                    'return_value': Item.STATUS_FAILED,
+                    'task_id': e.task_id,
+                }
 
             if msg['msg'] == 'REQUEST_WORK':
-                if items_without_deps:
+                if deadline is not None and time() >= deadline:
+                    for result in skip_ready_items(
+                        node,
+                        item_queue,
+                        item_index,
+                    ):
+                        yield result
+
+                # pop() returns None if there are no items without
+                # deps or all of them are waiting for a concurrency
+                # resource held by an item that is being applied
+                item = item_queue.pop()
+                if item is not None:
                     # There's work! Do it.
-                    item = items_without_deps.pop()
-
                     if item.ITEM_TYPE_NAME == 'action':
                         target = item.get_result
                     else:
                         target = item.apply
 
                     # start_task() increases jobs_open.
+                    start_times[item.id] = time()
                     worker_pool.start_task(
                         msg['wid'],
                         target,
                         task_id=item.id,
                         kwargs={'interactive': interactive},
+                        # this may have changed since the workers
+                        # were started
+                        target_attrs={
+                            'has_been_triggered': item.has_been_triggered,
+                        },
+                        timeout=task_timeout(item_timeout, deadline),
+                        ready_since=item_queue.ready_since(item),
                     )
                 else:
                     if worker_pool.jobs_open > 0:
@@ -112,72 +178,138 @@ def apply_items(node, workers=1, interactive=False):
 
                 # The task's id is the item we just processed.
                 item_id = msg['task_id']
-                item = find_item(item_id, items)
+                item = find_item(item_id, item_index)
 
                 status_code = msg['return_value']
 
-                if interactive:
-                    formatted_result = format_item_result(status_code, item_id)
-                    if formatted_result is not None:
-                        print(formatted_result)
-
-                if status_code in (
-                    Item.STATUS_FAILED,
-                    Item.STATUS_SKIPPED,
-                    Item.STATUS_ACTION_FAILED,
-                    Item.STATUS_ACTION_SKIPPED,
-                ) and item.cascade_skip:
-                    # if an item fails or is skipped, all items that depend on
-                    # it shall be removed from the queue
-                    items_with_deps, skipped_items = remove_item_dependents(
-                        items_with_deps,
-                        item.id,
-                    )
-                    # since we removed them from further processing, we
-                    # fake the status of the removed items so they still
-                    # show up in the result statistics
-                    for skipped_item in skipped_items:
-                        if skipped_item.ITEM_TYPE_NAME == 'dummy':
-                            continue
-                        if interactive:
-                            print(format_item_result(skipped_item.STATUS_SKIPPED, skipped_item))
-                        yield (skipped_item.id, skipped_item.STATUS_SKIPPED)
-                else:
-                    # if an item is applied successfully, all
-                    # dependencies on it can be removed from the
-                    # remaining items
-                    items_with_deps = remove_dep_from_items(
-                        items_with_deps,
-                        item.id,
-                    )
-
-                # now that we removed some deps from items_with_deps, we
-                # again need to look for items that don't have any deps
-                # left and can be processed next
-                items_with_deps, items_without_deps = \
-                    split_items_without_deps(items_with_deps + items_without_deps)
-
-                if status_code in (Item.STATUS_FIXED, Item.STATUS_ACTION_OK) or (
-                    status_code in (Item.STATUS_SKIPPED, Item.STATUS_ACTION_SKIPPED) and
-                    not item.cascade_skip
+                duration = time() - start_times.pop(item_id)
+                if (
+                    item_durations is not None and
+                    not interactive and
+                    item.ITEM_TYPE_NAME != 'dummy'
                 ):
-                    # action succeeded or item was fixed
-                    for triggered_item_id in item.triggers:
-                        triggered_item = find_item(
-                            triggered_item_id,
-                            items_with_deps + items_without_deps,
-                        )
-                        triggered_item.has_been_triggered = True
+                    item_durations[item_id] = duration
 
-                if item.ITEM_TYPE_NAME != 'dummy':
-                    yield (item.id, status_code)
+                for result in handle_item_result(
+                    item,
+                    status_code,
+                    item_queue,
+                    item_index,
+                    interactive=interactive,
+                ):
+                    yield result
 
                 # Finally, we have a new job queue. Thus, tell all idle
                 # workers to ask for work again.
                 worker_pool.activate_idle_workers()
 
+    check_for_unapplied_items(node, item_queue)
+
+
+def handle_item_result(item, status_code, item_queue, item_index,
+                       interactive=False):
+    """
+    Updates the item queue and triggers other items after the given item
+    has been applied. Returns a list of (item_id, status_code) tuples
+    for the item itself and all items skipped because of it.
+    """
+    results = []
+    if interactive:
+        formatted_result = format_item_result(status_code, item.id)
+        if formatted_result is not None:
+            print(formatted_result)
+
+    if status_code in (
+        Item.STATUS_FAILED,
+        Item.STATUS_SKIPPED,
+        Item.STATUS_ACTION_FAILED,
+        Item.STATUS_ACTION_SKIPPED,
+    ) and item.cascade_skip:
+        # if an item fails or is skipped, all items that depend on
+        # it shall be removed from the queue
+        skipped_items = item_queue.item_failed(item)
+        # since we removed them from further processing, we
+        # fake the status of the removed items so they still
+        # show up in the result statistics
+        for skipped_item in skipped_items:
+            if skipped_item.ITEM_TYPE_NAME == 'dummy':
+                continue
+            if interactive:
+                print(format_item_result(skipped_item.STATUS_SKIPPED, skipped_item))
+            results.append((skipped_item.id, skipped_item.STATUS_SKIPPED))
+    else:
+        # if an item is applied successfully, all
+        # dependencies on it are resolved and the items
+        # depending on it might be ready to be processed
+        item_queue.item_ok(item)
+
+    if status_code in (Item.STATUS_FIXED, Item.STATUS_ACTION_OK) or (
+        status_code in (Item.STATUS_SKIPPED, Item.STATUS_ACTION_SKIPPED) and
+        not item.cascade_skip
+    ):
+        # action succeeded or item was fixed
+        for triggered_item_id in item.triggers:
+            triggered_item = find_item(triggered_item_id, item_index)
+            triggered_item.has_been_triggered = True
+
+    if item.ITEM_TYPE_NAME != 'dummy':
+        results.append((item.id, status_code))
+
+    return results
+
+
+def skip_ready_items(node, item_queue, item_index):
+    """
+    Marks all items that are ready to be applied as skipped, along with
+    the items depending on them. Returns a list of (item_id,
+    status_code) tuples like handle_item_result().
+    """
+    results = []
+    while True:
+        item = item_queue.pop()
+        if item is None:
+            break
+        if item.ITEM_TYPE_NAME == 'dummy':
+            # there is nothing to skip, let the items depending on it
+            # be skipped on their own
+            item_queue.item_ok(item)
+            continue
+        results.extend(handle_item_result(
+            item,
+            Item.STATUS_SKIPPED,
+            item_queue,
+            item_index,
+        ))
+    if results:
+        LOG.warning(_("{node}: out of time, skipped {count} items").format(
+            count=len(results),
+            node=node.name,
+        ))
+    return results
+
+
+def task_timeout(item_timeout, deadline):
+    """
+    Returns the number of seconds an item may take to be applied:
+    item_timeout, but no more than what is left until deadline (a
+    timestamp). Both may be None.
+    """
+    if deadline is None:
+        return item_timeout
+    remaining = max(0, deadline - time())
+    if item_timeout is None:
+        return remaining
+    return min(item_timeout, remaining)
+
+
+def check_for_unapplied_items(node, item_queue):
+    """
+    Raises ItemDependencyError if the given queue still holds items
+    after applying everything we could.
+    """
     # we have no items without deps left and none are processing
     # there must be a loop
+    items_with_deps = item_queue.items_with_deps
     if items_with_deps:
         LOG.debug(_(
             "There was a dependency problem. Look at the debug.svg generated "
@@ -216,6 +348,10 @@ def format_item_result(result, item_id):
 
 
 class Node(object):
+    # Runs commands on the node and transfers files. This is replaced
+    # by blockwart.engine, the module is only used as a default.
+    transport = operations
+
     def __init__(self, name, infodict=None):
         if infodict is None:
             infodict = {}
@@ -228,6 +364,7 @@ class Node(object):
         self.hostname = infodict.get('hostname', self.name)
         self.metadata = infodict.get('metadata', {})
         self.use_shadow_passwords = infodict.get('use_shadow_passwords', True)
+        self.use_shell = infodict.get('use_shell', False)
 
     def __cmp__(self, other):
         return cmp(self.name, other.name)
@@ -282,7 +419,8 @@ class Node(object):
             for item in bundle.items:
                 yield item
 
-    def apply(self, interactive=False, force=False, workers=4):
+    def apply(self, interactive=False, force=False, workers=4,
+              pool_class=WorkerPool, item_timeout=None, timeout=None):
         self.repo.hooks.node_apply_start(
             self.repo,
             self,
@@ -291,13 +429,19 @@ class Node(object):
 
         start = datetime.now()
         worker_count = 1 if interactive else workers
+        item_durations = self.repo.get_item_durations(self.name)
         try:
             with NodeLock(self, interactive, ignore=force):
                 item_results = list(apply_items(
                     self,
                     workers=worker_count,
                     interactive=interactive,
+                    item_durations=item_durations,
+                    pool_class=pool_class,
+                    item_timeout=item_timeout,
+                    timeout=timeout,
                 ))
+                self.repo.set_item_durations(self.name, item_durations)
         except NodeAlreadyLockedException as e:
             if not interactive:
                 LOG.error(_("Node '{node}' already locked: {info}").format(
@@ -308,6 +452,7 @@ class Node(object):
         result = ApplyResult(self, item_results)
         result.start = start
         result.end = datetime.now()
+        result.connection_setup_time = operations.connection_setup_time(self.hostname)
 
         self.repo.hooks.node_apply_end(
             self.repo,
@@ -320,7 +465,7 @@ class Node(object):
         return result
 
     def download(self, remote_path, local_path, ignore_failure=False):
-        return operations.download(
+        return self.transport.download(
             self.hostname,
             remote_path,
             local_path,
@@ -329,7 +474,7 @@ class Node(object):
 
     def run(self, command, may_fail=False, pty=False, stderr=None, stdout=None,
             sudo=True):
-        return operations.run(
+        return self.transport.run(
             self.hostname,
             command,
             ignore_failure=may_fail,
@@ -337,28 +482,45 @@ class Node(object):
             stdout=stdout,
             sudo=sudo,
             pty=pty,
+            shell=self.use_shell,
         )
 
-    def test(self, workers=4):
+    def run_many(self, commands, may_fail=False, sudo=True):
+        """
+        Runs all given commands in a single round trip and returns a
+        list of RunResults. See blockwart.operations.run_batch().
+        """
+        return self.transport.run_batch(
+            self.hostname,
+            commands,
+            ignore_failure=may_fail,
+            sudo=sudo,
+            shell=self.use_shell,
+        )
+
+    def test(self, workers=4, pool_class=WorkerPool):
         test_items(
             self.items,
             workers=workers,
+            pool_class=pool_class,
         )
 
     def upload(self, local_path, remote_path, mode=None, owner="", group=""):
-        return operations.upload(
+        return self.transport.upload(
             self.hostname,
             local_path,
             remote_path,
             mode=mode,
             owner=owner,
             group=group,
+            shell=self.use_shell,
         )
 
-    def verify(self, workers=4):
-        verify_items(
+    def verify(self, workers=4, pool_class=WorkerPool):
+        return verify_items(
             self.items,
             workers=workers,
+            pool_class=pool_class,
         )
 
 
@@ -396,20 +558,9 @@ class NodeLock(object):
             }))
         self.node.upload(local_path, LOCK_FILE)
 
-        # See issue #19. We've just opened an SSH connection to the node,
-        # but before we can fork(), all connections *MUST* be closed!
-        # XXX: Revise this once we're using Fabric 2.0.
-        operations.disconnect_all()
-
     def __exit__(self, type, value, traceback):
         result = self.node.run("rm -R {}".format(quote(LOCK_PATH)), may_fail=True)
 
-        # See __enter__(). Most likely we won't fork() again now.
-        # Nevertheless, clean up the state so a future code change won't
-        # cause chaos.
-        # XXX: Revise this once we're using Fabric 2.0.
-        operations.disconnect_all()
-
         if result.return_code != 0:
             LOG.error(_("Could not release lock for node '{node}'").format(
                 node=self.node.name,
@@ -440,10 +591,41 @@ class NodeLock(object):
         )
 
 
-def test_items(items, workers=1):
-    items = prepare_dependencies(items)
+def _load_items(nodes, prepare=False):
+    """
+    Returns a list of all items of the given nodes, loading everything
+    workers need to process them before any worker is started.
+    """
+    items = []
+    for node in nodes:
+        try:
+            if prepare:
+                items.extend(prepare_dependencies(node.items))
+            else:
+                items.extend(node.items)
+        except Exception as e:
+            # report it just like it would have been reported by a
+            # worker loading the items itself
+            raise WorkerException(node.name, str(e), format_exc())
+        node.repo.preload()
+    return items
+
+
+def test_items(items, workers=1, pool_class=WorkerPool):
+    _test_items(prepare_dependencies(items), workers, pool_class)
 
-    with WorkerPool(workers=workers) as worker_pool:
+
+def test_nodes(nodes, workers=4, pool_class=WorkerPool):
+    """
+    Tests the items of all given nodes using a single pool of workers
+    that is only started once all of them have been loaded, so workers
+    inherit them and are kept busy across nodes.
+    """
+    _test_items(_load_items(nodes, prepare=True), workers, pool_class)
+
+
+def _test_items(items, workers, pool_class):
+    with pool_class(workers=workers, objects=items) as worker_pool:
         while worker_pool.keep_running():
             msg = worker_pool.get_event()
             if msg['msg'] == 'REQUEST_WORK':
@@ -469,15 +651,31 @@ def test_items(items, workers=1):
                 ))
 
 
-def verify_items(items_with_actions, workers=1):
+def verify_items(items_with_actions, workers=1, pool_class=WorkerPool,
+                 metrics=None):
+    """
+    Returns a list of WorkerExceptions for items that could not be
+    verified.
+
+    metrics is an optional blockwart.concurrency.PoolMetrics object
+    to collect the timings of the pool in.
+    """
     items = []
     for item in items_with_actions:
         if not item.ITEM_TYPE_NAME == 'action':
             items.append(item)
 
-    with WorkerPool(workers=workers) as worker_pool:
+    errors = []
+    with pool_class(workers=workers, objects=items, metrics=metrics) as worker_pool:
         while worker_pool.keep_running():
-            msg = worker_pool.get_event()
+            try:
+                msg = worker_pool.get_event()
+            except WorkerException as e:
+                if e.task_id is None:
+                    # a worker died, we don't know what it was doing
+                    raise
+                errors.append(e)
+                continue
             if msg['msg'] == 'REQUEST_WORK':
                 if items:
                     item = items.pop()
@@ -501,3 +699,18 @@ def verify_items(items_with_actions, workers=1):
                         green("✓"),
                         item_id,
                     ))
+
+    return errors
+
+
+def verify_nodes(nodes, workers=4, pool_class=WorkerPool, metrics=None):
+    """
+    Like verify_items(), but for all items of the given nodes. See
+    test_nodes().
+    """
+    return verify_items(
+        _load_items(nodes),
+        workers=workers,
+        pool_class=pool_class,
+        metrics=metrics,
+    )
@@ -1,63 +1,454 @@
-from base64 import b64decode
+from contextlib import contextmanager
+from os import getpid, read
 from pipes import quote
+from select import select
 from stat import S_IRUSR, S_IWUSR
+import sys
+from threading import local, Lock
+from time import time
 
-from fabric.api import prefix
-from fabric.api import put as _fabric_put
-from fabric.api import run as _fabric_run
-from fabric.api import sudo as _fabric_sudo
+from fabric import network
+from fabric.context_managers import char_buffered
 from fabric.network import disconnect_all as _fabric_disconnect_all
-from fabric.state import env, output
+from fabric.state import connections, env, output
+from paramiko import SSHException
 
 from .exceptions import RemoteException
 from .utils import LOG
 from .utils.text import mark_for_translation as _, randstr
-from .utils.ui import LineBuffer
+
+# Nobody is there to answer a password prompt, so sudo must fail right
+# away instead of waiting for input forever.
+SUDO_PREFIX = "sudo -n"
+# what sudo -n says when it would have asked for a password
+SUDO_PASSWORD_REQUIRED = b"sudo: a password is required"
+
+# how long to wait for output before checking whether the remote
+# command has exited (not all channel events can be select()ed)
+IO_TIMEOUT = 0.01
+RECV_SIZE = 8192
 
 env.use_ssh_config = True
-env.warn_only = True
 # silence fabric
 for key in output:
     output[key] = False
 
+# We use Fabric only to set up connections. All threads of a process
+# share the same connection to each node (every command gets its own
+# channel on it), so we must not rely on global state like
+# env.host_string (or output) while running commands. This lock is only
+# held while looking at or changing the dicts below and Fabric's
+# connection cache, not while connecting.
+_CONNECTION_LOCK = Lock()
 
-class FabricOutput(object):
-    def __init__(self, silent=False):
-        self.silent = silent
+# maps hostnames to Locks held while connecting to them, so threads
+# waiting for one host don't hold up those using another
+_HOST_LOCKS = {}
 
-    def __enter__(self):
-        output['stderr'] = not self.silent
-        output['stdout'] = not self.silent
+# remembers which host the current thread is connecting to (see
+# _ssh_config())
+_CONNECTING = local()
 
-    def __exit__(self, type, value, traceback):
-        output['stderr'] = False
-        output['stdout'] = False
+# The process the connections in Fabric's cache belong to. A forked
+# worker process inherits them, but they still belong to its parent:
+# using (or closing) them in the child would break them for the parent.
+_CONNECTIONS_PID = getpid()
 
+# maps hostnames to the number of seconds it took to connect to them
+_SETUP_TIMES = {}
 
-def download(hostname, remote_path, local_path, ignore_failure=False):
+# maps hostnames to lists of RemoteShells not running a command right now
+_IDLE_SHELLS = {}
+
+# Connections and shells inherited from the parent process. Paramiko
+# closes channels when they are garbage collected, which would send
+# messages over the parent's connection, so they are kept alive here.
+_INHERITED = []
+
+
+def _forget_inherited_connections():
     """
-    Download a file.
+    Must be called with _CONNECTION_LOCK held. Drops all connections
+    this process has inherited from the process it was forked from,
+    without closing them.
     """
+    global _CONNECTIONS_PID
+    if _CONNECTIONS_PID != getpid():
+        _INHERITED.append((dict(connections), dict(_IDLE_SHELLS)))
+        dict.clear(connections)
+        # held by threads that didn't make it into this process
+        _HOST_LOCKS.clear()
+        _IDLE_SHELLS.clear()
+        _SETUP_TIMES.clear()
+        _CONNECTIONS_PID = getpid()
+
+
+_fabric_ssh_config = network.ssh_config
+
+
+def _ssh_config(host_string=None):
+    """
+    Fabric looks up identity files from the SSH config for
+    env.host_string while connecting. Several threads may be connecting
+    to different hosts at the same time, so each one gets the config
+    for its own host instead.
+    """
+    if host_string is None:
+        host_string = getattr(_CONNECTING, 'hostname', None)
+    return _fabric_ssh_config(host_string)
+
+network.ssh_config = _ssh_config
+
 
-    # See issue #39.
-    # XXX: Revise this once we're using Fabric 2.0.
+def _connection(hostname):
+    """
+    Returns the SSH client connected to the given host, connecting first
+    if necessary.
+    """
+    with _CONNECTION_LOCK:
+        _forget_inherited_connections()
+        host_lock = _HOST_LOCKS.setdefault(hostname, Lock())
+    with host_lock:
+        with _CONNECTION_LOCK:
+            if hostname in connections:
+                return connections[hostname]
+        start = time()
+        _CONNECTING.hostname = hostname
+        try:
+            connections.connect(hostname)
+        finally:
+            _CONNECTING.hostname = None
+        with _CONNECTION_LOCK:
+            _SETUP_TIMES[hostname] = time() - start
+            LOG.debug(_("connected to {host} after {time:.3f}s").format(
+                host=hostname,
+                time=_SETUP_TIMES[hostname],
+            ))
+            return connections[hostname]
+
+
+def connection_setup_time(hostname):
+    """
+    Returns the number of seconds it took this process to connect to
+    the given host or None if it isn't connected.
+    """
+    with _CONNECTION_LOCK:
+        _forget_inherited_connections()
+        return _SETUP_TIMES.get(hostname)
+
+
+def _open_session(hostname):
+    """
+    Returns a new channel on the connection to the given host.
+    """
+    try:
+        return _connection(hostname).get_transport().open_session()
+    except SSHException as e:
+        if str(e) != "SSH session not active":
+            raise
+        disconnect(hostname)
+        return _connection(hostname).get_transport().open_session()
+
+
+@contextmanager
+def _forward_stdin(enabled):
+    """
+    Puts the local terminal into character mode and returns the inputs
+    to forward to the remote command (only used with a pty).
+    """
+    if enabled:
+        with char_buffered(sys.stdin):
+            yield [sys.stdin]
+    else:
+        yield []
+
+
+def _check_sudo(hostname, return_code, stderr):
+    """
+    Raises RemoteException if sudo refused to run a command because it
+    would have needed a password.
+    """
+    if return_code != 0 and SUDO_PASSWORD_REQUIRED in stderr:
+        raise RemoteException(_(
+            "sudo on {host} requires a password, but Blockwart needs "
+            "passwordless sudo"
+        ).format(host=hostname))
+
+
+def _wrap_command(command, sudo=True):
+    """
+    Wraps the command like Fabric would: it is run by env.shell (through
+    sudo, if requested) with a predictable locale.
+    """
+    command = "{} {}".format(env.shell, quote("export LANG=C && " + command))
+    if sudo:
+        command = SUDO_PREFIX + " " + command
+    return command
+
+
+def _execute(hostname, command, pty=False, stderr=None, stdout=None,
+             keep_stdout=True):
+    """
+    Runs the (already wrapped) command on its own channel and returns a
+    (return_code, stdout, stderr) tuple. Output is also written to the
+    given stderr and stdout objects as it arrives.
+
+    If keep_stdout is False, stdout is only written to the given object
+    and returned as an empty string.
+    """
+    channel = _open_session(hostname)
+    stderr_chunks = []
+    stdout_chunks = []
+    try:
+        if pty:
+            channel.get_pty()
+        channel.exec_command(command)
+        with _forward_stdin(pty and sys.stdin.isatty()) as inputs:
+            while True:
+                # The exit status arrives after all output, so once we
+                # have seen it, draining the buffers one last time will
+                # give us everything.
+                exited = channel.exit_status_ready()
+                while channel.recv_ready():
+                    chunk = channel.recv(RECV_SIZE)
+                    if keep_stdout:
+                        stdout_chunks.append(chunk)
+                    if stdout is not None:
+                        stdout.write(chunk)
+                while channel.recv_stderr_ready():
+                    chunk = channel.recv_stderr(RECV_SIZE)
+                    stderr_chunks.append(chunk)
+                    if stderr is not None:
+                        stderr.write(chunk)
+                if exited:
+                    break
+                readable, writable, exceptional = select(
+                    [channel] + inputs, [], [], IO_TIMEOUT,
+                )
+                if sys.stdin in readable:
+                    channel.sendall(read(sys.stdin.fileno(), RECV_SIZE))
+        return_code = channel.recv_exit_status()
+    finally:
+        channel.close()
+    return (
+        return_code,
+        b"".join(stdout_chunks).strip(),
+        b"".join(stderr_chunks).strip(),
+    )
+
+
+class _MarkedOutput(object):
+    """
+    Collects what a RemoteShell writes to one of its streams until the
+    given marker appears at the start of a line. Output is passed on to
+    target as it arrives (minus the marker, of course).
+    """
+    def __init__(self, marker, target=None):
+        self.buffer = b""
+        self.done = False
+        self.marker = b"\n" + marker
+        # the rest of the marker line
+        self.trailer = None
+        self.target = target
+        self._end = None
+        self._written = 0
+
+    @property
+    def output(self):
+        return self.buffer[:self._end].strip()
+
+    def feed(self, data):
+        # no need to search what we have already searched before
+        search_start = max(0, len(self.buffer) - len(self.marker))
+        self.buffer += data
+        if self._end is None:
+            index = self.buffer.find(self.marker, search_start)
+            if index != -1:
+                self._end = index
+        if self._end is None:
+            # the end of the buffer might be the start of the marker
+            safe_end = len(self.buffer) - len(self.marker) + 1
+        else:
+            safe_end = self._end
+            line_end = self.buffer.find(b"\n", self._end + len(self.marker))
+            if line_end != -1:
+                self.trailer = self.buffer[self._end + len(self.marker):line_end].strip()
+                self.done = True
+        if self.target is not None and safe_end > self._written:
+            self.target.write(self.buffer[self._written:safe_end])
+            self._written = safe_end
+
+
+class RemoteShell(object):
+    """
+    A root shell kept running on a node, so commands can be run without
+    opening a new channel and going through sudo for each one.
+
+    Commands are written to the shell's stdin one at a time. Each one
+    is followed by a line starting with a random marker on both stdout
+    and stderr, which tells us where its output ends and (on stdout)
+    what it returned.
+    """
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.channel = _open_session(hostname)
+        # the shell reads commands from stdin since it is not given any
+        self.channel.exec_command(_wrap_command("exec /bin/bash"))
+
+    @property
+    def alive(self):
+        return not self.channel.closed and not self.channel.exit_status_ready()
+
+    def close(self):
+        self.channel.close()
+
+    def execute(self, command, stderr=None, stdout=None):
+        """
+        Runs the (unwrapped) command in a subshell and returns a
+        (return_code, stdout, stderr) tuple just like _execute().
+        """
+        marker = "BLOCKWART-" + randstr()
+        # Commands don't get to read our stdin, nor can they change the
+        # state of the shell (e.g. by calling cd or exit).
+        self.channel.sendall(
+            "(eval {command}) </dev/null\n"
+            "printf '\\n{marker} %d\\n' $?\n"
+            "printf '\\n{marker}\\n' >&2\n".format(
+                command=quote(command),
+                marker=marker,
+            )
+        )
+        stderr_output = _MarkedOutput(marker, target=stderr)
+        stdout_output = _MarkedOutput(marker, target=stdout)
+        while True:
+            exited = self.channel.exit_status_ready()
+            while self.channel.recv_ready():
+                stdout_output.feed(self.channel.recv(RECV_SIZE))
+            while self.channel.recv_stderr_ready():
+                stderr_output.feed(self.channel.recv_stderr(RECV_SIZE))
+            if stdout_output.done and stderr_output.done:
+                break
+            if exited:
+                _check_sudo(
+                    self.hostname,
+                    self.channel.recv_exit_status(),
+                    stderr_output.output,
+                )
+                raise RemoteException(_(
+                    "shell on {host} exited while running '{command}':\n\n{result}"
+                ).format(
+                    command=command,
+                    host=self.hostname,
+                    result=stdout_output.output + stderr_output.output,
+                ))
+            select([self.channel], [], [], IO_TIMEOUT)
+        return (
+            int(stdout_output.trailer),
+            stdout_output.output,
+            stderr_output.output,
+        )
 
+
+def _execute_in_shell(hostname, command, stderr=None, stdout=None):
+    """
+    Runs the (unwrapped) command in one of the idle RemoteShells on the
+    given host or a new one if there are none.
+    """
+    shell = None
+    with _CONNECTION_LOCK:
+        _forget_inherited_connections()
+        idle_shells = _IDLE_SHELLS.setdefault(hostname, [])
+        while idle_shells and shell is None:
+            shell = idle_shells.pop()
+            if not shell.alive:
+                shell.close()
+                shell = None
+    if shell is None:
+        shell = RemoteShell(hostname)
+    try:
+        result = shell.execute(command, stderr=stderr, stdout=stdout)
+    except:
+        # we don't know what state the shell is in
+        shell.close()
+        raise
+    with _CONNECTION_LOCK:
+        _IDLE_SHELLS.setdefault(hostname, []).append(shell)
+    return result
+
+
+def _batch_script(commands, marker):
+    """
+    Returns a single shell script running all given commands. Just like
+    with a RemoteShell, each command is followed by a marker line on
+    stdout (with its return code) and stderr.
+    """
+    lines = []
+    for command in commands:
+        lines.append("(eval {}) </dev/null".format(quote(command)))
+        lines.append("printf '\\n{} %d\\n' $?".format(marker))
+        lines.append("printf '\\n{}\\n' >&2".format(marker))
+    return "\n".join(lines)
+
+
+def _split_batch_output(output, marker, count):
+    """
+    Splits the output of a script returned by _batch_script() into a
+    list of (output, marker line remainder) tuples, one for each command.
+    Returns None if not all commands were run.
+    """
+    chunks = ("\n" + output).split("\n" + marker)
+    if len(chunks) != count + 1:
+        return None
+    outputs = [chunks[0]]
+    trailers = []
+    for chunk in chunks[1:]:
+        trailer, newline, rest = chunk.partition("\n")
+        trailers.append(trailer.strip())
+        outputs.append(rest)
+    return [
+        (output.strip(), trailer)
+        for output, trailer in zip(outputs, trailers)
+    ]
+
+
+def _failure(hostname, command, result):
+    """
+    Returns a RemoteException for the given failed RunResult.
+    """
+    return RemoteException(_(
+        "Non-zero return code ({rcode}) running '{command}' on '{host}':\n\n{result}"
+    ).format(
+        command=command,
+        host=hostname,
+        rcode=result.return_code,
+        result=result.stdout + result.stderr,
+    ))
+
+
+def download(hostname, remote_path, local_path, ignore_failure=False):
+    """
+    Download a file.
+
+    The file is written to local_path as it arrives, so this takes the
+    same (small) amount of memory no matter how large the file is.
+    Downloads always get their own channel (see run()), the output of a
+    RemoteShell would have to be searched for markers.
+    """
     LOG.debug(_("downloading {host}:{path} -> {target}").format(
         host=hostname, path=remote_path, target=local_path))
-    env.host_string = hostname
-    fabric_result = _fabric_sudo(
-        "base64 {}".format(quote(remote_path)),
-        shell=True,
-        pty=False,
-        combine_stderr=False,
-    )
-    if fabric_result.succeeded:
-        with open(local_path, "w") as f:
-            f.write(b64decode(fabric_result.stdout))
-    elif not ignore_failure:
+    with open(local_path, "wb") as f:
+        # unlike Fabric (see issue #39), we don't mangle binary output
+        return_code, stdout, stderr = _execute(
+            hostname,
+            _wrap_command("cat -- {}".format(quote(remote_path))),
+            keep_stdout=False,
+            stdout=f,
+        )
+    _check_sudo(hostname, return_code, stderr)
+    if return_code != 0 and not ignore_failure:
             raise RemoteException(_(
                 "reading file '{path}' on {host} failed: {error}").format(
-                    error=fabric_result.stderr,
+                    error=stderr,
                     host=hostname,
                     path=remote_path,
                 )
@@ -74,84 +465,149 @@ class RunResult(object):
         return self.stdout
 
 
+def disconnect(hostname):
+    """
+    Close the connection to the given host (if any).
+    """
+    with _CONNECTION_LOCK:
+        _forget_inherited_connections()
+        for shell in _IDLE_SHELLS.pop(hostname, []):
+            shell.close()
+        if hostname in connections:
+            connections[hostname].close()
+            del connections[hostname]
+            _SETUP_TIMES.pop(hostname, None)
+
+
 def disconnect_all():
     """
-    Close all open connections.
+    Close all connections opened by this process.
     """
-    _fabric_disconnect_all()
+    with _CONNECTION_LOCK:
+        _forget_inherited_connections()
+        for shells in _IDLE_SHELLS.values():
+            for shell in shells:
+                shell.close()
+        _IDLE_SHELLS.clear()
+        _fabric_disconnect_all()
+        _SETUP_TIMES.clear()
 
 
 def run(hostname, command, ignore_failure=False, stderr=None,
-        stdout=None, pty=False, sudo=True):
+        stdout=None, pty=False, sudo=True, shell=False):
     """
     Runs a command on a remote system.
+
+    If shell is True, the command is run by a RemoteShell kept running
+    on the node instead of on its own channel. This only works for
+    commands run through sudo without a pty, others are run the usual
+    way.
     """
-    env.host_string = hostname
+    LOG.debug("running on {host}: {command}".format(command=command, host=hostname))
 
-    silent_fabric = stderr is None and stdout is None
+    if shell and sudo and not pty:
+        return_code, result_stdout, result_stderr = _execute_in_shell(
+            hostname,
+            command,
+            stderr=stderr,
+            stdout=stdout,
+        )
+    else:
+        return_code, result_stdout, result_stderr = _execute(
+            hostname,
+            _wrap_command(command, sudo=sudo),
+            pty=pty,
+            stderr=stderr,
+            stdout=stdout,
+        )
 
-    if stderr is None:
-        stderr = LineBuffer(lambda s: None)
-    if stdout is None:
-        stdout = LineBuffer(lambda s: None)
+    LOG.debug("command finished with return code {}".format(return_code))
 
-    LOG.debug("running on {host}: {command}".format(command=command, host=hostname))
+    if sudo:
+        # even if the command may fail, not running it at all is an error
+        _check_sudo(hostname, return_code, result_stderr)
 
-    runner = _fabric_sudo if sudo else _fabric_run
-
-    with FabricOutput(silent=silent_fabric):
-        with prefix("export LANG=C"):
-            fabric_result = runner(
-                command,
-                shell=True,
-                pty=pty,
-                combine_stderr=False,
-                stdout=stdout,
-                stderr=stderr,
-            )
+    result = RunResult()
+    result.stdout = result_stdout
+    result.stderr = result_stderr
+    result.return_code = return_code
 
-    LOG.debug("command finished with return code {}".format(fabric_result.return_code))
+    if return_code != 0 and not ignore_failure:
+        raise _failure(hostname, command, result)
+
+    return result
+
+
+def run_batch(hostname, commands, ignore_failure=False, sudo=True, shell=False):
+    """
+    Runs several independent commands on a remote system, paying for
+    only a single round trip. Returns a list of RunResults, one for each
+    command.
 
-    if not fabric_result.succeeded and not ignore_failure:
+    All commands are run (in order), even if some of them fail. Unless
+    ignore_failure is True, a RemoteException for the first failed
+    command is raised afterwards.
+    """
+    if not commands:
+        return []
+    marker = "BLOCKWART-BATCH-" + randstr()
+    batch_result = run(
+        hostname,
+        _batch_script(commands, marker),
+        ignore_failure=True,
+        sudo=sudo,
+        shell=shell,
+    )
+    stdout_chunks = _split_batch_output(batch_result.stdout, marker, len(commands))
+    stderr_chunks = _split_batch_output(batch_result.stderr, marker, len(commands))
+    if stdout_chunks is None or stderr_chunks is None:
         raise RemoteException(_(
-            "Non-zero return code ({rcode}) running '{command}' on '{host}':\n\n{result}"
+            "batch of {count} commands on {host} did not finish:\n\n{result}"
         ).format(
-            command=command,
+            count=len(commands),
             host=hostname,
-            rcode=fabric_result.return_code,
-            result=str(fabric_result) + fabric_result.stderr,
+            result=batch_result.stdout + batch_result.stderr,
         ))
 
-    result = RunResult()
-    result.stdout = str(fabric_result)
-    result.stderr = fabric_result.stderr
-    result.return_code = fabric_result.return_code
-    return result
+    results = []
+    for (stdout, return_code), (stderr, trailer) in zip(stdout_chunks, stderr_chunks):
+        result = RunResult()
+        result.stdout = stdout
+        result.stderr = stderr
+        result.return_code = int(return_code)
+        results.append(result)
+
+    if not ignore_failure:
+        for command, result in zip(commands, results):
+            if result.return_code != 0:
+                raise _failure(hostname, command, result)
+
+    return results
 
 
 def upload(hostname, local_path, remote_path, mode=None, owner="",
-           group="", ignore_failure=False):
+           group="", ignore_failure=False, shell=False):
     """
     Upload a file.
     """
     LOG.debug(_("uploading {path} -> {host}:{target}").format(
         host=hostname, path=local_path, target=remote_path))
-    env.host_string = hostname
     temp_filename = ".blockwart_tmp_" + randstr()
 
-    fabric_result = _fabric_put(
-        local_path=local_path,
-        remote_path=temp_filename,
-        mirror_local_mode=False,
-        mode=S_IRUSR | S_IWUSR,
-    )
-    if not ignore_failure and fabric_result.failed:
-        raise RemoteException(_(
-            "upload to {host} failed for: {failed}").format(
-                failed=", ".join(fabric_result.failed),
-                host=hostname,
+    sftp = _connection(hostname).open_sftp()
+    try:
+        sftp.put(local_path, temp_filename)
+        sftp.chmod(temp_filename, S_IRUSR | S_IWUSR)
+    except (IOError, OSError) as e:
+        if not ignore_failure:
+            raise RemoteException(_(
+                "upload to {host} failed for: {failed}").format(
+                    failed="{} ({})".format(local_path, e),
+                    host=hostname,
+                )
             )
-        )
+    finally:
+        sftp.close()
 
     if owner or group:
         run(
@@ -161,6 +617,7 @@ def upload(hostname, local_path, remote_path, mode=None, owner="",
                 quote(group),
                 quote(temp_filename),
             ),
+            shell=shell,
         )
 
     if mode:
@@ -170,6 +627,7 @@ def upload(hostname, local_path, remote_path, mode=None, owner="",
                 mode,
                 quote(temp_filename),
             ),
+            shell=shell,
         )
 
     run(
@@ -178,4 +636,5 @@ def upload(hostname, local_path, remote_path, mode=None, owner="",
             quote(temp_filename),
             quote(remote_path),
         ),
+        shell=shell,
     )
@@ -1,17 +1,21 @@
 from imp import load_source
-from os import listdir, mkdir
+import json
+from os import fdopen, listdir, makedirs, mkdir, rename
 from os.path import isdir, isfile, join
+from tempfile import mkstemp
 
 from . import items
 from .exceptions import NoSuchGroup, NoSuchNode, NoSuchRepository, RepositoryError
 from .group import Group
 from .node import Node
 from . import utils
+from .utils import LOG
 from .utils.scm import get_rev
 from .utils.text import mark_for_translation as _, validate_name
 
 DIRNAME_BUNDLES = "bundles"
 DIRNAME_HOOKS = "hooks"
+DIRNAME_ITEM_DURATIONS = ".item_durations"
 DIRNAME_ITEM_TYPES = "items"
 DIRNAME_LIBS = "libs"
 FILENAME_GROUPS = "groups.py"
@@ -334,6 +338,17 @@ class Repository(object):
         except KeyError:
             raise NoSuchGroup(group_name)
 
+    def get_item_durations(self, node_name):
+        """
+        Returns a dict mapping item IDs to the number of seconds it took
+        to apply them the last time they were applied to the given node.
+        """
+        try:
+            with open(join(self.item_durations_dir, node_name + ".json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
     def get_node(self, node_name):
         try:
             return self.node_dict[node_name]
@@ -387,14 +402,51 @@ class Repository(object):
         for node in nodes_from_file(self.nodes_file):
             self.add_node(node)
 
+    def preload(self):
+        """
+        Loads hooks, libs and the template engine right away instead of
+        when they are first used. Worker processes forked afterwards
+        inherit all of it instead of loading it again one by one.
+        """
+        for event in HOOK_EVENTS:
+            getattr(self.hooks, event)
+        if isdir(self.libs_dir):
+            for filename in listdir(self.libs_dir):
+                if not filename.endswith(".py") or \
+                        not isfile(join(self.libs_dir, filename)) or \
+                        filename.startswith("_"):
+                    continue
+                getattr(self.libs, filename[:-3])
+        # used to render file templates
+        import mako.template
+
     @utils.cached_property
     def revision(self):
         return get_rev()
 
+    def set_item_durations(self, node_name, item_durations):
+        """
+        Stores the result of a previous call to get_item_durations(),
+        updated with new measurements.
+        """
+        try:
+            if not isdir(self.item_durations_dir):
+                makedirs(self.item_durations_dir)
+            handle, tmp_path = mkstemp(dir=self.item_durations_dir)
+        except OSError as e:
+            LOG.warning(_("unable to store item durations: {}").format(e))
+            return
+        with fdopen(handle, 'w') as f:
+            json.dump(item_durations, f, indent=4, sort_keys=True)
+        # rename() replaces the old file atomically, so concurrent
+        # readers never see a partially written file
+        rename(tmp_path, join(self.item_durations_dir, node_name + ".json"))
+
     def _set_path(self, path):
         self.path = path
         self.bundles_dir = join(self.path, DIRNAME_BUNDLES)
         self.hooks_dir = join(self.path, DIRNAME_HOOKS)
+        self.item_durations_dir = join(self.path, DIRNAME_ITEM_DURATIONS)
         self.items_dir = join(self.path, DIRNAME_ITEM_TYPES)
         self.groups_file = join(self.path, FILENAME_GROUPS)
         self.libs_dir = join(self.path, DIRNAME_LIBS)
@@ -0,0 +1,388 @@
+from collections import deque
+from datetime import datetime
+from time import time
+from traceback import format_exc
+
+from . import operations
+from .concurrency import WorkerPool
+from .deps import index_items, ItemQueue, prepare_dependency_graph
+from .exceptions import NodeAlreadyLockedException, TaskTimeoutException, WorkerException
+from .items import Item
+from .node import (
+    ApplyResult,
+    check_for_unapplied_items,
+    handle_item_result,
+    NodeLock,
+    skip_ready_items,
+    task_timeout,
+)
+from .utils import LOG
+from .utils.text import mark_for_translation as _
+
+# number of seconds locking or unlocking a node may take (item_timeout
+# is meant for items and might not leave enough time for this)
+LOCK_TIMEOUT = 60
+
+
+class _NodeRun(object):
+    """
+    Keeps track of applying a single node as part of apply_nodes().
+
+    Workers get a copy of this object when the pool is started. Only
+    acquire_lock(), release_lock() and disconnect() are called there,
+    everything else happens in the parent process.
+    """
+    def __init__(self, node, force=False, item_timeout=None, timeout=None):
+        self.node = node
+        self.item_timeout = item_timeout
+        self.timeout = timeout
+        self.graph = prepare_dependency_graph(node.items)
+        self.item_index = index_items(self.graph.items)
+        self.item_durations = node.repo.get_item_durations(node.name)
+        self.item_queue = ItemQueue(self.graph, item_durations=self.item_durations)
+        self.item_results = []
+        self.lock = NodeLock(node, False, ignore=force)
+
+        self.connection_setup_time = None
+        self.deadline = None
+        self.error = None
+        self.jobs_open = 0
+        self.start = None
+        self.start_times = {}
+        # waiting -> locking -> applying -> unlocking -> done
+        self.state = 'waiting'
+
+    def acquire_lock(self):
+        """
+        Returns a (locked, connection_setup_time) tuple, locked being
+        False if the node is locked by someone else.
+
+        Locking is the first thing done on the node, so this is where
+        the worker connects to it. Connections only live in the worker,
+        so the parent has to be told how long that took.
+        """
+        try:
+            self.lock.__enter__()
+        except NodeAlreadyLockedException as e:
+            LOG.error(_("Node '{node}' already locked: {info}").format(
+                node=self.node.name,
+                info=e.args,
+            ))
+            locked = False
+        else:
+            locked = True
+        return (locked, operations.connection_setup_time(self.node.hostname))
+
+    def disconnect(self):
+        """
+        Closes the worker's connection to the node once the node is done.
+        """
+        operations.disconnect(self.node.hostname)
+
+    def release_lock(self):
+        self.lock.__exit__(None, None, None)
+
+    def finish(self):
+        """
+        Returns the final event for this node.
+        """
+        if self.error is not None:
+            return ('failed', self.node, self.error)
+
+        self.node.repo.set_item_durations(self.node.name, self.item_durations)
+        result = ApplyResult(self.node, self.item_results)
+        result.start = self.start
+        result.end = datetime.now()
+        result.connection_setup_time = self.connection_setup_time
+        self.node.repo.hooks.node_apply_end(
+            self.node.repo,
+            self.node,
+            duration=result.duration,
+            interactive=False,
+            result=result,
+        )
+        return ('finished', self.node, result)
+
+    def next_task(self, item_workers):
+        """
+        Returns a (target, task_id, kwargs, target_attrs, timeout,
+        ready_since) tuple for the next task to start for this node or
+        None if there is nothing to do right now. ready_since is only
+        known for items.
+        """
+        if self.state == 'waiting':
+            self.node.repo.hooks.node_apply_start(
+                self.node.repo,
+                self.node,
+                interactive=False,
+            )
+            self.start = datetime.now()
+            if self.timeout is not None:
+                self.deadline = time() + self.timeout
+            self.state = 'locking'
+            return (
+                self.acquire_lock,
+                (self.node.name, 'lock', None),
+                {},
+                {},
+                LOCK_TIMEOUT,
+                None,
+            )
+
+        if self.state != 'applying':
+            return None
+
+        if self.deadline is not None and time() >= self.deadline:
+            self.item_results.extend(skip_ready_items(
+                self.node,
+                self.item_queue,
+                self.item_index,
+            ))
+
+        while self.error is None and self.jobs_open < item_workers:
+            item = self.item_queue.pop()
+            if item is None:
+                break
+            if item.ITEM_TYPE_NAME == 'dummy':
+                # nothing to do, no need to bother a worker
+                self._item_finished(item, Item.STATUS_OK)
+                continue
+            if item.ITEM_TYPE_NAME == 'action':
+                target = item.get_result
+            else:
+                target = item.apply
+            self.jobs_open += 1
+            self.start_times[item.id] = time()
+            return (
+                target,
+                (self.node.name, 'item', item.id),
+                {'interactive': False},
+                {'has_been_triggered': item.has_been_triggered},
+                task_timeout(self.item_timeout, self.deadline),
+                self.item_queue.ready_since(item),
+            )
+
+        if self.jobs_open == 0:
+            if self.error is None:
+                try:
+                    check_for_unapplied_items(self.node, self.item_queue)
+                except Exception as e:
+                    self.error = WorkerException(self.node.name, str(e), format_exc())
+            self.state = 'unlocking'
+            # the node is unlocked even if we are out of time
+            return (
+                self.release_lock,
+                (self.node.name, 'unlock', None),
+                {},
+                {},
+                LOCK_TIMEOUT,
+                None,
+            )
+
+        return None
+
+    def task_failed(self, kind, item_id, exception):
+        """
+        Returns True if this node is done.
+        """
+        if kind == 'item' and isinstance(exception, TaskTimeoutException):
+            LOG.error("{}: {}".format(self.node.name, exception.wrapped_exception))
+            # treat it just like the item failed
+            return self.task_finished(kind, item_id, Item.STATUS_FAILED)
+        if kind == 'item':
+            self.jobs_open -= 1
+        if self.error is None:
+            self.error = exception
+        if kind == 'lock':
+            # The worker might have locked the node before failing.
+            # Since self.error is set, no items will be applied, the
+            # node will just be unlocked.
+            self.state = 'applying'
+        elif kind == 'unlock':
+            self.state = 'done'
+        return self.state == 'done'
+
+    def task_finished(self, kind, item_id, return_value):
+        """
+        Returns True if this node is done.
+        """
+        if kind == 'lock':
+            locked, self.connection_setup_time = return_value
+            self.state = 'applying' if locked else 'done'
+        elif kind == 'item':
+            self.jobs_open -= 1
+            item = self.graph.items[self.graph.index[item_id]]
+            self.item_durations[item_id] = time() - self.start_times.pop(item_id)
+            self._item_finished(item, return_value)
+        elif kind == 'unlock':
+            self.state = 'done'
+        return self.state == 'done'
+
+    def _item_finished(self, item, status_code):
+        self.item_results.extend(handle_item_result(
+            item,
+            status_code,
+            self.item_queue,
+            self.item_index,
+        ))
+
+
+def _release_locks(runs):
+    """
+    Removes the locks of all given nodes that might still be locked
+    (used when applying can't go on).
+    """
+    for run in runs:
+        if run.state not in ('locking', 'applying', 'unlocking'):
+            continue
+        LOG.warn(_("{node}: releasing lock after error").format(node=run.node.name))
+        try:
+            run.release_lock()
+        except Exception as e:
+            LOG.error(_("{node}: unable to release lock: {error}").format(
+                error=e,
+                node=run.node.name,
+            ))
+
+
+def _next_task(waiting, active, node_workers, item_workers):
+    """
+    Returns a (run, task) tuple for the next task to start (task being
+    as returned by _NodeRun.next_task()) or None.
+
+    New nodes are started as long as there is room, so they are locked
+    early. Otherwise, the nodes being applied take turns.
+    """
+    if waiting and len(active) < node_workers:
+        run = waiting.popleft()
+        active.append(run)
+        return (run, run.next_task(item_workers))
+    for i in range(len(active)):
+        run = active[0]
+        active.rotate(-1)
+        task = run.next_task(item_workers)
+        if task is not None:
+            return (run, task)
+    return None
+
+
+def apply_nodes(nodes, workers=16, node_workers=4, item_workers=4,
+                force=False, pool_class=WorkerPool, item_timeout=None,
+                node_timeout=None, metrics=None):
+    """
+    Applies all given nodes using a single pool of workers, yielding
+    these tuples as it goes along:
+
+        ('started', node, None)
+        ('finished', node, ApplyResult)
+        ('failed', node, WorkerException)
+
+    At most node_workers nodes are applied at the same time with at most
+    item_workers items being applied on each of them. Workers are never
+    idle while there is an item on any node they could apply.
+
+    See blockwart.node.apply_items() for item_timeout. node_timeout is
+    the number of seconds each node may take (starting when it is about
+    to be locked), after which all remaining items are skipped.
+
+    metrics is an optional blockwart.concurrency.PoolMetrics object
+    to collect the timings of the pool in.
+    """
+    runs = []
+    for node in nodes:
+        try:
+            runs.append(_NodeRun(
+                node,
+                force=force,
+                item_timeout=item_timeout,
+                timeout=node_timeout,
+            ))
+        except Exception as e:
+            yield ('failed', node, WorkerException(node.name, str(e), format_exc()))
+    runs_by_node_name = dict([(run.node.name, run) for run in runs])
+
+    # workers get their own copies of all runs and items when they are
+    # started, so tasks only need to tell them which one to use
+    objects = list(runs)
+    for run in runs:
+        objects.extend(run.graph.items)
+        run.node.repo.preload()
+
+    waiting = deque(runs)
+    active = deque()
+    # maps worker IDs to the runs of the nodes each worker is connected
+    # to, so they can disconnect once those nodes are done (otherwise
+    # every worker would stay connected to every node)
+    connected_runs = {}
+    try:
+        with pool_class(workers=workers, objects=objects, metrics=metrics) as worker_pool:
+            while worker_pool.keep_running():
+                try:
+                    msg = worker_pool.get_event()
+                except WorkerException as e:
+                    if e.task_id is None:
+                        # a worker died, we don't know what it was doing
+                        raise
+                    node_name, kind, item_id = e.task_id
+                    if kind == 'disconnect':
+                        LOG.debug(e.traceback)
+                        worker_pool.activate_idle_workers()
+                        continue
+                    run = runs_by_node_name[node_name]
+                    if run.task_failed(kind, item_id, e):
+                        active.remove(run)
+                        yield run.finish()
+                    worker_pool.activate_idle_workers()
+                    continue
+
+                if msg['msg'] == 'REQUEST_WORK':
+                    wid = msg['wid']
+                    done_runs = [
+                        run for run in connected_runs.get(wid, ())
+                        if run.state == 'done'
+                    ]
+                    if done_runs:
+                        run = done_runs[0]
+                        connected_runs[wid].remove(run)
+                        worker_pool.start_task(
+                            wid,
+                            run.disconnect,
+                            task_id=(run.node.name, 'disconnect', None),
+                        )
+                        continue
+                    next_task = _next_task(waiting, active, node_workers, item_workers)
+                    if next_task is not None:
+                        run, task = next_task
+                        target, task_id, kwargs, target_attrs, timeout, ready_since = task
+                        if task_id[1] == 'lock':
+                            yield ('started', run.node, None)
+                        connected_runs.setdefault(wid, set()).add(run)
+                        worker_pool.start_task(
+                            wid,
+                            target,
+                            task_id=task_id,
+                            kwargs=kwargs,
+                            target_attrs=target_attrs,
+                            timeout=timeout,
+                            ready_since=ready_since,
+                        )
+                    elif worker_pool.jobs_open > 0:
+                        # another worker might finish and make items
+                        # ready to be applied
+                        worker_pool.mark_idle(wid)
+                    else:
+                        # quitting closes all connections anyway
+                        worker_pool.quit(wid)
+
+                elif msg['msg'] == 'FINISHED_WORK':
+                    node_name, kind, item_id = msg['task_id']
+                    if kind != 'disconnect':
+                        run = runs_by_node_name[node_name]
+                        if run.task_finished(kind, item_id, msg['return_value']):
+                            active.remove(run)
+                            yield run.finish()
+                    worker_pool.activate_idle_workers()
+    finally:
+        # only nodes we couldn't finish are left here, their workers
+        # are gone by now
+        _release_locks(active)
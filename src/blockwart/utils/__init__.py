@@ -4,6 +4,8 @@ from inspect import isgenerator
 import logging
 import pstats
 
+from .depgraph import DependencyGraph
+
 __GETATTR_CACHE = {}
 __GETATTR_NODEFAULT = "very_unlikely_default_value"
 
@@ -117,9 +119,11 @@ def graph_for_items(
                  "style=\"rounded,filled\"]")
     yield "edge [arrowhead=vee]"
 
-    item_ids = []
-    for item in items:
-        item_ids.append(item.id)
+    if isinstance(items, DependencyGraph):
+        item_ids = items.index
+        items = items.items
+    else:
+        item_ids = set([item.id for item in items])
 
     if cluster:
         # Define which items belong to which bundle
@@ -151,12 +155,17 @@ def graph_for_items(
                 if dep in item_ids:
                     yield "\"{}\" -> \"{}\" [color=\"#C24948\",penwidth=2]".format(item.id, dep)
 
+        if concurrency:
+            for resource in sorted(item._concurrency_resources):
+                yield ("\"{}\" -> \"concurrency:{}\" "
+                       "[arrowhead=none,color=\"#714D99\",penwidth=2,style=dashed]").format(
+                    item.id,
+                    resource,
+                )
+
         if auto:
             for dep in item._deps:
-                if dep in item._concurrency_deps:
-                    if concurrency:
-                        yield "\"{}\" -> \"{}\" [color=\"#714D99\",penwidth=2]".format(item.id, dep)
-                elif dep in item._reverse_deps:
+                if dep in item._reverse_deps:
                     if reverse:
                         yield "\"{}\" -> \"{}\" [color=\"#D18C57\",penwidth=2]".format(item.id, dep)
                 elif dep not in item.NEEDS_STATIC and dep not in item.needs:
@@ -1,8 +1,18 @@
+import json
+
 from ..exceptions import NoSuchNode, NoSuchGroup, UsageException
 from . import names
 from .text import mark_for_translation as _
 
 
+def dump_metrics(metrics, path):
+    """
+    Writes the given blockwart.concurrency.PoolMetrics to a JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump(metrics.as_dict(), f, indent=4, sort_keys=True)
+
+
 def get_target_nodes(repo, target_string):
     """
     Returns a list of nodes. The input is a string like this:
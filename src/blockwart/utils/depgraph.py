@@ -0,0 +1,136 @@
+from array import array
+from copy import copy
+
+from .text import mark_for_translation as _
+
+
+class DependencyGraph(object):
+    """
+    A compact representation of the dependencies between a list of
+    items (as found in item._deps).
+
+    Items are numbered by their position in self.items. The
+    dependencies of all items are stored in a single flat array of item
+    numbers and a second array holds the offset at which the
+    dependencies of each item start ("compressed sparse row" format).
+    The items depending on each item are stored the same way.
+    Duplicate dependencies are only stored once.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self.index = {}
+        for position, item in enumerate(self.items):
+            self.index.setdefault(item.id, position)
+
+        self._dep_offsets = array('l', [0])
+        self._dep_targets = array('l')
+        dependent_counts = array('l', [0]) * len(self.items)
+        for item in self.items:
+            seen = set()
+            for dep in item._deps:
+                try:
+                    target = self.index[dep]
+                except KeyError:
+                    raise ValueError(_("item not found: {}").format(dep))
+                if target in seen:
+                    continue
+                seen.add(target)
+                self._dep_targets.append(target)
+                dependent_counts[target] += 1
+            self._dep_offsets.append(len(self._dep_targets))
+
+        self._dependent_offsets = array('l', [0])
+        for dependent_count in dependent_counts:
+            self._dependent_offsets.append(
+                self._dependent_offsets[-1] + dependent_count
+            )
+        next_slot = array('l', self._dependent_offsets[:-1])
+        self._dependent_targets = array('l', [0]) * len(self._dep_targets)
+        for position in xrange(len(self.items)):
+            for target in self.deps(position):
+                self._dependent_targets[next_slot[target]] = position
+                next_slot[target] += 1
+
+    def __len__(self):
+        return len(self.items)
+
+    def bind(self, items):
+        """
+        Returns a graph for another list of items with the same IDs in
+        the same order and the same dependencies. All internal arrays
+        are shared with this graph.
+        """
+        graph = copy(self)
+        graph.items = list(items)
+        return graph
+
+    def deps(self, position):
+        """
+        Returns the numbers of the items the given item depends on.
+        """
+        return self._dep_targets[
+            self._dep_offsets[position]:self._dep_offsets[position + 1]
+        ]
+
+    def dependents(self, position):
+        """
+        Returns the numbers of the items depending on the given item.
+        """
+        return self._dependent_targets[
+            self._dependent_offsets[position]:self._dependent_offsets[position + 1]
+        ]
+
+    def strongly_connected_components(self):
+        """
+        Returns the strongly connected components of the graph as lists
+        of item numbers (using Tarjan's algorithm without recursion, so
+        deep dependency chains won't hit the recursion limit).
+
+        Components are returned in reverse topological order: items only
+        depend on items in the same component or in components returned
+        earlier.
+        """
+        components = []
+        counter = 0
+        index = array('l', [-1]) * len(self.items)
+        lowlink = array('l', [-1]) * len(self.items)
+        on_stack = bytearray(len(self.items))
+        stack = []
+
+        for root in xrange(len(self.items)):
+            if index[root] != -1:
+                continue
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            path = [(root, iter(self.deps(root)))]
+
+            while path:
+                position, deps = path[-1]
+                for dep in deps:
+                    if index[dep] == -1:
+                        index[dep] = lowlink[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        on_stack[dep] = 1
+                        path.append((dep, iter(self.deps(dep))))
+                        break
+                    elif on_stack[dep]:
+                        lowlink[position] = min(lowlink[position], index[dep])
+                else:
+                    # all deps of this item have been visited
+                    path.pop()
+                    if path:
+                        parent = path[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[position])
+                    if lowlink[position] == index[position]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = 0
+                            component.append(member)
+                            if member == position:
+                                break
+                        components.append(component)
+        return components
@@ -0,0 +1,303 @@
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from os import close, pipe, read, write
+from Queue import Queue
+from select import select
+import sys
+from threading import Thread
+from time import time
+from traceback import format_exception
+
+from .text import mark_for_translation as _
+
+
+class Return(Exception):
+    """
+    Raised by a coroutine to return a value (generators can't return
+    values in Python 2).
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """
+    The result of an operation that hasn't necessarily finished yet.
+
+    Coroutines (generators run by a Task) yield futures to wait for
+    them. Callbacks added to a future are called by the event loop once
+    it is done.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.traceback = None
+        self._callbacks = []
+        self._done = False
+        self._exception = None
+        self._result = None
+
+    def add_done_callback(self, callback):
+        if self._done:
+            self.loop.call_soon(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def done(self):
+        return self._done
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError(_("future isn't done yet"))
+        return self._exception
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError(_("future isn't done yet"))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def set_exception(self, exception, traceback=None):
+        self._exception = exception
+        self.traceback = traceback
+        self._finish()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            raise RuntimeError(_("future is already done"))
+        self._done = True
+        for callback in self._callbacks:
+            self.loop.call_soon(callback, self)
+        self._callbacks = []
+
+
+class Task(Future):
+    """
+    Runs a coroutine: a generator yielding futures. The coroutine is
+    resumed with the result of each future once it is done (or the
+    exception is raised inside the coroutine). The task itself is done
+    once the generator is exhausted or raises Return.
+    """
+    def __init__(self, loop, coroutine):
+        Future.__init__(self, loop)
+        self.coroutine = coroutine
+        loop.call_soon(self._step)
+
+    def _step(self, future=None):
+        try:
+            if future is None:
+                yielded = self.coroutine.send(None)
+            elif future._exception is not None:
+                yielded = self.coroutine.throw(future._exception)
+            else:
+                yielded = self.coroutine.send(future._result)
+        except StopIteration:
+            self.set_result(None)
+        except Return as r:
+            self.set_result(r.value)
+        except Exception as e:
+            self.set_exception(e, "".join(format_exception(*sys.exc_info())))
+        else:
+            if not isinstance(yielded, Future):
+                self.coroutine.close()
+                self.set_exception(TypeError(_(
+                    "coroutines must yield futures, got: {}"
+                ).format(repr(yielded))))
+            else:
+                yielded.add_done_callback(self._step)
+
+
+class EventLoop(object):
+    """
+    Runs callbacks, timers and coroutines in a single thread.
+
+    Blocking functions can be run with run_in_executor(), which uses a
+    pool of at most executor_threads threads (started as needed).
+    """
+    def __init__(self, executor_threads=4):
+        if executor_threads < 1:
+            raise ValueError(_("at least one executor thread is required"))
+        self.executor_threads = executor_threads
+        # number of functions passed to run_in_executor() that haven't
+        # returned yet (only touched by the loop's thread)
+        self._executor_jobs = 0
+        self._executor_queue = Queue()
+        self._executor_workers = []
+        self._ready = deque()
+        self._sequence = count()
+        self._threadsafe = deque()
+        self._timers = []
+        self._wakeup_read, self._wakeup_write = pipe()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def call_later(self, delay, callback, *args):
+        heappush(
+            self._timers,
+            (time() + delay, next(self._sequence), callback, args),
+        )
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Like call_soon(), but may be called from any thread.
+        """
+        self._threadsafe.append((callback, args))
+        write(self._wakeup_write, b"\0")
+
+    def close(self):
+        for worker in self._executor_workers:
+            self._executor_queue.put(None)
+        for worker in self._executor_workers:
+            worker.join()
+        self._executor_workers = []
+        if self._wakeup_read is not None:
+            close(self._wakeup_read)
+            close(self._wakeup_write)
+            self._wakeup_read = self._wakeup_write = None
+
+    def create_task(self, coroutine):
+        return Task(self, coroutine)
+
+    def run_in_executor(self, func, *args, **kwargs):
+        """
+        Calls func in one of the executor threads and returns a future
+        for its return value.
+        """
+        future = Future(self)
+        self._executor_jobs += 1
+        if (
+            self._executor_jobs > len(self._executor_workers) and
+            len(self._executor_workers) < self.executor_threads
+        ):
+            # all threads are busy
+            worker = Thread(target=self._executor_worker)
+            worker.daemon = True
+            worker.start()
+            self._executor_workers.append(worker)
+        self._executor_queue.put((future, func, args, kwargs))
+        return future
+
+    def run_until_complete(self, future):
+        """
+        Runs the loop until the given future (or coroutine, which will be
+        wrapped in a Task) is done and returns its result.
+        """
+        if not isinstance(future, Future):
+            future = self.create_task(future)
+        while not future.done():
+            self._run_once()
+        return future.result()
+
+    def _executor_worker(self):
+        while True:
+            job = self._executor_queue.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.call_soon_threadsafe(
+                    self._executor_job_done,
+                    future.set_exception,
+                    e,
+                    "".join(format_exception(*sys.exc_info())),
+                )
+            else:
+                self.call_soon_threadsafe(
+                    self._executor_job_done,
+                    future.set_result,
+                    result,
+                )
+
+    def _executor_job_done(self, finish, *args):
+        self._executor_jobs -= 1
+        finish(*args)
+
+    def _run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time())
+        else:
+            timeout = None
+        readable, writable, exceptional = select(
+            [self._wakeup_read], [], [], timeout,
+        )
+        if readable:
+            read(self._wakeup_read, 4096)
+        while self._threadsafe:
+            self._ready.append(self._threadsafe.popleft())
+
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            when, sequence, callback, args = heappop(self._timers)
+            self._ready.append((callback, args))
+
+        # callbacks scheduled by these callbacks will run next time
+        for i in xrange(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+
+class CompletionQueue(object):
+    """
+    Collects futures and hands them back once they are done.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = []
+        self._pending = 0
+        self._waiter = None
+
+    def __len__(self):
+        return self._pending + len(self._done)
+
+    def add(self, future):
+        self._pending += 1
+        future.add_done_callback(self._future_done)
+
+    def get(self):
+        """
+        Returns a future for the list of futures that are done (but
+        haven't been returned before) as soon as there is at least one.
+        """
+        waiter = Future(self.loop)
+        if self._done:
+            waiter.set_result(self._take())
+        else:
+            self._waiter = waiter
+        return waiter
+
+    def _future_done(self, future):
+        self._pending -= 1
+        self._done.append(future)
+        if self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            waiter.set_result(self._take())
+
+    def _take(self):
+        done, self._done = self._done, []
+        return done
+
+
+def sleep(loop, delay, result=None):
+    """
+    Returns a future that will be done after delay seconds.
+    """
+    future = Future(loop)
+    loop.call_later(delay, future.set_result, result)
+    return future
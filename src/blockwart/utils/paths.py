@@ -0,0 +1,69 @@
+from os.path import normpath
+
+from .text import mark_for_translation as _
+
+PATH_ITEM_TYPES = ("directory", "file", "symlink")
+
+
+def _path_components(path):
+    """
+    Splits a path into its components. Two paths have the same
+    relationship as checked by blockwart.utils.text.is_subdirectory()
+    if the components of one are a prefix of the components of the
+    other.
+    """
+    path = normpath(path)
+    if not path.startswith("/"):
+        raise ValueError(_("directory paths must be absolute"))
+    if path == "/":
+        return []
+    return path.split("/")[1:]
+
+
+class _PathTrieNode(object):
+    __slots__ = ('children', 'items')
+
+    def __init__(self):
+        self.children = {}
+        self.items = []
+
+
+class PathIndex(object):
+    """
+    A trie of all directory, file and symlink items in a list of items,
+    keyed by path components. Looking up the items on the path to a
+    given path takes time proportional to the depth of that path rather
+    than the number of items.
+    """
+    def __init__(self, items):
+        self.root = _PathTrieNode()
+        for position, item in enumerate(items):
+            if item.ITEM_TYPE_NAME not in PATH_ITEM_TYPES:
+                continue
+            node = self.root
+            for component in _path_components(item.name):
+                node = node.children.setdefault(component, _PathTrieNode())
+            node.items.append((position, item))
+
+    def items_on_path(self, path, parent_types, path_types=()):
+        """
+        Returns all items of parent_types located in a parent directory
+        of the given path and all items of path_types located at the
+        given path itself. Items are returned in the order they appeared
+        in the list this index was built from.
+        """
+        found = []
+        node = self.root
+        for component in _path_components(path):
+            for position, item in node.items:
+                if item.ITEM_TYPE_NAME in parent_types:
+                    found.append((position, item))
+            node = node.children.get(component)
+            if node is None:
+                break
+        else:
+            for position, item in node.items:
+                if item.ITEM_TYPE_NAME in path_types:
+                    found.append((position, item))
+        return [item for position, item in sorted(found)]
+
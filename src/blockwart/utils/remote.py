@@ -1,5 +1,6 @@
 from pipes import quote
 
+from ..exceptions import RemoteException
 from . import cached_property, LOG
 from .text import mark_for_translation as _
 
@@ -18,23 +19,22 @@ def _parse_file_output(file_output):
         return ('file', file_output)
 
 
-def get_path_type(node, path):
-    """
-    Returns (TYPE, DESC) where TYPE is one of:
+def _file_command(path):
+    return "file -bh -- {}".format(quote(path))
 
-        'directory', 'file', 'nonexistent', 'other', 'symlink'
 
-    and DESC is the output of the 'file' command line utility.
-    """
-    result = node.run("file -bh -- {}".format(quote(path)), may_fail=True)
+def _file_result(result):
     if result.return_code != 0:
         return ('nonexistent', "")
     file_output = result.stdout.strip()
     return _parse_file_output(file_output)
 
 
-def stat(node, path):
-    result = node.run("stat --printf '%U:%G:%a:%s' -- {}".format(quote(path)))
+def _stat_command(path):
+    return "stat --printf '%U:%G:%a:%s' -- {}".format(quote(path))
+
+
+def _stat_result(node, path, result):
     owner, group, mode, size = result.stdout.split(":")
     mode = mode.zfill(4)
     file_stat = {
@@ -51,15 +51,64 @@ def stat(node, path):
     return file_stat
 
 
+def get_path_info(node, path, sha1=False):
+    """
+    Returns (TYPE, DESC, STAT, SHA1) for the given path, using only a
+    single round trip to the node. See get_path_type() and stat().
+
+    SHA1 is the hash of the file if it is a regular file and sha1 is
+    True, otherwise None.
+    """
+    commands = [_file_command(path), _stat_command(path)]
+    if sha1:
+        commands.append("test -f {path} && ! test -L {path} && sha1sum -- {path}".format(
+            path=quote(path),
+        ))
+    results = node.run_many(commands, may_fail=True)
+
+    path_type, desc = _file_result(results[0])
+    if path_type == 'nonexistent':
+        return (path_type, desc, {}, None)
+    if results[1].return_code != 0:
+        raise RemoteException(_("stat for '{path}' on {node} failed: {error}").format(
+            error=results[1].stderr,
+            node=node.name,
+            path=path,
+        ))
+    file_stat = _stat_result(node, path, results[1])
+    file_hash = None
+    if sha1 and path_type == 'file' and results[2].return_code == 0:
+        file_hash = results[2].stdout.strip().split()[0]
+    return (path_type, desc, file_stat, file_hash)
+
+
+def get_path_type(node, path):
+    """
+    Returns (TYPE, DESC) where TYPE is one of:
+
+        'directory', 'file', 'nonexistent', 'other', 'symlink'
+
+    and DESC is the output of the 'file' command line utility.
+    """
+    return _file_result(node.run(_file_command(path), may_fail=True))
+
+
+def stat(node, path):
+    return _stat_result(node, path, node.run(_stat_command(path)))
+
+
 class PathInfo(object):
     """
-    Serves as a proxy to get_path_type.
+    Serves as a proxy to get_path_info.
+
+    If sha1 is True, the hash of the file is fetched right away instead
+    of in another round trip when it is first needed.
     """
-    def __init__(self, node, path):
+    def __init__(self, node, path, sha1=False):
         self.node = node
         self.path = path
-        self.path_type, self.desc = get_path_type(node, path)
-        self.stat = stat(node, path) if self.path_type != 'nonexistent' else {}
+        self.path_type, self.desc, self.stat, self._prefetched_sha1 = \
+            get_path_info(node, path, sha1=sha1)
 
     def __repr__(self):
         return "<PathInfo for {}:{}>".format(self.node.name, quote(self.path))
@@ -105,6 +154,8 @@ class PathInfo(object):
 
     @cached_property
     def sha1(self):
+        if self._prefetched_sha1 is not None:
+            return self._prefetched_sha1
         result = self.node.run("sha1sum -- " + quote(self.path))
         return result.stdout.strip().split()[0]
 
@@ -1,7 +1,7 @@
 from datetime import datetime
 from unittest import TestCase
 
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from blockwart.cmdline.apply import bw_apply, format_node_result
 from blockwart.node import ApplyResult
@@ -10,7 +10,7 @@ from blockwart.node import ApplyResult
 class FakeNode(object):
     name = "nodename"
 
-    def apply(self, interactive=False, workers=4, force=False):
+    def apply(self, interactive=False, workers=4, force=False, pool_class=None):
         assert interactive
         result = ApplyResult(self, ())
         result.start = datetime(2013, 8, 10, 0, 0)
@@ -29,6 +29,8 @@ class ApplyTest(TestCase):
         args = MagicMock()
         args.force = False
         args.interactive = True
+        args.item_threads = False
+        args.metrics_file = None
         args.item_workers = 4
         args.target = "node1"
         output = list(bw_apply(repo, args))
@@ -37,6 +39,33 @@ class ApplyTest(TestCase):
         self.assertTrue(output[1].endswith("(0 OK, 0 fixed, 0 skipped, 0 failed)\n"))
         self.assertEqual(len(output), 2)
 
+    @patch('blockwart.cmdline.apply.apply_nodes')
+    def test_noninteractive(self, apply_nodes):
+        node1 = FakeNode()
+        exception = MagicMock()
+        exception.wrapped_exception = "wrapped"
+        apply_nodes.return_value = [
+            ('started', node1, None),
+            ('failed', node1, exception),
+        ]
+        repo = MagicMock()
+        repo.get_node.return_value = node1
+        args = MagicMock()
+        args.debug = False
+        args.force = False
+        args.interactive = False
+        args.item_threads = False
+        args.metrics_file = None
+        args.target = "node1"
+        args.total_workers = 16
+        output = list(bw_apply(repo, args))
+        self.assertEqual(output, ["nodename: ! wrapped"])
+        self.assertEqual(apply_nodes.call_args[1]['workers'], 16)
+        self.assertIs(
+            repo.hooks.apply_end.call_args[1]['metrics'],
+            apply_nodes.call_args[1]['metrics'],
+        )
+
 
 class FormatNodeItemResultTest(TestCase):
     """
@@ -160,15 +160,13 @@ class PlotTest(TestCase):
 
 class FakeNode(object):
     name = "nodename"
+    items = ()
+    repo = MagicMock()
 
-    def test(self, workers=4):
-        return
 
-
-class FailNode(object):
-    name = "nodename"
-
-    def test(self, workers=4):
+class FailNode(FakeNode):
+    @property
+    def items(self):
         raise RuntimeError("I accidentally")
 
 
@@ -195,5 +193,7 @@ class TestTest(TestCase):
         args.item_workers = 4
         args.node_workers = 1
         args.target = "node1"
-        list(repo.bw_repo_test(repo_obj, args))
+        output = list(repo.bw_repo_test(repo_obj, args))
+        self.assertTrue(output[0].endswith(" nodename\n"))
+        self.assertIn("I accidentally", output[1])
         exit.assert_called_once_with(1)
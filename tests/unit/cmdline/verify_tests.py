@@ -1,26 +1,30 @@
 from unittest import TestCase
 
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from blockwart.cmdline import verify
+from blockwart.exceptions import WorkerException
 
 
-class FakeNode(object):
-    name = "nodename"
-
-    def verify(self, workers=4):
-        return ()
-
-
-class ApplyTest(TestCase):
+class VerifyTest(TestCase):
     """
     Tests blockwart.cmdline.verify.bw_verify.
     """
-    def test_interactive(self):
-        node1 = FakeNode()
+    @patch('blockwart.cmdline.verify.verify_nodes')
+    def test_errors(self, verify_nodes):
+        verify_nodes.return_value = [
+            WorkerException("nodename:type1:item1", "failed", "traceback"),
+        ]
         repo = MagicMock()
-        repo.get_node.return_value = node1
+        repo.get_node.return_value = "node"
         args = MagicMock()
+        args.debug = False
+        args.item_threads = False
+        args.metrics_file = None
         args.item_workers = 4
+        args.node_workers = 2
         args.target = "node1"
-        verify.bw_verify(repo, args)
+        output = list(verify.bw_verify(repo, args))
+        self.assertEqual(output, ["! nodename:type1:item1: failed"])
+        self.assertEqual(verify_nodes.call_args[0][0], ["node"])
+        self.assertEqual(verify_nodes.call_args[1]['workers'], 8)
@@ -0,0 +1,333 @@
+from logging import DEBUG, ERROR, Handler, INFO, WARNING
+from threading import Event
+from time import sleep, time
+from unittest import TestCase
+
+from blockwart import concurrency
+from blockwart.concurrency import ChildLogHandler, PoolMetrics, ThreadPool, WorkerPool
+from blockwart.exceptions import TaskTimeoutException
+from blockwart.utils import LOG
+
+
+class FakePipe(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class ListHandler(Handler):
+    def __init__(self):
+        Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Logger(object):
+    def log(self):
+        LOG.debug("debug %s", "message")
+        LOG.warning("warning %s", "message")
+        try:
+            raise ValueError("error")
+        except ValueError:
+            LOG.exception("exception")
+
+    def hang(self):
+        LOG.warning("hanging")
+        sleep(5)
+
+
+class Sleeper(object):
+    def sleep(self, seconds):
+        sleep(seconds)
+        return seconds
+
+
+class Gate(object):
+    def __init__(self):
+        self.opened = Event()
+
+    def wait(self):
+        self.opened.wait(5)
+
+
+class RacingThreadPool(ThreadPool):
+    """
+    Lets the timed out task finish right before its worker is replaced.
+    """
+    def _replace_worker(self, wid):
+        self.objects[0].opened.set()
+        # give the thread a chance to report its task as finished
+        for i in range(20):
+            if self.messages:
+                break
+            sleep(0.01)
+        ThreadPool._replace_worker(self, wid)
+
+
+class ChildLogHandlerTest(TestCase):
+    """
+    Tests blockwart.concurrency.ChildLogHandler.
+    """
+    def test_batch(self):
+        pipe = FakePipe()
+        handler = ChildLogHandler(pipe)
+        LOG.addHandler(handler)
+        level = LOG.level
+        LOG.setLevel(DEBUG)
+        try:
+            for i in range(concurrency.LOG_BATCH_SIZE + 1):
+                LOG.debug("message %d", i)
+        finally:
+            LOG.removeHandler(handler)
+            LOG.setLevel(level)
+        self.assertEqual(len(pipe.sent), 1)
+        self.assertEqual(pipe.sent[0]['msg'], 'LOG_ENTRIES')
+        self.assertEqual(len(pipe.sent[0]['log_entries']), concurrency.LOG_BATCH_SIZE)
+        self.assertEqual(pipe.sent[0]['log_entries'][1][2], "message 1")
+
+        handler.send({'msg': 'REQUEST_WORK'})
+        self.assertEqual(pipe.sent[1]['msg'], 'REQUEST_WORK')
+        self.assertEqual(len(pipe.sent[1]['log_entries']), 1)
+
+        handler.send({'msg': 'REQUEST_WORK'})
+        self.assertEqual(pipe.sent[2]['log_entries'], [])
+
+    def test_stop(self):
+        pipe = FakePipe()
+        handler = ChildLogHandler(pipe)
+        LOG.addHandler(handler)
+        level = LOG.level
+        LOG.setLevel(DEBUG)
+        try:
+            LOG.debug("message")
+            handler.stop()
+            LOG.debug("too late")
+            handler.flush()
+        finally:
+            LOG.removeHandler(handler)
+            LOG.setLevel(level)
+        self.assertEqual(len(pipe.sent), 1)
+        self.assertEqual(pipe.sent[0]['log_entries'][0][2], "message")
+
+    def test_timer(self):
+        pipe = FakePipe()
+        handler = ChildLogHandler(pipe)
+        LOG.addHandler(handler)
+        level = LOG.level
+        LOG.setLevel(DEBUG)
+        try:
+            handler.start_timer()
+            LOG.debug("message")
+            sleep(concurrency.LOG_BATCH_INTERVAL * 5)
+        finally:
+            handler.stop()
+            LOG.removeHandler(handler)
+            LOG.setLevel(level)
+        self.assertEqual(len(pipe.sent), 1)
+        self.assertEqual(pipe.sent[0]['msg'], 'LOG_ENTRIES')
+        self.assertEqual(pipe.sent[0]['log_entries'][0][2], "message")
+
+
+class WorkerPoolLogTest(TestCase):
+    """
+    Tests log records sent by workers of blockwart.concurrency.WorkerPool.
+    """
+    def test_threshold(self):
+        handler = ListHandler()
+        LOG.addHandler(handler)
+        level = LOG.level
+        LOG.setLevel(INFO)
+        try:
+            logger = Logger()
+            with WorkerPool(workers=1, objects=[logger]) as worker_pool:
+                started = False
+                while worker_pool.keep_running():
+                    msg = worker_pool.get_event()
+                    if msg['msg'] == 'REQUEST_WORK':
+                        if not started:
+                            worker_pool.start_task(msg['wid'], logger.log)
+                            started = True
+                        else:
+                            worker_pool.quit(msg['wid'])
+        finally:
+            LOG.removeHandler(handler)
+            LOG.setLevel(level)
+        self.assertEqual(
+            [(record.levelno, record.getMessage()) for record in handler.records],
+            [(WARNING, "warning message"), (ERROR, "exception")],
+        )
+        self.assertIn("ValueError: error", handler.records[1].exc_text)
+
+    def test_timeout(self):
+        handler = ListHandler()
+        LOG.addHandler(handler)
+        level = LOG.level
+        LOG.setLevel(INFO)
+        # the timer won't help, so this relies on the worker sending
+        # its logs when it is terminated
+        interval = concurrency.LOG_BATCH_INTERVAL
+        concurrency.LOG_BATCH_INTERVAL = 60
+        timed_out = []
+        try:
+            logger = Logger()
+            with WorkerPool(workers=1, objects=[logger]) as worker_pool:
+                started = False
+                while worker_pool.keep_running():
+                    try:
+                        msg = worker_pool.get_event()
+                    except TaskTimeoutException as e:
+                        timed_out.append(e.task_id)
+                        continue
+                    if msg['msg'] == 'REQUEST_WORK':
+                        if not started:
+                            worker_pool.start_task(
+                                msg['wid'],
+                                logger.hang,
+                                task_id="hang",
+                                timeout=0.2,
+                            )
+                            started = True
+                        else:
+                            worker_pool.quit(msg['wid'])
+        finally:
+            concurrency.LOG_BATCH_INTERVAL = interval
+            LOG.removeHandler(handler)
+            LOG.setLevel(level)
+        self.assertEqual(timed_out, ["hang"])
+        self.assertEqual(
+            [(record.levelno, record.getMessage()) for record in handler.records],
+            [(WARNING, "hanging")],
+        )
+
+
+class TimeoutTest(TestCase):
+    """
+    Tests timeouts passed to blockwart.concurrency.WorkerPool.start_task.
+    """
+    def _run(self, pool_class):
+        sleeper = Sleeper()
+        tasks = [("slow", 5), ("fast", 0)]
+        finished = []
+        timed_out = []
+        with pool_class(workers=1, objects=[sleeper]) as worker_pool:
+            while worker_pool.keep_running():
+                try:
+                    msg = worker_pool.get_event()
+                except TaskTimeoutException as e:
+                    timed_out.append(e.task_id)
+                    continue
+                if msg['msg'] == 'REQUEST_WORK':
+                    if tasks:
+                        task_id, seconds = tasks.pop(0)
+                        worker_pool.start_task(
+                            msg['wid'],
+                            sleeper.sleep,
+                            task_id=task_id,
+                            args=(seconds,),
+                            timeout=0.2,
+                        )
+                    else:
+                        worker_pool.quit(msg['wid'])
+                elif msg['msg'] == 'FINISHED_WORK':
+                    finished.append(msg['task_id'])
+        self.assertEqual(timed_out, ["slow"])
+        # the worker has been replaced by one that can do more work
+        self.assertEqual(finished, ["fast"])
+
+    def test_processes(self):
+        self._run(WorkerPool)
+
+    def test_threads(self):
+        self._run(ThreadPool)
+
+    def test_finished_while_expiring(self):
+        gate = Gate()
+        tasks = ["slow", "fast"]
+        finished = []
+        timed_out = []
+        with RacingThreadPool(workers=1) as worker_pool:
+            worker_pool.objects = [gate]
+            while worker_pool.keep_running():
+                try:
+                    msg = worker_pool.get_event()
+                except TaskTimeoutException as e:
+                    timed_out.append(e.task_id)
+                    continue
+                if msg['msg'] == 'REQUEST_WORK':
+                    if tasks:
+                        task_id = tasks.pop(0)
+                        worker_pool.start_task(
+                            msg['wid'],
+                            gate.wait,
+                            task_id=task_id,
+                            timeout=0.2 if task_id == "slow" else None,
+                        )
+                    else:
+                        worker_pool.quit(msg['wid'])
+                elif msg['msg'] == 'FINISHED_WORK':
+                    finished.append(msg['task_id'])
+                self.assertGreaterEqual(worker_pool.jobs_open, 0)
+        self.assertEqual(timed_out, ["slow"])
+        self.assertEqual(finished, ["fast"])
+
+
+class PoolMetricsTest(TestCase):
+    """
+    Tests blockwart.concurrency.PoolMetrics.
+    """
+    def _run(self, pool_class, metrics):
+        sleeper = Sleeper()
+        tasks = [0.05, 0.05, 0.05]
+        # all tasks are ready right away
+        start = time()
+        with pool_class(workers=2, objects=[sleeper], metrics=metrics) as worker_pool:
+            while worker_pool.keep_running():
+                msg = worker_pool.get_event()
+                if msg['msg'] == 'REQUEST_WORK':
+                    if tasks:
+                        worker_pool.start_task(
+                            msg['wid'],
+                            sleeper.sleep,
+                            task_id=len(tasks),
+                            args=(tasks.pop(),),
+                            ready_since=start,
+                        )
+                    elif worker_pool.jobs_open:
+                        worker_pool.mark_idle(msg['wid'])
+                    else:
+                        worker_pool.quit(msg['wid'])
+                elif msg['msg'] == 'FINISHED_WORK':
+                    worker_pool.activate_idle_workers()
+
+    def test_metrics(self):
+        for pool_class in (ThreadPool, WorkerPool):
+            metrics = PoolMetrics()
+            self._run(pool_class, metrics)
+            summary = metrics.as_dict()
+            self.assertEqual(
+                sorted([task['task_id'] for task in summary['tasks']]),
+                [1, 2, 3],
+            )
+            for task in summary['tasks']:
+                self.assertGreaterEqual(task['run'], 0.05)
+                self.assertGreaterEqual(task['idle'], 0)
+            # with 2 workers, one of the tasks had to wait for another
+            self.assertGreaterEqual(
+                max([task['queued'] for task in summary['tasks']]),
+                0.05,
+            )
+            self.assertEqual(
+                sum([worker['tasks'] for worker in summary['workers'].values()]),
+                3,
+            )
+            busy = sum([worker['busy'] for worker in summary['workers'].values()])
+            self.assertGreaterEqual(busy, 0.15)
+            self.assertTrue(0 < summary['utilization'] <= 1)
+            # 3 FINISHED_WORK, 3 + 2 REQUEST_WORK
+            self.assertGreaterEqual(summary['messages'], 8)
+            self.assertGreaterEqual(summary['duration'], 0.1)
+            self.assertIsNotNone(metrics.end)
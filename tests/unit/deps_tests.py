@@ -1,10 +1,14 @@
+from threading import Thread
 from unittest import TestCase
 
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from blockwart import deps
-from blockwart.exceptions import BundleError
+from blockwart.exceptions import BundleError, ItemDependencyError
 from blockwart.items import Item
+from blockwart.items.actions import Action
+from blockwart.items.directories import Directory
+from blockwart.utils.paths import PathIndex
 
 
 class MockItem(Item):
@@ -20,42 +24,112 @@ class MockItem(Item):
         }
 
 
-class FlattenDependenciesTest(TestCase):
+class CheckBundleCollisionsTest(TestCase):
     """
-    Tests blockwart.deps._flatten_dependencies.
+    Tests blockwart.deps._check_bundle_collisions.
     """
-    def test_flatten(self):
-        class FakeItem(object):
-            pass
+    def _make_item(self, item_id, bundle_name):
+        item = MagicMock()
+        item.id = item_id
+        item.bundle.name = bundle_name
+        return item
+
+    def test_collision(self):
+        item1 = self._make_item("type1:name1", "bundle1")
+        item2 = self._make_item("type1:name1", "bundle2")
+        with self.assertRaises(BundleError) as cm:
+            deps._check_bundle_collisions([item1, item2])
+        self.assertEqual(
+            str(cm.exception),
+            "duplicate definition of type1:name1 in bundles 'bundle1' and 'bundle2'",
+        )
 
-        def make_item(item_id):
-            item = FakeItem()
-            item._deps = []
-            item.id = item_id
-            return item
+    def test_multiple_collisions(self):
+        items = [
+            self._make_item("type1:name1", "bundle1"),
+            self._make_item("type1:name2", "bundle1"),
+            self._make_item("type1:name1", "bundle2"),
+            self._make_item("type1:name2", "bundle3"),
+        ]
+        with self.assertRaises(BundleError) as cm:
+            deps._check_bundle_collisions(items)
+        self.assertEqual(
+            str(cm.exception),
+            "duplicate definition of type1:name1 in bundles 'bundle1' and 'bundle2'\n"
+            "duplicate definition of type1:name2 in bundles 'bundle1' and 'bundle3'",
+        )
+
+    def test_no_collision(self):
+        deps._check_bundle_collisions([
+            self._make_item("type1:name1", "bundle1"),
+            self._make_item("type1:name2", "bundle1"),
+        ])
+
+
+class CheckLoopsTest(TestCase):
+    """
+    Tests blockwart.deps._check_loops.
+    """
+    def test_no_loop(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {'needs': ["mock:name2"]})
+        item2 = MockItem(bundle, "name2", {})
+        deps.prepare_dependencies([item1, item2])
+
+    def test_regular_loop(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {'needs': ["mock:name2"]})
+        item2 = MockItem(bundle, "name2", {'needs': ["mock:name1"]})
+        item3 = MockItem(bundle, "name3", {'needs': ["mock:name1"]})
+        with self.assertRaises(ItemDependencyError) as cm:
+            deps.prepare_dependencies([item1, item2, item3])
+        self.assertEqual(
+            str(cm.exception),
+            "loop in dependencies between these items: mock:name1, mock:name2\n"
+            "  mock:name1 -> mock:name2 (regular)\n"
+            "  mock:name2 -> mock:name1 (regular)",
+        )
+
+    def test_edge_types(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {
+            'needed_by': ["mock:name2"],
+            'triggered': True,
+        })
+        item2 = MockItem(bundle, "name2", {'triggers': ["mock:name1"]})
+        with self.assertRaises(ItemDependencyError) as cm:
+            deps.prepare_dependencies([item1, item2])
+        self.assertEqual(
+            str(cm.exception),
+            "loop in dependencies between these items: mock:name1, mock:name2\n"
+            "  mock:name1 -> mock:name2 (trigger)\n"
+            "  mock:name2 -> mock:name1 (reverse)",
+        )
 
-        item1 = make_item("type1:name1")
-        item2 = make_item("type1:name2")
-        item3 = make_item("type2:name1")
-        item3._deps = ["type1:"]
-        item4 = make_item("type3:name1")
-        item4._deps = ["type2:name1"]
-        item5 = make_item("type1:")
-        item5._deps = ["type1:name1", "type1:name2"]
-        items = [item1, item2, item3, item4, item5]
-
-        items = deps._flatten_dependencies(items)
-
-        deps_should = {
-            item1: [],
-            item2: [],
-            item3: ["type1:", "type1:name1", "type1:name2"],
-            item4: ["type1:", "type1:name1", "type1:name2", "type2:name1"],
-            item5: ["type1:name1", "type1:name2"],
-        }
 
-        for item in items:
-            self.assertEqual(set(item._flattened_deps), set(deps_should[item]))
+class FindItemTest(TestCase):
+    """
+    Tests blockwart.deps.find_item.
+    """
+    def test_list(self):
+        item1 = MagicMock()
+        item1.id = "type1:name1"
+        item2 = MagicMock()
+        item2.id = "type1:name2"
+        self.assertEqual(deps.find_item("type1:name2", [item1, item2]), item2)
+
+    def test_index(self):
+        item1 = MagicMock()
+        item1.id = "type1:name1"
+        item2 = MagicMock()
+        item2.id = "type1:name1"
+        item_index = deps.index_items([item1, item2])
+        self.assertEqual(item_index, {"type1:name1": item1})
+        self.assertEqual(deps.find_item("type1:name1", item_index), item1)
+
+    def test_not_found(self):
+        with self.assertRaises(ValueError):
+            deps.find_item("type1:name1", {})
 
 
 class InjectCannedActionsTest(TestCase):
@@ -142,11 +216,11 @@ class InjectDummyItemsTest(TestCase):
         self.assertEqual(dummy_counter, 3)
 
 
-class InjectConcurrencyBlockersTest(TestCase):
+class InjectConcurrencyResourcesTest(TestCase):
     """
-    Tests blockwart.deps._inject_concurrency_blockers.
+    Tests blockwart.deps._inject_concurrency_resources.
     """
-    def test_blockers(self):
+    def test_resources(self):
         class FakeItem1(object):
             BLOCK_CONCURRENT = []
             ITEM_TYPE_NAME = 'type1'
@@ -159,11 +233,13 @@ class InjectConcurrencyBlockersTest(TestCase):
             BLOCK_CONCURRENT = []
             ITEM_TYPE_NAME = 'type3'
 
+        class FakeItem4(object):
+            BLOCK_CONCURRENT = ['type4']
+            ITEM_TYPE_NAME = 'type4'
 
         def make_item(cls, item_id):
             item = cls()
             item._deps = []
-            item._flattened_deps = []
             item.id = item_id
             return item
 
@@ -171,27 +247,30 @@ class InjectConcurrencyBlockersTest(TestCase):
         item12 = make_item(FakeItem1, "type1:name2")
         item21 = make_item(FakeItem2, "type2:name1")
         item22 = make_item(FakeItem2, "type2:name2")
-        item23 = make_item(FakeItem2, "type2:name3")
         item31 = make_item(FakeItem3, "type3:name1")
-        item32 = make_item(FakeItem3, "type3:name2")
-
-        items = [item11, item32, item22, item12, item21, item23, item31]
-        injected = deps._inject_concurrency_blockers(items)
-
-        deps_should = {
-            item11: [],
-            item32: [],
-            item22: ["type3:name2"],
-            item12: [],
-            item21: ["type2:name2"],
-            item23: ["type2:name1"],
-            item31: ["type2:name3"],
+        item41 = make_item(FakeItem4, "type4:name1")
+        item42 = make_item(FakeItem4, "type4:name2")
+        dummy = deps.DummyItem("type2")
+
+        items = [item11, item22, item12, item21, item31, item41, item42, dummy]
+        injected = deps._inject_concurrency_resources(items)
+
+        resources_should = {
+            item11: set(),
+            item12: set(),
+            item21: set(["type2"]),
+            item22: set(["type2"]),
+            item31: set(["type2"]),
+            item41: set(["type4"]),
+            item42: set(["type4"]),
+            dummy: set(),
         }
 
-        self.assertEqual(len(injected), len(items))
+        self.assertEqual(injected, items)
 
         for item in injected:
-            self.assertEqual(item._deps, deps_should[item])
+            self.assertEqual(item._concurrency_resources, resources_should[item])
+            self.assertEqual(item._deps, [])
 
     def test_noop(self):
         class FakeItem(object):
@@ -205,114 +284,241 @@ class InjectConcurrencyBlockersTest(TestCase):
             item.id = item_id
             return item
 
-        item11 = make_item("type1:name1")
-        item12 = make_item("type1:name2")
-        item21 = make_item("type2:name1")
-        item22 = make_item("type2:name2")
-        item23 = make_item("type2:name3")
-        item31 = make_item("type3:name1")
-        item32 = make_item("type3:name2")
-
-        items = [item11, item32, item22, item12, item21, item23, item31]
-        injected = deps._inject_concurrency_blockers(items)
-
-        deps_should = {
-            item11: [],
-            item32: [],
-            item22: [],
-            item12: [],
-            item21: [],
-            item23: [],
-            item31: [],
-        }
-
-        self.assertEqual(len(injected), len(items))
+        items = [
+            make_item("type1:name1"),
+            make_item("type1:name2"),
+            make_item("type2:name1"),
+        ]
+        injected = deps._inject_concurrency_resources(items)
 
         for item in injected:
-            self.assertEqual(item._deps, deps_should[item])
+            self.assertEqual(item._concurrency_resources, set())
 
 
-class ItemSplitWithoutDepTest(TestCase):
+class InjectReverseDependenciesTest(TestCase):
     """
-    Tests blockwart.deps.split_items_without_deps.
+    Tests blockwart.deps._inject_reverse_dependencies.
     """
-    def test_all_deps(self):
-        class FakeItem(object):
-            pass
-        item1 = FakeItem()
-        item1._deps = ["type1:name1"]
-        item2 = FakeItem()
-        item2._deps = ["type1:", "type2:name2"]
-        item3 = FakeItem()
-        item3._deps = ["type2:"]
-        items = [item1, item2, item3]
-        items, removed_items = deps.split_items_without_deps(items)
-        self.assertEqual(removed_items, [])
-        self.assertEqual(items, [item1, item2, item3])
-
-    def test_no_deps(self):
-        class FakeItem(object):
-            pass
-        item1 = FakeItem()
-        item1._deps = []
-        item2 = FakeItem()
-        item2._deps = []
-        item3 = FakeItem()
-        item3._deps = []
-        items = [item1, item2, item3]
-        items, removed_items = deps.split_items_without_deps(items)
-        self.assertEqual(items, [])
-        self.assertEqual(removed_items, [item1, item2, item3])
-
-    def test_some_deps(self):
-        class FakeItem(object):
-            pass
-        item1 = FakeItem()
-        item1._deps = []
-        item2 = FakeItem()
-        item2._deps = []
-        item3 = FakeItem()
-        item3._deps = ["type2:"]
-        items = [item1, item2, item3]
-        items, removed_items = deps.split_items_without_deps(items)
-        self.assertEqual(removed_items, [item1, item2])
-        self.assertEqual(items, [item3])
-
-
-class ItemsRemoveDepTest(TestCase):
+    def _make_bundle(self, name):
+        bundle = MagicMock()
+        bundle.name = name
+        return bundle
+
+    def test_bundle(self):
+        bundle1 = self._make_bundle("bundle1")
+        bundle2 = self._make_bundle("bundle2")
+        item1 = MockItem(bundle1, "name1", {'needed_by': ["bundle:bundle2"]})
+        item2 = MockItem(bundle2, "name2", {})
+        item3 = MockItem(bundle2, "name3", {})
+        items = deps.prepare_dependencies([item1, item2, item3])
+        bundle_item = deps.find_item("bundle:bundle2", items)
+        self.assertEqual(item1._reverse_deps, [])
+        self.assertEqual(item2._reverse_deps, ["mock:name1"])
+        self.assertEqual(item3._reverse_deps, ["mock:name1"])
+        self.assertIn("mock:name1", bundle_item._deps)
+
+    def test_type(self):
+        bundle = self._make_bundle("bundle1")
+        item1 = MockItem(bundle, "name1", {'needed_by': ["action:"]})
+        item2 = Action(bundle, "action1", {'command': "true"})
+        item3 = MockItem(bundle, "name3", {})
+        deps.prepare_dependencies([item1, item2, item3])
+        self.assertEqual(item2._reverse_deps, ["mock:name1"])
+        self.assertEqual(item3._reverse_deps, [])
+
+
+class ItemQueueTest(TestCase):
     """
-    Tests blockwart.deps.remove_dep_from_items.
+    Tests blockwart.deps.ItemQueue.
     """
-    def test_remove(self):
-        item1 = MagicMock()
-        item1._deps = ["foo", "bar"]
-        item2 = MagicMock()
-        item2._deps = ["foo"]
-        items = deps.remove_dep_from_items([item1, item2], "foo")
-        self.assertEqual(items[0]._deps, ["bar"])
-        self.assertEqual(items[1]._deps, [])
-
-
-class RemoveItemDependentsTest(TestCase):
+    def _make_item(self, item_id, deps, resources=(), duration=1):
+        item = MagicMock()
+        item.id = item_id
+        item.ESTIMATED_APPLY_DURATION = duration
+        item._concurrency_resources = set(resources)
+        item._deps = deps
+        return item
+
+    def _pop_all(self, item_queue):
+        items = []
+        while True:
+            item = item_queue.pop()
+            if item is None:
+                return items
+            items.append(item)
+
+    def test_initial(self):
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", ["type1:name1"])
+        item3 = self._make_item("type1:name3", [])
+        item_queue = deps.ItemQueue([item1, item2, item3])
+        self.assertEqual(item_queue.items_with_deps, [item2])
+        self.assertEqual(self._pop_all(item_queue), [item1, item3])
+
+    def test_item_ok(self):
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", [])
+        item3 = self._make_item("type1:name3", ["type1:name1", "type1:name2"])
+        item_queue = deps.ItemQueue([item1, item2, item3])
+        self.assertEqual(self._pop_all(item_queue), [item1, item2])
+        item_queue.item_ok(item2)
+        self.assertEqual(item_queue.pop(), None)
+        item_queue.item_ok(item1)
+        self.assertEqual(item_queue.pop(), item3)
+        self.assertEqual(item_queue.items_with_deps, [])
+
+    @patch('blockwart.deps.time')
+    def test_ready_since(self, time):
+        time.return_value = 1.0
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", ["type1:name1"])
+        item_queue = deps.ItemQueue([item1, item2])
+        self.assertEqual(item_queue.ready_since(item1), 1.0)
+        self.assertIsNone(item_queue.ready_since(item2))
+        time.return_value = 3.0
+        item_queue.item_ok(item_queue.pop())
+        self.assertEqual(item_queue.ready_since(item2), 3.0)
+
+    def test_duplicate_deps(self):
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", ["type1:name1", "type1:name1"])
+        item_queue = deps.ItemQueue([item1, item2])
+        item_queue.item_ok(item_queue.pop())
+        self.assertEqual(item_queue.pop(), item2)
+
+    def test_item_failed(self):
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", ["type1:name1"])
+        item3 = self._make_item("type1:name3", ["type1:name2"])
+        item4 = self._make_item("type1:name4", [])
+        item_queue = deps.ItemQueue([item1, item2, item3, item4])
+        self.assertEqual(item_queue.item_failed(item1), [item2, item3])
+        self.assertEqual(item_queue.items_with_deps, [])
+        self.assertEqual(self._pop_all(item_queue), [item1, item4])
+
+    def test_item_failed_diamond(self):
+        item1 = self._make_item("type1:name1", ["type1:name2", "type1:name3"])
+        item2 = self._make_item("type1:name2", ["type1:name4"])
+        item3 = self._make_item("type1:name3", ["type1:name4"])
+        item4 = self._make_item("type1:name4", [])
+        item5 = self._make_item("type1:name5", [])
+        item_queue = deps.ItemQueue([item1, item2, item3, item4, item5])
+        self.assertEqual(item_queue.pop(), item4)
+        self.assertEqual(item_queue.item_failed(item4), [item2, item3, item1])
+        self.assertEqual(item_queue.items_with_deps, [])
+        self.assertEqual(self._pop_all(item_queue), [item5])
+
+    def test_priority(self):
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", [])
+        item3 = self._make_item("type1:name3", ["type1:name2"])
+        item_queue = deps.ItemQueue([item1, item2, item3])
+        self.assertEqual(item_queue.pop(), item2)
+        self.assertEqual(item_queue.pop(), item1)
+
+    def test_priority_critical_path(self):
+        item1 = self._make_item("type1:name1", [], duration=20)
+        item2 = self._make_item("type1:name2", [])
+        item3 = self._make_item("type1:name3", ["type1:name2"])
+        item4 = self._make_item("type1:name4", ["type1:name3"])
+        item5 = self._make_item("type1:name5", ["type1:name1"])
+        item_queue = deps.ItemQueue([item1, item2, item3, item4, item5])
+        self.assertEqual(self._pop_all(item_queue), [item1, item2])
+
+    def test_priority_item_durations(self):
+        item1 = self._make_item("type1:name1", [])
+        item2 = self._make_item("type1:name2", [], duration=20)
+        item3 = self._make_item("type1:name3", ["type1:name1"])
+        item_queue = deps.ItemQueue(
+            [item1, item2, item3],
+            item_durations={"type1:name1": 30},
+        )
+        self.assertEqual(self._pop_all(item_queue), [item1, item2])
+
+    def test_resources(self):
+        item1 = self._make_item("type1:name1", [], resources=["type1"])
+        item2 = self._make_item("type1:name2", [], resources=["type1"])
+        item3 = self._make_item("type2:name1", [])
+        item_queue = deps.ItemQueue([item1, item2, item3])
+        self.assertEqual(self._pop_all(item_queue), [item1, item3])
+        item_queue.item_ok(item1)
+        self.assertEqual(self._pop_all(item_queue), [item2])
+
+    def test_resources_released_on_failure(self):
+        item1 = self._make_item("type1:name1", [], resources=["type1"])
+        item2 = self._make_item("type1:name2", [], resources=["type1"])
+        item_queue = deps.ItemQueue([item1, item2])
+        self.assertEqual(self._pop_all(item_queue), [item1])
+        item_queue.item_failed(item1)
+        self.assertEqual(self._pop_all(item_queue), [item2])
+
+
+class PrepareDependencyGraphTest(TestCase):
     """
-    Tests blockwart.deps.remove_item_dependents.
+    Tests blockwart.deps.prepare_dependency_graph.
     """
-    def test_remove_empty(self):
-        self.assertEqual(deps.remove_item_dependents([], "foo"), ([], []))
-
-    def test_recursive_removal(self):
-        item1 = MagicMock()
-        item1.id = "item1"
-        item1._deps = ["item2"]
-        item2 = MagicMock()
-        item2.id = "item2"
-        item2._deps = ["item3"]
-        item3 = MagicMock()
-        item3.id = "item3"
-        item3._deps = []
-        items = [item1, item2, item3]
+    def setUp(self):
+        deps._GRAPH_TEMPLATE_CACHE.clear()
 
+    def _make_items(self, needs):
+        bundle = MagicMock()
+        bundle.name = "bundle1"
+        return [
+            MockItem(bundle, "name1", {'needs': needs, 'triggers': ["mock:name2:action1"]}),
+            MockItem(bundle, "name2", {'needed_by': ["mock:name3"]}),
+            MockItem(bundle, "name3", {}),
+        ]
+
+    def test_template(self):
+        items1 = self._make_items(["mock:name3"])
+        items2 = self._make_items(["mock:name3"])
+        graph1 = deps.prepare_dependency_graph(items1)
+        graph2 = deps.prepare_dependency_graph(items2)
+        self.assertIs(graph1._dep_targets, graph2._dep_targets)
         self.assertEqual(
-            deps.remove_item_dependents(items, "item3"),
-            ([item3], [item2, item1]),
+            [item.id for item in graph1.items],
+            [item.id for item in graph2.items],
         )
+        for item1, item2 in zip(graph1.items, graph2.items):
+            self.assertIsNot(item1, item2)
+            if item1.bundle is not None:
+                self.assertIs(item2.bundle, items2[0].bundle)
+            self.assertEqual(item1._deps, item2._deps)
+            self.assertEqual(item1._reverse_deps, item2._reverse_deps)
+            self.assertEqual(item1._trigger_deps, item2._trigger_deps)
+        for item in items2:
+            self.assertIn(item, graph2.items)
+
+    def test_template_signature(self):
+        graph1 = deps.prepare_dependency_graph(self._make_items(["mock:name3"]))
+        graph2 = deps.prepare_dependency_graph(self._make_items([]))
+        self.assertIsNot(graph1._dep_targets, graph2._dep_targets)
+        self.assertEqual(len(deps._GRAPH_TEMPLATE_CACHE), 2)
+
+    def _make_directories(self, root, count):
+        bundle = MagicMock()
+        bundle.name = "bundle1"
+        return [
+            Directory(bundle, root + "/sub" * i, {}) for i in range(count)
+        ]
+
+    def test_path_index(self):
+        items = self._make_directories("/foo", 3)
+        with patch('blockwart.deps.PathIndex', side_effect=PathIndex) as path_index:
+            deps.prepare_dependency_graph(items)
+        self.assertEqual(path_index.call_count, 1)
+        self.assertIn("directory:/foo/sub", items[2]._deps)
+
+    def test_threads(self):
+        lists = [self._make_directories("/dir{}".format(i), 25) for i in range(8)]
+        threads = [
+            Thread(target=deps.prepare_dependency_graph, args=(items,))
+            for items in lists
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for items in lists:
+            for parent, child in zip(items, items[1:]):
+                self.assertIn(parent.id, child._deps)
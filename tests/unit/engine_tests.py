@@ -0,0 +1,260 @@
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import current_thread
+from time import sleep
+from unittest import TestCase
+
+from mock import patch
+
+from blockwart import operations
+from blockwart.deps import prepare_dependency_graph
+from blockwart.engine import apply_nodes, FakeTransport
+from blockwart.exceptions import RemoteException
+from blockwart.items import Item, ItemStatus
+from blockwart.node import Node, LOCK_FILE, LOCK_PATH
+from blockwart.operations import RunResult
+from blockwart.repo import Repository
+from blockwart.utils.eventloop import EventLoop, Return
+
+
+class MockBundle(object):
+    bundle_dir = ""
+    name = "mock"
+
+
+class MockItem(Item):
+    """
+    Correct once it has been fixed on its node.
+    """
+    BUNDLE_ATTRIBUTE_NAME = "mock"
+    ITEM_TYPE_NAME = "type1"
+    NEEDS_STATIC = []
+
+    def fix(self, status):
+        self.node.run("fix " + self.name)
+
+    def get_status(self):
+        result = self.node.run("check " + self.name, may_fail=True)
+        return ItemStatus(correct=result.return_code == 0)
+
+
+class MockSlowItem(MockItem):
+    """
+    Takes a moment before it is fixed.
+    """
+    def fix(self, status):
+        sleep(0.3)
+        MockItem.fix(self, status)
+
+
+class MockNode(Node):
+    items = ()
+
+
+def handler(hostname, command):
+    """
+    Keeps track of what has been fixed where. Items named "broken*"
+    can't be fixed, fixing items named "error*" fails.
+    """
+    result = RunResult()
+    result.return_code = 0
+    result.stderr = ""
+    result.stdout = ""
+    action, name = command.split(" ", 1)
+    if action == "check":
+        if (hostname, name) not in handler.fixed:
+            result.return_code = 1
+    elif action == "fix":
+        if name.startswith("error"):
+            result.return_code = 1
+        elif not name.startswith("broken"):
+            handler.fixed.add((hostname, name))
+    return result
+
+
+class ApplyNodesTest(TestCase):
+    """
+    Tests blockwart.engine.apply_nodes.
+    """
+    def setUp(self):
+        handler.fixed = set()
+        self.tmpdir = mkdtemp()
+        Repository().create(self.tmpdir)
+        self.repo = Repository(self.tmpdir)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _make_node(self, name, items):
+        node = MockNode(name)
+        self.repo.add_node(node)
+        bundle = MockBundle()
+        bundle.node = node
+        node.items = []
+        for item_name, needs in items:
+            node.items.append(MockItem(
+                bundle,
+                item_name,
+                {'needs': needs},
+                skip_validation=True,
+            ))
+        return node
+
+    def _apply(self, nodes):
+        with EventLoop(executor_threads=4) as loop:
+            transport = FakeTransport(loop, handler=handler, latency=0.001)
+            results = loop.run_until_complete(
+                apply_nodes(loop, nodes, transport=transport),
+            )
+        return results, transport
+
+    def test_apply(self):
+        node1 = self._make_node("engine1", [("item1", []), ("item2", ["type1:item1"])])
+        node2 = self._make_node("engine2", [("item1", [])])
+        handler.fixed.add(("engine2", "item1"))
+
+        results, transport = self._apply([node1, node2])
+
+        self.assertEqual(
+            (results['engine1'].correct, results['engine1'].fixed),
+            (0, 2),
+        )
+        self.assertEqual(
+            (results['engine2'].correct, results['engine2'].fixed),
+            (1, 0),
+        )
+        self.assertIn(("engine1", LOCK_FILE), transport.files)
+        self.assertEqual(
+            set(self.repo.get_item_durations("engine1").keys()),
+            set(["type1:item1", "type1:item2"]),
+        )
+        # the node's usual transport is restored
+        self.assertIs(node1.transport, operations)
+
+    def test_prepare_on_loop_thread(self):
+        nodes = [self._make_node("engine{}".format(i), [("item1", [])]) for i in range(4)]
+        threads = []
+
+        def prepare(items):
+            threads.append(current_thread())
+            return prepare_dependency_graph(items)
+
+        with patch('blockwart.engine.prepare_dependency_graph', side_effect=prepare):
+            self._apply(nodes)
+        self.assertEqual(threads, [current_thread()] * 4)
+
+    def test_failed(self):
+        node = self._make_node("engine1", [
+            ("broken1", []),
+            ("item2", ["type1:broken1"]),
+            ("item3", []),
+        ])
+
+        results, transport = self._apply([node])
+
+        self.assertEqual(results['engine1'].failed, 1)
+        self.assertEqual(results['engine1'].skipped, 1)
+        self.assertEqual(results['engine1'].fixed, 1)
+
+    def test_exception(self):
+        node1 = self._make_node("engine1", [("error1", [])])
+        node2 = self._make_node("engine2", [("item1", [])])
+
+        results, transport = self._apply([node1, node2])
+
+        self.assertIsNone(results['engine1'])
+        self.assertEqual(results['engine2'].fixed, 1)
+
+    def test_exception_in_flight(self):
+        node = self._make_node("engine1", [("error1", [])])
+        node.items.append(MockSlowItem(
+            node.items[0].bundle,
+            "slow2",
+            {},
+            skip_validation=True,
+        ))
+
+        results, transport = self._apply([node])
+
+        self.assertIsNone(results['engine1'])
+        commands = [command for hostname, command in transport.commands]
+        # the node isn't unlocked before the slow item is done
+        self.assertTrue(
+            commands.index("fix slow2") < commands.index("rm -R " + LOCK_PATH)
+        )
+
+
+class FakeTransportTest(TestCase):
+    """
+    Tests blockwart.engine.FakeTransport.
+    """
+    def test_run_async(self):
+        def coroutine(loop, transport):
+            results = []
+            for command in ("true", "false"):
+                try:
+                    result = yield transport.run_async("engine1", command)
+                    results.append(result.return_code)
+                except RemoteException:
+                    results.append("failed")
+            result = yield transport.run_async("engine1", "false", ignore_failure=True)
+            results.append(result.return_code)
+            raise Return(results)
+
+        def fail_false(hostname, command):
+            if command == "false":
+                result = RunResult()
+                result.return_code = 1
+                result.stderr = ""
+                result.stdout = ""
+                return result
+
+        with EventLoop() as loop:
+            transport = FakeTransport(loop, handler=fail_false)
+            task = loop.create_task(coroutine(loop, transport))
+            loop.run_until_complete(task)
+        self.assertEqual(task.result(), [0, "failed", 1])
+
+    def test_run_batch(self):
+        def fail_false(hostname, command):
+            if command == "false":
+                result = RunResult()
+                result.return_code = 1
+                result.stderr = ""
+                result.stdout = ""
+                return result
+
+        with EventLoop(executor_threads=1) as loop:
+            transport = FakeTransport(loop, handler=fail_false, latency=0.01)
+            results = loop.run_until_complete(loop.run_in_executor(
+                transport.run_batch,
+                "engine1",
+                ["true", "false"],
+                ignore_failure=True,
+            ))
+            self.assertEqual([result.return_code for result in results], [0, 1])
+            self.assertEqual(transport.max_in_flight, 2)
+            with self.assertRaises(RemoteException):
+                loop.run_until_complete(loop.run_in_executor(
+                    transport.run_batch,
+                    "engine1",
+                    ["false"],
+                ))
+
+    def test_files(self):
+        tmpdir = mkdtemp()
+        try:
+            with open(join(tmpdir, "upload"), 'w') as f:
+                f.write("content")
+            with EventLoop() as loop:
+                transport = FakeTransport(loop)
+                transport.upload("engine1", join(tmpdir, "upload"), "/remote")
+                transport.download("engine1", "/remote", join(tmpdir, "download"))
+                with self.assertRaises(RemoteException):
+                    transport.download("engine2", "/remote", join(tmpdir, "download"))
+            with open(join(tmpdir, "download")) as f:
+                self.assertEqual(f.read(), "content")
+        finally:
+            rmtree(tmpdir)
+
@@ -3,27 +3,22 @@ from __future__ import unicode_literals
 
 from unittest import TestCase
 
-from mock import MagicMock, patch, call
+from mock import MagicMock, call
 
 from blockwart.exceptions import BundleError
 from blockwart.items import ItemStatus, users
 from blockwart.operations import RunResult
 
 
-class GroupsForUserTest(TestCase):
+class ParseGroupsTest(TestCase):
     """
-    Tests blockwart.items.users._groups_for_user.
+    Tests blockwart.items.users._parse_groups.
     """
     def test_groups(self):
-        node = MagicMock()
-        result = RunResult()
-        result.stdout = "group1 group2\n"
-        node.run.return_value = result
-
-        groups = users._groups_for_user(node, "jdoe")
-
-        node.run.assert_called_once_with("id -Gn jdoe")
-        self.assertEqual(groups, ["group1", "group2"])
+        self.assertEqual(
+            users._parse_groups("group1 group2\n"),
+            ["group1", "group2"],
+        )
 
 
 class ParsePasswdLineTest(TestCase):
@@ -318,13 +313,19 @@ class FixTest(TestCase):
         )
 
 
+def _result(return_code, stdout=""):
+    result = RunResult()
+    result.return_code = return_code
+    result.stderr = ""
+    result.stdout = stdout
+    return result
+
+
 class GetStatusTest(TestCase):
     """
     Tests blockwart.items.users.User.get_status.
     """
-    @patch('blockwart.items.users._groups_for_user')
-    def test_ok(self, _groups_for_user):
-        _groups_for_user.return_value = ["group1", "group2"]
+    def test_ok(self):
         bundle = MagicMock()
         user = users.User(
             bundle,
@@ -339,26 +340,27 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:secret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        bundle.node.run_many.return_value = [
+            _result(0, "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"),
+            _result(0, "group1 group2\n"),
+            _result(0, "blockwart:secret:::::::"),
+        ]
 
         status = user.get_status()
         self.assertTrue(status.correct)
+        self.assertEqual(
+            bundle.node.run_many.call_args_list,
+            [call(
+                [
+                    "grep -e '^blockwart:' /etc/passwd",
+                    "id -Gn blockwart",
+                    "grep -e '^blockwart:' /etc/shadow",
+                ],
+                may_fail=True,
+            )],
+        )
 
-    @patch('blockwart.items.users._groups_for_user')
-    def test_passwd(self, _groups_for_user):
-        _groups_for_user.return_value = ["group1", "group2"]
+    def test_passwd(self):
         bundle = MagicMock()
         user = users.User(
             bundle,
@@ -374,19 +376,10 @@ class GetStatusTest(TestCase):
                 'use_shadow': False,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:666:666:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:secret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        bundle.node.run_many.return_value = [
+            _result(0, "blockwart:x:666:666:Blöck Wart:/home/blockwart:/bin/bash\n"),
+            _result(0, "group1 group2\n"),
+        ]
 
         status = user.get_status()
         self.assertFalse(status.correct)
@@ -406,19 +399,17 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 1
-
-        bundle.node.run.return_value = passwd_grep_result
+        bundle.node.run_many.return_value = [
+            _result(1),
+            _result(1),
+            _result(1),
+        ]
 
         status = user.get_status()
         self.assertFalse(status.correct)
         self.assertFalse(status.info['exists'])
 
-    @patch('blockwart.items.users._groups_for_user')
-    def test_shadow(self, _groups_for_user):
-        _groups_for_user.return_value = ["group1", "group2"]
+    def test_shadow(self):
         bundle = MagicMock()
         user = users.User(
             bundle,
@@ -433,26 +424,16 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:topsecret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        bundle.node.run_many.return_value = [
+            _result(0, "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"),
+            _result(0, "group1 group2\n"),
+            _result(0, "blockwart:topsecret:::::::"),
+        ]
 
         status = user.get_status()
         self.assertFalse(status.correct)
 
-    @patch('blockwart.items.users._groups_for_user')
-    def test_shadow_fail(self, _groups_for_user):
-        _groups_for_user.return_value = ["group1", "group2"]
+    def test_shadow_fail(self):
         bundle = MagicMock()
         user = users.User(
             bundle,
@@ -467,18 +448,11 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 1
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        bundle.node.run_many.return_value = [
+            _result(0, "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"),
+            _result(0, "group1 group2\n"),
+            _result(1),
+        ]
 
         status = user.get_status()
         self.assertFalse(status.correct)
@@ -491,20 +465,17 @@ class GetStatusTest(TestCase):
             "blockwart",
             {'delete': True},
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-
-        bundle.node.run.return_value = passwd_grep_result
+        bundle.node.run_many.return_value = [
+            _result(0, "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"),
+            _result(0, "group1 group2\n"),
+            _result(0, "blockwart:secret:::::::"),
+        ]
 
         status = user.get_status()
         self.assertFalse(status.correct)
         self.assertTrue(status.info['exists'])
 
-    @patch('blockwart.items.users._groups_for_user')
-    def test_groups(self, _groups_for_user):
-        _groups_for_user.return_value = ["group1", "group3"]
+    def test_groups(self):
         bundle = MagicMock()
         user = users.User(
             bundle,
@@ -519,19 +490,11 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:secret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        bundle.node.run_many.return_value = [
+            _result(0, "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"),
+            _result(0, "group1 group3\n"),
+            _result(0, "blockwart:secret:::::::"),
+        ]
 
         status = user.get_status()
         self.assertFalse(status.correct)
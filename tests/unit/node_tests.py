@@ -1,11 +1,19 @@
+from time import sleep
 from unittest import TestCase
 
 from mock import MagicMock, patch
 
-from blockwart.exceptions import ItemDependencyError, NodeAlreadyLockedException, RepositoryError
+from blockwart.concurrency import ThreadPool, WorkerPool
+from blockwart.exceptions import (
+    ItemDependencyError,
+    NodeAlreadyLockedException,
+    RepositoryError,
+    WorkerException,
+)
 from blockwart.group import Group
-from blockwart.items import Item
-from blockwart.node import ApplyResult, apply_items, Node, NodeLock
+from blockwart.items import Item, ItemStatus
+from blockwart import node as node_module
+from blockwart.node import ApplyResult, apply_items, Node, NodeLock, verify_nodes
 from blockwart.operations import RunResult
 from blockwart.repo import Repository
 from blockwart.utils import names
@@ -29,6 +37,21 @@ class MockItem(Item):
 
     def apply(self, *args, **kwargs):
         return self._APPLY_RESULT
+
+
+class MockTriggeredItem(MockItem):
+    def apply(self, *args, **kwargs):
+        if self.has_been_triggered:
+            return Item.STATUS_FIXED
+        return Item.STATUS_SKIPPED
+
+
+class MockSlowItem(MockItem):
+    def apply(self, *args, **kwargs):
+        sleep(5)
+        return Item.STATUS_FIXED
+
+
 del Item.__reduce__  # we don't need the custom pickle-magic for our
                      # MockItems
 
@@ -123,6 +146,156 @@ class ApplyItemsTest(TestCase):
         self.assertEqual(results[1][0], "type1:name2")
         self.assertEqual(results[2][0], "type1:name1")
 
+    def test_apply_block_concurrent(self):
+        i1 = get_mock_item("type1", "name1", [], [])
+        i2 = get_mock_item("type1", "name2", [], [])
+        i3 = get_mock_item("type2", "name3", [], ["type1:name2"])
+        for item in (i1, i2):
+            item.BLOCK_CONCURRENT = ["type1"]
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        item_ids = [item_id for item_id, status in apply_items(node, workers=2)]
+
+        self.assertEqual(len(item_ids), 3)
+        self.assertTrue(item_ids.index("type1:name2") < item_ids.index("type2:name3"))
+
+    def test_apply_skip_cascade(self):
+        i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
+        i2 = get_mock_item("type1", "name2", [], ["type1:name3"])
+        i3 = get_mock_item("type1", "name3", [], [])
+        i3._APPLY_RESULT = Item.STATUS_FAILED
+        i4 = get_mock_item("type2", "name4", [], [])
+
+        node = MagicMock()
+        node.items = [i1, i2, i3, i4]
+
+        results = dict(apply_items(node))
+
+        self.assertEqual(results, {
+            "type1:name1": Item.STATUS_SKIPPED,
+            "type1:name2": Item.STATUS_SKIPPED,
+            "type1:name3": Item.STATUS_FAILED,
+            "type2:name4": Item.STATUS_OK,
+        })
+
+    def test_apply_item_durations(self):
+        i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
+        i2 = get_mock_item("type1", "name2", [], [])
+
+        node = MagicMock()
+        node.items = [i1, i2]
+
+        item_durations = {"type1:name1": 42, "type1:name3": 23}
+        list(apply_items(node, item_durations=item_durations))
+
+        self.assertEqual(
+            set(item_durations.keys()),
+            set(["type1:name1", "type1:name2", "type1:name3"]),
+        )
+        self.assertNotEqual(item_durations["type1:name1"], 42)
+
+    def test_apply_triggered(self):
+        i1 = get_mock_item("type1", "name1", [], [])
+        i1._APPLY_RESULT = Item.STATUS_FIXED
+        i1.triggers = ["type1:name2"]
+        bundle = MockBundle()
+        bundle.node = MockNode()
+        i2 = MockTriggeredItem(bundle, "name2", {'triggered': True}, skip_validation=True)
+        i3 = MockTriggeredItem(bundle, "name3", {'triggered': True}, skip_validation=True)
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        results = dict(apply_items(node, workers=2))
+
+        self.assertEqual(results, {
+            "type1:name1": Item.STATUS_FIXED,
+            "type1:name2": Item.STATUS_FIXED,
+            "type1:name3": Item.STATUS_SKIPPED,
+        })
+
+    def test_apply_threads(self):
+        i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
+        i2 = get_mock_item("type1", "name2", [], [])
+        i2._APPLY_RESULT = Item.STATUS_FIXED
+        i2.triggers = ["type1:name3"]
+        bundle = MockBundle()
+        bundle.node = MockNode()
+        i3 = MockTriggeredItem(bundle, "name3", {'triggered': True}, skip_validation=True)
+        i4 = get_mock_item("type2", "name4", [], ["type1:name5"])
+        i5 = get_mock_item("type1", "name5", [], [])
+        i5._APPLY_RESULT = Item.STATUS_FAILED
+
+        node = MagicMock()
+        node.items = [i1, i2, i3, i4, i5]
+
+        results = dict(apply_items(node, workers=2, pool_class=ThreadPool))
+
+        self.assertEqual(results, {
+            "type1:name1": Item.STATUS_OK,
+            "type1:name2": Item.STATUS_FIXED,
+            "type1:name3": Item.STATUS_FIXED,
+            "type2:name4": Item.STATUS_SKIPPED,
+            "type1:name5": Item.STATUS_FAILED,
+        })
+
+    def test_apply_item_timeout(self):
+        bundle = MockBundle()
+        bundle.node = MockNode()
+        i1 = MockSlowItem(bundle, "name1", {}, skip_validation=True)
+        i2 = get_mock_item("type1", "name2", [], ["type1:name1"])
+        i3 = get_mock_item("type1", "name3", [], [])
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        for pool_class in (ThreadPool, WorkerPool):
+            results = dict(apply_items(
+                node,
+                workers=2,
+                item_timeout=0.2,
+                pool_class=pool_class,
+            ))
+
+            self.assertEqual(results, {
+                "type1:name1": Item.STATUS_FAILED,
+                "type1:name2": Item.STATUS_SKIPPED,
+                "type1:name3": Item.STATUS_OK,
+            })
+
+    def test_apply_timeout(self):
+        bundle = MockBundle()
+        bundle.node = MockNode()
+        i1 = MockSlowItem(bundle, "name1", {}, skip_validation=True)
+        i2 = get_mock_item("type1", "name2", [], [])
+
+        node = MagicMock()
+        node.items = [i1, i2]
+
+        results = list(apply_items(
+            node,
+            item_durations={"type1:name1": 10},
+            timeout=0.2,
+        ))
+
+        self.assertEqual(results, [
+            ("type1:name1", Item.STATUS_FAILED),
+            ("type1:name2", Item.STATUS_SKIPPED),
+        ])
+
+    def test_apply_timeout_dummy(self):
+        # there are no type2 items, so the dummy item standing in for
+        # them is ready right away
+        i1 = get_mock_item("type1", "name1", [], ["type2:"])
+
+        node = MagicMock()
+        node.items = [i1]
+
+        results = list(apply_items(node, timeout=0))
+
+        self.assertEqual(results, [("type1:name1", Item.STATUS_SKIPPED)])
 
     def test_apply_interactive(self):
         i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
@@ -255,3 +428,66 @@ class NodeLockTest(TestCase):
         with self.assertRaises(NodeAlreadyLockedException):
             with NodeLock(node, False, ignore=False):
                 pass
+
+
+class StatusItem(MockItem):
+    def get_status(self):
+        if self.name == "broken":
+            raise RuntimeError("unable to get status")
+        return ItemStatus(correct=self.name.startswith("correct"))
+
+    def test(self):
+        if self.name == "broken":
+            raise RuntimeError("invalid")
+
+
+class ItemsNode(Node):
+    items = ()
+
+
+class NodesTest(TestCase):
+    """
+    Tests blockwart.node.test_nodes and blockwart.node.verify_nodes.
+    """
+    def _make_node(self, repo, name, item_names):
+        node = ItemsNode(name)
+        repo.add_node(node)
+        bundle = MockBundle()
+        bundle.node = node
+        node.items = [
+            StatusItem(bundle, item_name, {}, skip_validation=True)
+            for item_name in item_names
+        ]
+        return node
+
+    def test_verify_nodes(self):
+        repo = Repository()
+        nodes = [
+            self._make_node(repo, "verify1", ["correct1", "broken"]),
+            self._make_node(repo, "verify2", ["correct1", "incorrect1"]),
+        ]
+        for pool_class in (ThreadPool, WorkerPool):
+            errors = verify_nodes(nodes, workers=3, pool_class=pool_class)
+            self.assertEqual(
+                [(e.task_id, e.wrapped_exception) for e in errors],
+                [("verify1:type1:broken", "unable to get status")],
+            )
+
+    def test_test_nodes(self):
+        repo = Repository()
+        nodes = [
+            self._make_node(repo, "test1", ["correct1"]),
+            self._make_node(repo, "test2", ["correct1", "correct2"]),
+        ]
+        node_module.test_nodes(nodes, workers=2)
+        nodes.append(self._make_node(repo, "test3", ["broken"]))
+        with self.assertRaises(WorkerException):
+            node_module.test_nodes(nodes, workers=2)
+
+    def test_load_failed(self):
+        repo = Repository()
+        node = self._make_node(repo, "test1", ["correct1"])
+        node.items = None
+        with self.assertRaises(WorkerException) as cm:
+            node_module.test_nodes([node])
+        self.assertEqual(cm.exception.task_id, "test1")
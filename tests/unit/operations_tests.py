@@ -0,0 +1,412 @@
+from gc import collect
+from os import close, getcwd, read, remove
+from select import select
+from subprocess import PIPE, Popen
+from tempfile import mkstemp
+from threading import Event, Thread
+from unittest import TestCase
+
+from fabric import network
+from mock import patch
+
+from blockwart import operations
+from blockwart.exceptions import RemoteException
+
+
+class FakeChannel(object):
+    """
+    Delivers one chunk of output per poll and reports the exit status
+    once all output has been delivered.
+    """
+    def __init__(self, stdout=(), stderr=(), return_code=0):
+        self.closed = False
+        self.command = None
+        self.return_code = return_code
+        self.stderr = list(stderr)
+        self.stdout = list(stdout)
+
+    def close(self):
+        self.closed = True
+
+    def exec_command(self, command):
+        self.command = command
+
+    def exit_status_ready(self):
+        return not self.stdout and not self.stderr
+
+    def fileno(self):
+        return None
+
+    def get_pty(self):
+        pass
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_exit_status(self):
+        return self.return_code
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+
+@patch('blockwart.operations.select', lambda r, w, x, timeout: ([], [], []))
+class RunTest(TestCase):
+    """
+    Tests blockwart.operations.run.
+    """
+    @patch('blockwart.operations._open_session')
+    def test_output(self, _open_session):
+        channel = FakeChannel(stdout=["foo\n", "bar\n"], stderr=["baz\n"])
+        _open_session.return_value = channel
+        stdout = FakeStream()
+        result = operations.run("localhost", "true", stdout=stdout)
+        _open_session.assert_called_once_with("localhost")
+        self.assertEqual(result.return_code, 0)
+        self.assertEqual(result.stdout, "foo\nbar")
+        self.assertEqual(result.stderr, "baz")
+        self.assertEqual(stdout.chunks, ["foo\n", "bar\n"])
+        self.assertTrue(channel.closed)
+
+    @patch('blockwart.operations._open_session')
+    def test_failure(self, _open_session):
+        _open_session.return_value = FakeChannel(stderr=["nope"], return_code=1)
+        with self.assertRaises(RemoteException):
+            operations.run("localhost", "false")
+
+    @patch('blockwart.operations._open_session')
+    def test_ignore_failure(self, _open_session):
+        _open_session.return_value = FakeChannel(return_code=1)
+        result = operations.run("localhost", "false", ignore_failure=True)
+        self.assertEqual(result.return_code, 1)
+
+    @patch('blockwart.operations._open_session')
+    def test_wrap_command(self, _open_session):
+        channel = FakeChannel()
+        _open_session.return_value = channel
+        operations.run("localhost", "echo \"$HOME\"", sudo=False)
+        self.assertEqual(
+            channel.command,
+            "/bin/bash -l -c 'export LANG=C && echo \"$HOME\"'",
+        )
+
+    @patch('blockwart.operations._open_session')
+    def test_wrap_command_sudo(self, _open_session):
+        channel = FakeChannel()
+        _open_session.return_value = channel
+        operations.run("localhost", "true")
+        self.assertEqual(
+            channel.command,
+            "sudo -n /bin/bash -l -c 'export LANG=C && true'",
+        )
+
+    @patch('blockwart.operations._open_session')
+    def test_sudo_password(self, _open_session):
+        _open_session.return_value = FakeChannel(
+            stderr=["sudo: a password is required\n"],
+            return_code=1,
+        )
+        with self.assertRaises(RemoteException) as cm:
+            operations.run("localhost", "true", ignore_failure=True)
+        self.assertIn("passwordless sudo", str(cm.exception))
+
+
+@patch('blockwart.operations.select', lambda r, w, x, timeout: ([], [], []))
+class DownloadTest(TestCase):
+    """
+    Tests blockwart.operations.download.
+    """
+    def setUp(self):
+        handle, self.local_path = mkstemp()
+        close(handle)
+
+    def tearDown(self):
+        remove(self.local_path)
+
+    @patch('blockwart.operations._open_session')
+    def test_download(self, _open_session):
+        channel = FakeChannel(stdout=[b"\x00foo\n", b"bar\r\n\n"])
+        _open_session.return_value = channel
+        operations.download("localhost", "/foo bar", self.local_path)
+        self.assertIn("cat -- ", channel.command)
+        with open(self.local_path, 'rb') as f:
+            self.assertEqual(f.read(), b"\x00foo\nbar\r\n\n")
+
+    @patch('blockwart.operations._open_session')
+    def test_failure(self, _open_session):
+        _open_session.return_value = FakeChannel(stderr=["No such file"], return_code=1)
+        with self.assertRaises(RemoteException):
+            operations.download("localhost", "/foo", self.local_path)
+
+    @patch('blockwart.operations._open_session')
+    def test_ignore_failure(self, _open_session):
+        _open_session.return_value = FakeChannel(stderr=["No such file"], return_code=1)
+        operations.download("localhost", "/foo", self.local_path, ignore_failure=True)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnectionCache(dict):
+    def connect(self, key):
+        self[key] = FakeConnection()
+
+
+@patch('blockwart.operations._CONNECTIONS_PID', 1)
+@patch('blockwart.operations._SETUP_TIMES', {})
+class ConnectionTest(TestCase):
+    """
+    Tests blockwart.operations._connection.
+    """
+    @patch('blockwart.operations.getpid', lambda: 1)
+    @patch('blockwart.operations.connections', new_callable=FakeConnectionCache)
+    def test_reuse(self, connections):
+        self.assertIsNone(operations.connection_setup_time("localhost"))
+        connection = operations._connection("localhost")
+        self.assertIs(operations._connection("localhost"), connection)
+        self.assertEqual(len(connections), 1)
+        self.assertIsNotNone(operations.connection_setup_time("localhost"))
+
+    @patch('blockwart.operations.getpid')
+    @patch('blockwart.operations.connections', new_callable=FakeConnectionCache)
+    def test_fork(self, connections, getpid):
+        getpid.return_value = 1
+        parent_connection = operations._connection("localhost")
+        # pretend we have been forked
+        getpid.return_value = 2
+        self.assertIsNone(operations.connection_setup_time("localhost"))
+        child_connection = operations._connection("localhost")
+        self.assertIsNot(child_connection, parent_connection)
+        operations.disconnect("localhost")
+        self.assertTrue(child_connection.closed)
+        self.assertFalse(parent_connection.closed)
+        self.assertIsNone(operations.connection_setup_time("localhost"))
+
+    @patch('blockwart.operations._fabric_ssh_config', lambda host_string: host_string)
+    @patch('blockwart.operations._SETUP_TIMES', {})
+    @patch('blockwart.operations.getpid', lambda: 1)
+    def test_parallel(self):
+        connecting = Event()
+        done = Event()
+        connected = []
+        ssh_configs = {}
+
+        class SlowConnectionCache(FakeConnectionCache):
+            def connect(self, key):
+                # Fabric asks for the SSH config without naming the host
+                ssh_configs[key] = network.ssh_config()
+                if key == "slow":
+                    connecting.set()
+                    done.wait(5)
+                connected.append(key)
+                FakeConnectionCache.connect(self, key)
+
+        with patch('blockwart.operations.connections', new_callable=SlowConnectionCache):
+            threads = [
+                Thread(target=operations._connection, args=("slow",))
+                for i in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            try:
+                self.assertTrue(connecting.wait(5))
+                # not held up by the other host
+                fast = Thread(target=operations._connection, args=("fast",))
+                fast.start()
+                fast.join(1)
+                self.assertFalse(fast.is_alive())
+            finally:
+                done.set()
+                for thread in threads:
+                    thread.join()
+
+        # the second thread used the connection made by the first one
+        self.assertEqual(connected, ["fast", "slow"])
+        self.assertEqual(ssh_configs, {"fast": "fast", "slow": "slow"})
+
+    @patch('blockwart.operations._INHERITED', [])
+    @patch('blockwart.operations._IDLE_SHELLS', {})
+    @patch('blockwart.operations.getpid')
+    @patch('blockwart.operations.connections', new_callable=FakeConnectionCache)
+    def test_fork_idle_shell(self, connections, getpid):
+        collected = []
+
+        class CollectedChannel(FakeChannel):
+            def __del__(self):
+                # paramiko closes the channel on the parent's connection
+                collected.append(self)
+
+        getpid.return_value = 1
+        shell = object.__new__(operations.RemoteShell)
+        shell.hostname = "localhost"
+        shell.channel = CollectedChannel()
+        operations._IDLE_SHELLS["localhost"] = [shell]
+        del shell
+        # pretend we have been forked
+        getpid.return_value = 2
+        self.assertIsNone(operations.connection_setup_time("localhost"))
+        collect()
+        self.assertEqual(operations._IDLE_SHELLS, {})
+        self.assertEqual(collected, [])
+
+
+class LocalShellChannel(object):
+    """
+    Runs the shell started by RemoteShell on the local machine instead
+    (without sudo).
+    """
+    def __init__(self):
+        self.closed = False
+        self.eof = set()
+        self.process = None
+
+    def close(self):
+        self.closed = True
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def exec_command(self, command):
+        self.process = Popen(
+            ["/bin/bash"],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+
+    def exit_status_ready(self):
+        return self.process.poll() is not None
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def _read(self, pipe, size):
+        data = read(pipe.fileno(), size)
+        if not data:
+            self.eof.add(pipe)
+        return data
+
+    def _ready(self, pipe):
+        return pipe not in self.eof and bool(select([pipe], [], [], 0)[0])
+
+    def recv(self, size):
+        return self._read(self.process.stdout, size)
+
+    def recv_ready(self):
+        return self._ready(self.process.stdout)
+
+    def recv_stderr(self, size):
+        return self._read(self.process.stderr, size)
+
+    def recv_stderr_ready(self):
+        return self._ready(self.process.stderr)
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+
+@patch('blockwart.operations._IDLE_SHELLS', {})
+@patch('blockwart.operations._open_session', lambda hostname: LocalShellChannel())
+class RemoteShellTest(TestCase):
+    """
+    Tests blockwart.operations.run with shell=True.
+    """
+    def tearDown(self):
+        for shell in operations._IDLE_SHELLS.get("localhost", []):
+            shell.close()
+
+    def test_output(self):
+        stdout = FakeStream()
+        result = operations.run(
+            "localhost",
+            "echo foo; echo bar >&2; printf baz",
+            shell=True,
+            stdout=stdout,
+        )
+        self.assertEqual(result.return_code, 0)
+        self.assertEqual(result.stdout, "foo\nbaz")
+        self.assertEqual(result.stderr, "bar")
+        self.assertEqual("".join(stdout.chunks), "foo\nbaz")
+
+    def test_failure(self):
+        with self.assertRaises(RemoteException):
+            operations.run("localhost", "exit 3", shell=True)
+        result = operations.run("localhost", "exit 3", shell=True, ignore_failure=True)
+        self.assertEqual(result.return_code, 3)
+
+    def test_reuse(self):
+        operations.run("localhost", "cd /; X=47", shell=True)
+        result = operations.run("localhost", "echo \"$X\"; pwd; cat", shell=True)
+        # the shell is reused, but commands don't affect each other
+        self.assertEqual(len(operations._IDLE_SHELLS["localhost"]), 1)
+        self.assertEqual(result.stdout, getcwd())
+
+    def test_dead_shell(self):
+        with self.assertRaises(RemoteException):
+            operations.run("localhost", "kill $$", shell=True)
+        self.assertEqual(operations._IDLE_SHELLS["localhost"], [])
+        result = operations.run("localhost", "echo foo", shell=True)
+        self.assertEqual(result.stdout, "foo")
+
+
+def run_locally(hostname, command, ignore_failure=False, **kwargs):
+    process = Popen(["/bin/bash", "-c", command], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = process.communicate()
+    result = operations.RunResult()
+    result.return_code = process.returncode
+    result.stderr = stderr.strip()
+    result.stdout = stdout.strip()
+    return result
+
+
+@patch('blockwart.operations.run', side_effect=run_locally)
+class RunBatchTest(TestCase):
+    """
+    Tests blockwart.operations.run_batch.
+    """
+    def test_results(self, run):
+        results = operations.run_batch(
+            "localhost",
+            ["true", "echo foo; echo bar >&2", "printf baz; exit 3", "echo $1 '$1'"],
+            ignore_failure=True,
+        )
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(
+            [(r.return_code, r.stdout, r.stderr) for r in results],
+            [(0, "", ""), (0, "foo", "bar"), (3, "baz", ""), (0, "$1", "")],
+        )
+
+    def test_failure(self, run):
+        with self.assertRaises(RemoteException):
+            operations.run_batch("localhost", ["false", "true"])
+
+    def test_empty(self, run):
+        self.assertEqual(operations.run_batch("localhost", []), [])
+        self.assertFalse(run.called)
+
+    def test_interrupted(self, run):
+        with self.assertRaises(RemoteException):
+            operations.run_batch("localhost", ["kill $$", "true"], ignore_failure=True)
@@ -1,4 +1,4 @@
-from os import mkdir
+from os import mkdir, remove
 from os.path import join
 from pickle import dumps, loads
 from shutil import rmtree
@@ -67,6 +67,37 @@ def apply_start(arg, kwarg=0):
         p.apply_start()
 
 
+class RepoPreloadTest(RepoTest):
+    """
+    Tests blockwart.repo.Repository.preload.
+    """
+    def test_hooks(self):
+        r = Repository.create(self.tmpdir)
+        mkdir(r.hooks_dir)
+        with open(join(r.hooks_dir, "hook1.py"), 'w') as f:
+            f.write(
+"""
+def apply_start(arg):
+    with open("{}", 'w') as f:
+        f.write(arg)
+""".format(join(self.tmpdir, "test.log"))
+            )
+        r.preload()
+        remove(join(r.hooks_dir, "hook1.py"))
+        r.hooks.apply_start("foo")
+        with open(join(self.tmpdir, "test.log")) as f:
+            self.assertEqual(f.read(), "foo")
+
+    def test_libs(self):
+        r = Repository.create(self.tmpdir)
+        mkdir(r.libs_dir)
+        with open(join(r.libs_dir, "lib1.py"), 'w') as f:
+            f.write("answer = 42")
+        r.preload()
+        remove(join(r.libs_dir, "lib1.py"))
+        self.assertEqual(r.libs.lib1.answer, 42)
+
+
 class LibsProxyTest(RepoTest):
     """
     Tests blockwart.repo.LibsProxy.
@@ -95,6 +126,22 @@ class RepoBundlesTest(RepoTest):
 
 
 
+class RepoItemDurationsTest(RepoTest):
+    """
+    Tests blockwart.repo.Repository.get_item_durations and
+    blockwart.repo.Repository.set_item_durations.
+    """
+    def test_missing(self):
+        r = Repository.create(self.tmpdir)
+        self.assertEqual(r.get_item_durations("node1"), {})
+
+    def test_roundtrip(self):
+        r = Repository.create(self.tmpdir)
+        r.set_item_durations("node1", {"file:/foo": 1.5})
+        self.assertEqual(r.get_item_durations("node1"), {"file:/foo": 1.5})
+        self.assertEqual(r.get_item_durations("node2"), {})
+
+
 class RepoItemClasses2Test(RepoTest):
     """
     Tests blockwart.repo.Repository.item_classes.
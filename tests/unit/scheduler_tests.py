@@ -0,0 +1,321 @@
+from os import getpid
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep
+from unittest import TestCase
+
+from mock import call, patch
+
+from blockwart.concurrency import PoolMetrics, ThreadPool, WorkerPool
+from blockwart.exceptions import RemoteException, WorkerException
+from blockwart.items import Item, ItemStatus
+from blockwart.node import LOCK_PATH, Node
+from blockwart.operations import RunResult
+from blockwart.repo import Repository
+from blockwart.scheduler import apply_nodes
+
+
+class FakeTransport(object):
+    """
+    Keeps track of what has been fixed where. Nodes in self.locked
+    appear to be locked by someone else, uploads to nodes in
+    self.broken fail, locking nodes in self.slow takes a moment, fixing
+    items named "error*" fails and fixing items named "hang*" takes a
+    long time.
+    """
+    def __init__(self):
+        self.broken = set()
+        self.commands = []
+        self.fixed = set()
+        self.locked = set()
+        self.slow = set()
+        self.lock = Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def download(self, hostname, remote_path, local_path, ignore_failure=False,
+                 **kwargs):
+        with open(local_path, 'w') as f:
+            f.write("{}")
+
+    def run(self, hostname, command, ignore_failure=False, **kwargs):
+        with self.lock:
+            self.commands.append((hostname, command))
+        result = RunResult()
+        result.return_code = 0
+        result.stderr = ""
+        result.stdout = ""
+        action, name = command.split(" ", 1)
+        if action == "mkdir" and hostname in self.slow:
+            sleep(0.3)
+        if action == "mkdir" and hostname in self.locked:
+            result.return_code = 1
+        elif action == "check" and (hostname, name) not in self.fixed:
+            result.return_code = 1
+        elif action == "fix":
+            if name.startswith("error"):
+                raise RemoteException("fixing {} failed".format(name))
+            elif name.startswith("hang"):
+                sleep(5)
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            sleep(0.01)
+            with self.lock:
+                self.fixed.add((hostname, name))
+                self.in_flight -= 1
+        return result
+
+    def upload(self, hostname, local_path, remote_path, **kwargs):
+        if hostname in self.broken:
+            raise RemoteException("uploading to {} failed".format(hostname))
+
+
+class MockBundle(object):
+    bundle_dir = ""
+    name = "mock"
+
+
+class MockItem(Item):
+    BUNDLE_ATTRIBUTE_NAME = "mock"
+    ITEM_TYPE_NAME = "type1"
+    NEEDS_STATIC = []
+
+    def fix(self, status):
+        self.node.run("fix " + self.name)
+
+    def get_status(self):
+        result = self.node.run("check " + self.name, may_fail=True)
+        return ItemStatus(correct=result.return_code == 0)
+
+
+class MockNode(Node):
+    items = ()
+
+
+class DyingWorkerPool(ThreadPool):
+    """
+    Pretends a worker died as soon as the first item has been applied.
+    """
+    def get_event(self):
+        msg = ThreadPool.get_event(self)
+        if msg['msg'] == 'FINISHED_WORK' and msg['task_id'][1] == 'item':
+            raise WorkerException(None, None, "")
+        return msg
+
+
+class ApplyNodesTest(TestCase):
+    """
+    Tests blockwart.scheduler.apply_nodes.
+    """
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        Repository().create(self.tmpdir)
+        self.repo = Repository(self.tmpdir)
+        self.transport = FakeTransport()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def _make_node(self, name, items):
+        node = MockNode(name)
+        node.transport = self.transport
+        self.repo.add_node(node)
+        bundle = MockBundle()
+        bundle.node = node
+        node.items = []
+        for item_name, needs in items:
+            node.items.append(MockItem(
+                bundle,
+                item_name,
+                {'needs': needs},
+                skip_validation=True,
+            ))
+        return node
+
+    def _apply(self, nodes, **kwargs):
+        kwargs.setdefault('pool_class', ThreadPool)
+        return list(apply_nodes(nodes, **kwargs))
+
+    def test_apply(self):
+        node1 = self._make_node("sched1", [("item1", []), ("item2", ["type1:item1"])])
+        node2 = self._make_node("sched2", [("item1", [])])
+        self.transport.fixed.add(("sched2", "item1"))
+
+        events = self._apply([node1, node2])
+
+        self.assertEqual(
+            [(event, node.name) for event, node, value in events],
+            [
+                ('started', "sched1"),
+                ('started', "sched2"),
+                ('finished', "sched2"),
+                ('finished', "sched1"),
+            ],
+        )
+        results = dict([(node.name, value) for event, node, value in events if value])
+        self.assertEqual((results['sched1'].correct, results['sched1'].fixed), (0, 2))
+        self.assertEqual((results['sched2'].correct, results['sched2'].fixed), (1, 0))
+        self.assertEqual(
+            set(self.repo.get_item_durations("sched1").keys()),
+            set(["type1:item1", "type1:item2"]),
+        )
+        commands = [command for hostname, command in self.transport.commands]
+        self.assertEqual(commands.count("rm -R " + LOCK_PATH), 2)
+
+    def test_metrics(self):
+        node = self._make_node("sched1", [("item1", []), ("item2", ["type1:item1"])])
+        metrics = PoolMetrics()
+
+        self._apply([node], metrics=metrics)
+
+        queued = dict([
+            (task['task_id'][1:], task['queued']) for task in metrics.tasks
+            if task['task_id'][1] != 'disconnect'
+        ])
+        self.assertIsNone(queued[('lock', None)])
+        self.assertIsNone(queued[('unlock', None)])
+        self.assertGreaterEqual(queued[('item', "type1:item1")], 0)
+        self.assertGreaterEqual(queued[('item', "type1:item2")], 0)
+
+    def test_node_workers(self):
+        nodes = [
+            self._make_node("sched{}".format(i), [("item1", [])])
+            for i in range(3)
+        ]
+
+        events = self._apply(nodes, node_workers=1)
+
+        self.assertEqual(
+            [(event, node.name) for event, node, value in events],
+            [
+                ('started', "sched0"),
+                ('finished', "sched0"),
+                ('started', "sched1"),
+                ('finished', "sched1"),
+                ('started', "sched2"),
+                ('finished', "sched2"),
+            ],
+        )
+
+    def test_item_workers(self):
+        node = self._make_node(
+            "sched1",
+            [("item{}".format(i), []) for i in range(10)],
+        )
+
+        events = self._apply([node], item_workers=2, workers=8)
+
+        self.assertEqual(events[-1][2].fixed, 10)
+        self.assertTrue(self.transport.max_in_flight <= 2)
+
+    def test_locked(self):
+        node1 = self._make_node("sched1", [("item1", [])])
+        node2 = self._make_node("sched2", [("item1", [])])
+        self.transport.locked.add("sched1")
+
+        events = self._apply([node1, node2])
+
+        results = dict([(node.name, value) for event, node, value in events if value])
+        self.assertEqual(results['sched1'].fixed, 0)
+        self.assertEqual(results['sched2'].fixed, 1)
+        self.assertNotIn(("sched1", "check item1"), self.transport.commands)
+
+    def test_failed(self):
+        node1 = self._make_node("sched1", [("error1", []), ("item2", [])])
+        node2 = self._make_node("sched2", [("item1", [])])
+
+        events = self._apply([node1, node2])
+
+        results = dict([(node.name, (event, value)) for event, node, value in events if value])
+        self.assertEqual(results['sched1'][0], 'failed')
+        self.assertIsInstance(results['sched1'][1], WorkerException)
+        self.assertIn("fixing error1 failed", str(results['sched1'][1].wrapped_exception))
+        self.assertEqual(results['sched2'][0], 'finished')
+        # the node is unlocked anyway
+        self.assertIn(("sched1", "rm -R " + LOCK_PATH), self.transport.commands)
+
+    def test_lock_failed(self):
+        node = self._make_node("sched1", [("item1", [])])
+        self.transport.broken.add("sched1")
+
+        events = self._apply([node])
+
+        self.assertEqual(events[-1][0], 'failed')
+        self.assertNotIn(("sched1", "fix item1"), self.transport.commands)
+        # the lock directory has been created before uploading failed
+        self.assertIn(("sched1", "rm -R " + LOCK_PATH), self.transport.commands)
+
+    def test_lock_item_timeout(self):
+        node = self._make_node("sched1", [("item1", [])])
+        self.transport.slow.add("sched1")
+
+        events = self._apply([node], item_timeout=0.2)
+
+        self.assertEqual(events[-1][0], 'finished')
+        self.assertEqual(events[-1][2].fixed, 1)
+
+    def test_item_timeout(self):
+        node = self._make_node("sched1", [
+            ("hang1", []),
+            ("item2", ["type1:hang1"]),
+            ("item3", []),
+        ])
+
+        events = self._apply([node], item_timeout=0.2)
+
+        self.assertEqual(events[-1][0], 'finished')
+        self.assertEqual(events[-1][2].failed, 1)
+        self.assertEqual(events[-1][2].skipped, 1)
+        self.assertEqual(events[-1][2].fixed, 1)
+        self.assertIn(("sched1", "rm -R " + LOCK_PATH), self.transport.commands)
+
+    def test_node_timeout(self):
+        node = self._make_node("sched1", [("hang1", []), ("item2", [])])
+        self.repo.set_item_durations("sched1", {"type1:hang1": 10})
+
+        events = self._apply([node], item_workers=1, node_timeout=0.2)
+
+        self.assertEqual(events[-1][2].failed, 1)
+        self.assertEqual(events[-1][2].skipped, 1)
+        self.assertIn(("sched1", "rm -R " + LOCK_PATH), self.transport.commands)
+
+    @patch('blockwart.scheduler.operations.disconnect')
+    def test_disconnect(self, disconnect):
+        node1 = self._make_node("sched1", [("item1", []), ("item2", [])])
+        node2 = self._make_node("sched2", [("item1", [])])
+
+        self._apply([node1, node2], workers=2, node_workers=1)
+
+        # node1 is done before node2 is started, so workers disconnect
+        # from it while node2 is still being applied
+        self.assertIn(call("sched1"), disconnect.call_args_list)
+
+    def test_worker_died(self):
+        node1 = self._make_node("sched1", [("item1", []), ("item2", ["type1:item1"])])
+        node2 = self._make_node("sched2", [("item1", [])])
+
+        with self.assertRaises(WorkerException):
+            self._apply([node1, node2], pool_class=DyingWorkerPool)
+
+        self.assertIn(("sched1", "rm -R " + LOCK_PATH), self.transport.commands)
+        self.assertIn(("sched2", "rm -R " + LOCK_PATH), self.transport.commands)
+
+    def test_processes(self):
+        node = self._make_node("sched1", [("item1", []), ("item2", ["type1:item1"])])
+
+        parent_pid = getpid()
+
+        def connection_setup_time(hostname):
+            # only the worker is connected to the node
+            return 1.5 if getpid() != parent_pid else None
+
+        with patch(
+            'blockwart.scheduler.operations.connection_setup_time',
+            side_effect=connection_setup_time,
+        ):
+            events = self._apply([node], pool_class=WorkerPool)
+
+        self.assertEqual([event for event, node, value in events], ['started', 'finished'])
+        self.assertEqual(events[-1][2].connection_setup_time, 1.5)
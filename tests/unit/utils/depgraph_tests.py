@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from mock import MagicMock
+
+from blockwart.utils.depgraph import DependencyGraph
+
+
+def make_item(item_id, deps):
+    item = MagicMock()
+    item.id = item_id
+    item._deps = deps
+    return item
+
+
+class DependencyGraphTest(TestCase):
+    """
+    Tests blockwart.utils.depgraph.DependencyGraph.
+    """
+    def test_deps(self):
+        item1 = make_item("type1:name1", ["type1:name2", "type1:name3", "type1:name2"])
+        item2 = make_item("type1:name2", [])
+        item3 = make_item("type1:name3", ["type1:name2"])
+        graph = DependencyGraph([item1, item2, item3])
+        self.assertEqual(list(graph.deps(0)), [1, 2])
+        self.assertEqual(list(graph.deps(1)), [])
+        self.assertEqual(list(graph.dependents(1)), [0, 2])
+        self.assertEqual(list(graph.dependents(2)), [0])
+        self.assertEqual(graph.index["type1:name3"], 2)
+
+    def test_unknown_dep(self):
+        item1 = make_item("type1:name1", ["type1:name2"])
+        with self.assertRaises(ValueError):
+            DependencyGraph([item1])
+
+
+class DependencyGraphStronglyConnectedComponentsTest(TestCase):
+    """
+    Tests blockwart.utils.depgraph.DependencyGraph.strongly_connected_components.
+    """
+    def test_components(self):
+        item1 = make_item("type1:name1", ["type1:name2"])
+        item2 = make_item("type1:name2", ["type1:name3"])
+        item3 = make_item("type1:name3", ["type1:name1", "type1:name4"])
+        item4 = make_item("type1:name4", [])
+        item5 = make_item("type1:name5", ["type1:name5"])
+        graph = DependencyGraph([item1, item2, item3, item4, item5])
+        components = graph.strongly_connected_components()
+        self.assertEqual(len(components), 3)
+        self.assertEqual(components[0], [3])
+        self.assertEqual(set(components[1]), set([0, 1, 2]))
+        self.assertEqual(components[2], [4])
+
+    def test_deep_chain(self):
+        items = [make_item("type1:name0", [])]
+        for i in range(1, 2000):
+            items.append(make_item("type1:name{}".format(i), [items[-1].id]))
+        graph = DependencyGraph(items)
+        self.assertEqual(len(graph.strongly_connected_components()), 2000)
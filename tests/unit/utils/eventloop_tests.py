@@ -0,0 +1,97 @@
+from unittest import TestCase
+
+from blockwart.utils.eventloop import CompletionQueue, EventLoop, Return, sleep
+
+
+def _add_later(loop, a, b):
+    yield sleep(loop, 0.01)
+    raise Return(a + b)
+
+
+def _fail():
+    raise ValueError("failed")
+
+
+class EventLoopTest(TestCase):
+    """
+    Tests blockwart.utils.eventloop.EventLoop.
+    """
+    def test_return(self):
+        with EventLoop() as loop:
+            self.assertEqual(loop.run_until_complete(_add_later(loop, 1, 2)), 3)
+
+    def test_nested(self):
+        def coroutine(loop):
+            a = yield loop.create_task(_add_later(loop, 1, 2))
+            b = yield loop.create_task(_add_later(loop, a, 3))
+            raise Return(b)
+
+        with EventLoop() as loop:
+            self.assertEqual(loop.run_until_complete(coroutine(loop)), 6)
+
+    def test_exception(self):
+        def coroutine(loop):
+            try:
+                yield loop.run_in_executor(_fail)
+            except ValueError:
+                raise Return("caught")
+
+        with EventLoop() as loop:
+            self.assertEqual(loop.run_until_complete(coroutine(loop)), "caught")
+
+    def test_exception_traceback(self):
+        def coroutine(loop):
+            yield sleep(loop, 0)
+            _fail()
+
+        with EventLoop() as loop:
+            task = loop.create_task(coroutine(loop))
+            with self.assertRaises(ValueError):
+                loop.run_until_complete(task)
+            self.assertIn("_fail", task.traceback)
+
+    def test_executor(self):
+        with EventLoop(executor_threads=2) as loop:
+            futures = [loop.run_in_executor(lambda x: x * 2, i) for i in range(5)]
+            results = [loop.run_until_complete(future) for future in futures]
+            self.assertEqual(results, [0, 2, 4, 6, 8])
+            self.assertEqual(len(loop._executor_workers), 2)
+
+    def test_timers(self):
+        order = []
+        with EventLoop() as loop:
+            loop.call_later(0.02, order.append, 2)
+            loop.call_later(0.01, order.append, 1)
+            loop.call_soon(order.append, 0)
+            loop.run_until_complete(sleep(loop, 0.03))
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_yield_non_future(self):
+        def coroutine(loop):
+            yield 47
+
+        with EventLoop() as loop:
+            with self.assertRaises(TypeError):
+                loop.run_until_complete(coroutine(loop))
+
+
+class CompletionQueueTest(TestCase):
+    """
+    Tests blockwart.utils.eventloop.CompletionQueue.
+    """
+    def test_order(self):
+        def coroutine(loop):
+            queue = CompletionQueue(loop)
+            queue.add(sleep(loop, 0.02, "slow"))
+            queue.add(sleep(loop, 0.01, "fast"))
+            results = []
+            while len(queue):
+                done = yield queue.get()
+                results.extend([future.result() for future in done])
+            raise Return(results)
+
+        with EventLoop() as loop:
+            self.assertEqual(
+                loop.run_until_complete(coroutine(loop)),
+                ["fast", "slow"],
+            )
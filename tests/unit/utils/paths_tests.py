@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from mock import MagicMock
+
+from blockwart.utils import paths
+
+
+def make_item(item_type, path):
+    item = MagicMock()
+    item.ITEM_TYPE_NAME = item_type
+    item.id = "{}:{}".format(item_type, path)
+    item.name = path
+    return item
+
+
+class PathIndexTest(TestCase):
+    """
+    Tests blockwart.utils.paths.PathIndex.
+    """
+    def test_parents(self):
+        item1 = make_item("directory", "/foo/bar")
+        item2 = make_item("directory", "/foo")
+        item3 = make_item("directory", "/foo/barbaz")
+        item4 = make_item("symlink", "/foo/bar/baz")
+        item5 = make_item("directory", "/")
+        index = paths.PathIndex([item1, item2, item3, item4, item5])
+        self.assertEqual(
+            index.items_on_path("/foo/bar/baz", ("directory",)),
+            [item1, item2, item5],
+        )
+
+    def test_path_types(self):
+        item1 = make_item("file", "/foo/bar")
+        item2 = make_item("symlink", "/foo/bar")
+        item3 = make_item("file", "/foo")
+        index = paths.PathIndex([item1, item2, item3])
+        self.assertEqual(
+            index.items_on_path("/foo/bar", ("file",), path_types=("symlink",)),
+            [item2, item3],
+        )
+
+    def test_ignores_other_types(self):
+        item1 = make_item("directory", "/foo")
+        item2 = MagicMock()
+        item2.ITEM_TYPE_NAME = "action"
+        item2.name = "foo"
+        index = paths.PathIndex([item1, item2])
+        self.assertEqual(index.items_on_path("/foo/bar", ("directory",)), [item1])
+
+    def test_root(self):
+        item1 = make_item("directory", "/")
+        index = paths.PathIndex([item1])
+        self.assertEqual(index.items_on_path("/", ("directory",)), [])
+
+    def test_relative(self):
+        with self.assertRaises(ValueError):
+            paths.PathIndex([make_item("file", "foo")])
+
@@ -61,10 +61,9 @@ class PathInfoTest(TestCase):
     """
     Tests blockwart.utils.remote.PathInfo.
     """
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'nonexistent', ""))
-    def test_nonexistent(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'nonexistent', "", {}, None))
+    def test_nonexistent(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertFalse(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -75,10 +74,9 @@ class PathInfoTest(TestCase):
         with self.assertRaises(ValueError):
             p.symlink_target
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'file', "data"))
-    def test_binary(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'file', "data", {}, None))
+    def test_binary(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertTrue(p.is_binary_file)
@@ -89,10 +87,9 @@ class PathInfoTest(TestCase):
         with self.assertRaises(ValueError):
             p.symlink_target
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'directory', "directory"))
-    def test_directory(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'directory', "directory", {}, None))
+    def test_directory(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -103,10 +100,9 @@ class PathInfoTest(TestCase):
         with self.assertRaises(ValueError):
             p.symlink_target
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'file', "ASCII English text"))
-    def test_text(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'file', "ASCII English text", {}, None))
+    def test_text(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -117,10 +113,9 @@ class PathInfoTest(TestCase):
         with self.assertRaises(ValueError):
             p.symlink_target
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'symlink', "symbolic link to `/47'"))
-    def test_symlink_normal(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'symlink', "symbolic link to `/47'", {}, None))
+    def test_symlink_normal(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -130,10 +125,9 @@ class PathInfoTest(TestCase):
         self.assertFalse(p.is_text_file)
         self.assertEqual(p.symlink_target, "/47")
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'symlink', "broken symbolic link to `/47'"))
-    def test_symlink_broken(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'symlink', "broken symbolic link to `/47'", {}, None))
+    def test_symlink_broken(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -143,10 +137,9 @@ class PathInfoTest(TestCase):
         self.assertFalse(p.is_text_file)
         self.assertEqual(p.symlink_target, "/47")
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'symlink', "symbolic link to /47"))
-    def test_symlink_noquotes(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'symlink', "symbolic link to /47", {}, None))
+    def test_symlink_noquotes(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -156,10 +149,9 @@ class PathInfoTest(TestCase):
         self.assertFalse(p.is_text_file)
         self.assertEqual(p.symlink_target, "/47")
 
-    @patch('blockwart.utils.remote.stat')
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'symlink', "broken symbolic link to /47"))
-    def test_symlink_noquotes_broken(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'symlink', "broken symbolic link to /47", {}, None))
+    def test_symlink_noquotes_broken(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertTrue(p.exists)
         self.assertFalse(p.is_binary_file)
@@ -183,15 +175,18 @@ class PathInfoTest(TestCase):
             "827bfc458708f0b442009c9c9836f7e4b65557fb",
         )
 
-    @patch('blockwart.utils.remote.stat', return_value={
-        'owner': "foo",
-        'group': "bar",
-        'mode': "4747",
-        'size': 4848,
-    })
-    @patch('blockwart.utils.remote.get_path_type', return_value=(
-        'file', "data"))
-    def test_stat(self, stat, get_path_type):
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'file',
+        "data",
+        {
+            'owner': "foo",
+            'group': "bar",
+            'mode': "4747",
+            'size': 4848,
+        },
+        None,
+    ))
+    def test_stat(self, get_path_info):
         p = remote.PathInfo(MagicMock(), "/")
         self.assertEqual(p.owner, "foo")
         self.assertEqual(p.group, "bar")
@@ -199,6 +194,48 @@ class PathInfoTest(TestCase):
         self.assertEqual(p.size, 4848)
 
 
+def _result(return_code, stdout=""):
+    result = RunResult()
+    result.return_code = return_code
+    result.stderr = ""
+    result.stdout = stdout
+    return result
+
+
+class GetPathInfoTest(TestCase):
+    """
+    Tests blockwart.utils.remote.get_path_info.
+    """
+    def test_file(self):
+        node = MagicMock()
+        node.run_many.return_value = [
+            _result(0, "ASCII text\n"),
+            _result(0, "user:group:644:47"),
+            _result(0, "827bfc458708f0b442009c9c9836f7e4b65557fb  /foo\n"),
+        ]
+        path_type, desc, file_stat, sha1 = remote.get_path_info(node, "/foo", sha1=True)
+        self.assertEqual(len(node.run_many.call_args_list), 1)
+        self.assertEqual(path_type, 'file')
+        self.assertEqual(file_stat['mode'], "0644")
+        self.assertEqual(sha1, "827bfc458708f0b442009c9c9836f7e4b65557fb")
+
+    def test_nonexistent(self):
+        node = MagicMock()
+        node.run_many.return_value = [_result(1), _result(1)]
+        self.assertEqual(
+            remote.get_path_info(node, "/foo"),
+            ('nonexistent', "", {}, None),
+        )
+
+    @patch('blockwart.utils.remote.get_path_info', return_value=(
+        'file', "data", {}, "47"))
+    def test_prefetched_sha1(self, get_path_info):
+        node = MagicMock()
+        p = remote.PathInfo(node, "/foo", sha1=True)
+        self.assertEqual(p.sha1, "47")
+        self.assertFalse(node.run.called)
+
+
 class StatTest(TestCase):
     """
     Tests blockwart.utils.remote.stat.